@@ -0,0 +1,214 @@
+"""
+Load test of the Flask app under gunicorn (threaded workers) against the
+asyncio entry point, dataserv.aioapp. Many concurrent clients send signed
+pings that are all accepted (MAX_PING 0) and so verified and written, and
+a share of the requests reads /api/online/json. With a --max-ping above
+the run time only the first ping of a farmer is verified and written.
+
+    python -m benchmarks.bench_async --concurrency 200 --seconds 10
+
+Each server runs in its own process on a copy of one populated sqlite
+file. The headers are signed before the clock starts and replay
+protection is off in the servers, so the client does not sign.
+
+"""
+import os
+import sys
+import time
+import shutil
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from email.utils import formatdate
+
+
+SERVERS = ["flask", "aiohttp"]
+
+
+def serve(server, port, workers, threads):
+    """Run one of the servers in this process until terminated."""
+    from dataserv.app import app
+    app.config["AUTHENTICATION_TIMEOUT"] = 24 * 3600
+    if server == "aiohttp":
+        from aiohttp import web
+        from dataserv.aioapp import create_app
+        web.run_app(create_app(), host="127.0.0.1", port=port,
+                    access_log=None, print=None)
+        return
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:  # werkzeug's threaded server instead
+        app.run(host="127.0.0.1", port=port, threaded=True)
+        return
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set("bind", "127.0.0.1:{0}".format(port))
+            self.cfg.set("workers", workers)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", threads)
+            self.cfg.set("backlog", 4096)
+            self.cfg.set("loglevel", "warning")
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def populate(path, farmers, signed):
+    """Fill the database, returns (btc_addr, headers) of the signers."""
+    os.environ["DATASERV_DATABASE_URI"] = "sqlite:///" + path
+    from btctxstore import BtcTxStore
+    from dataserv.app import app, db
+    from dataserv.Farmer import Farmer
+    from dataserv.population import populate_database
+    db.create_all()
+    populate_database(farmers, online=0.05)
+    btctxstore = BtcTxStore()
+    date = formatdate(timeval=time.mktime(datetime.now().timetuple()),
+                      localtime=True, usegmt=True)
+    message = app.config["ADDRESS"] + " " + date
+    signers = []
+    for _ in range(signed):
+        wif = btctxstore.create_key()
+        btc_addr = btctxstore.get_address(wif)
+        Farmer(btc_addr).register()
+        signature = btctxstore.sign_unicode(wif, message)
+        signers.append((btc_addr, {"Date": date,
+                                   "Authorization": signature.decode()}))
+    db.session.remove()
+    db.engine.dispose()
+    return signers
+
+
+async def load(port, signers, concurrency, seconds, reads):
+    import aiohttp
+    base = "http://127.0.0.1:{0}".format(port)
+    latencies = []
+    codes = {}
+    deadline = time.time() + seconds
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def client(btc_addr, headers):
+            while time.time() < deadline:
+                if random.random() < reads:
+                    url, sent = base + "/api/online/json", None
+                else:
+                    url, sent = base + "/api/ping/" + btc_addr, headers
+                begin = time.time()
+                try:
+                    async with session.get(url, headers=sent) as response:
+                        await response.read()
+                        code = response.status
+                except aiohttp.ClientError:
+                    code = 0
+                latencies.append(time.time() - begin)
+                codes[code] = codes.get(code, 0) + 1
+
+        await asyncio.gather(*[client(*signers[i % len(signers)])
+                               for i in range(concurrency)])
+    latencies.sort()
+
+    def percentile(share):
+        if not latencies:
+            return 0.0
+        return latencies[int(len(latencies) * share)] * 1000
+
+    return {
+        "requests_per_sec": len(latencies) / seconds,
+        "failed": len(latencies) - codes.get(200, 0),
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def wait_ready(port, process, timeout=30):
+    from urllib.request import urlopen
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited with {0}".format(
+                process.returncode))
+        try:
+            urlopen("http://127.0.0.1:{0}/api/total".format(port)).read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def run(server, args, directory, source, signers):
+    path = os.path.join(directory, server + ".db")
+    shutil.copy(source, path)
+    env = dict(os.environ,
+               DATASERV_DATABASE_URI="sqlite:///" + path,
+               DATASERV_MAX_PING=str(args.max_ping),
+               DATASERV_CACHING_TIME="0",
+               DATASERV_LOG_LEVEL="WARNING",
+               DATASERV_LOG_FILE=os.path.join(directory, server + ".log"),
+               DATASERV_METRICS_DIR=directory)
+    if args.wal:
+        env["DATASERV_SQLITE_WAL"] = "1"
+    command = [sys.executable, "-m", "benchmarks.bench_async",
+               "--serve", server, "--port", str(args.port),
+               "--workers", str(args.workers), "--threads", str(args.threads)]
+    process = subprocess.Popen(command, env=env)
+    try:
+        wait_ready(args.port, process)
+        return asyncio.get_event_loop().run_until_complete(load(
+            args.port, signers, args.concurrency, args.seconds, args.reads))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--concurrency", type=int, default=200,
+                        help="concurrent client connections")
+    parser.add_argument("--signers", type=int, default=200,
+                        help="farmers with signing keys, pinged in turn")
+    parser.add_argument("--farmers", type=int, default=10000,
+                        help="other registered farmers")
+    parser.add_argument("--reads", type=float, default=0.01,
+                        help="share of requests to /api/online/json")
+    parser.add_argument("--max-ping", type=int, default=0,
+                        help="MAX_PING of the servers, throttled pings are "
+                             "neither verified nor written")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="gunicorn worker processes for flask")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="threads per gunicorn worker")
+    parser.add_argument("--wal", action="store_true",
+                        help="set DATASERV_SQLITE_WAL for both servers")
+    parser.add_argument("--port", type=int, default=5123)
+    parser.add_argument("--serve", choices=SERVERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port, args.workers, args.threads)
+        return 0
+
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, "source.db")
+        signers = populate(source, args.farmers, args.signers)
+        print("{0:10} {1:>10} {2:>8} {3:>8} {4:>9}".format(
+            "server", "req/s", "failed", "p50 ms", "p99 ms"))
+        for server in SERVERS:
+            r = run(server, args, directory, source, signers)
+            print("{0:10} {1[requests_per_sec]:10.1f} {1[failed]:8d} "
+                  "{1[p50_ms]:8.2f} {1[p99_ms]:9.2f}".format(server, r))
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
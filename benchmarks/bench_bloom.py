@@ -0,0 +1,75 @@
+"""
+The registered address filter at a synthetic population in a temporary
+SQLite database: build time, size, false positive rate and pings of
+unregistered addresses with and without the filter.
+
+    python -m benchmarks.bench_bloom --farmers 1000000 --pings 2000
+
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+
+def ping_rate(client, addresses):
+    """Pings of addresses per second and their status codes."""
+    codes = {}
+    begin = time.time()
+    for btc_addr in addresses:
+        code = client.get("/api/ping/{0}".format(btc_addr)).status_code
+        codes[code] = codes.get(code, 0) + 1
+    return len(addresses) / (time.time() - begin), codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--farmers", type=int, default=1000000,
+                        help="registered farmers")
+    parser.add_argument("--pings", type=int, default=2000,
+                        help="pings of unregistered addresses per run")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        from dataserv.app import app, db
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
+            directory, "bench.db")
+        app.config["SKIP_AUTHENTICATION"] = True
+        import dataserv.bloom
+        from dataserv.population import populate_database, random_address
+        from dataserv.bloom import RegisteredAddresses
+        db.create_all()
+        populate_database(args.farmers)
+        strangers = [random_address() for _ in range(args.pings)]
+
+        registry = RegisteredAddresses(args.error_rate,
+                                       app.config["BLOOM_MIN_CAPACITY"],
+                                       3600, 3600)
+        begin = time.time()
+        with app.app_context():
+            bloom = registry.build()
+        print("built for {0} farmers in {1:.1f}s, {2:.2f} MB, {3} hashes"
+              .format(args.farmers, time.time() - begin,
+                      len(bloom.bits) / 1024.0 ** 2, bloom.hashes))
+        false = sum(btc_addr in bloom for btc_addr in strangers)
+        print("false positives {0:.2%}".format(false / float(len(strangers))))
+
+        client = app.test_client()
+        rate, codes = ping_rate(client, strangers)
+        print("without filter {0:8.0f} pings/s {1}".format(rate, codes))
+        dataserv.bloom._registry.append(registry)
+        rate, codes = ping_rate(client, strangers)
+        print("with filter    {0:8.0f} pings/s {1}".format(rate, codes))
+        db.session.remove()
+        db.engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+Import time of the serving and command line entry points, from
+`python -X importtime` in fresh interpreters, with the slowest imported
+packages of the first target.
+
+    python -m benchmarks.bench_import --runs 5 --top 15
+
+The wall time includes the interpreter start, the import time sums the
+cumulative times of the top level imports -X importtime reported.
+
+"""
+import sys
+import time
+import argparse
+import subprocess
+
+
+TARGETS = [
+    ("dataserv.app", "import dataserv.app"),
+    ("wsgi create_app", "import dataserv.wsgi; dataserv.wsgi.create_app()"),
+    ("dataserv.manage", "import dataserv.manage"),
+    ("dataserv.aioapp", "import dataserv.aioapp"),
+]
+
+
+def importtime(code):
+    """Wall seconds, import us and {module: cumulative us} of one run."""
+    begin = time.time()
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c",
+                                code], stderr=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    _, err = process.communicate()
+    wall = time.time() - begin
+    if process.returncode:
+        raise RuntimeError(err.decode("utf-8", "replace").strip()[-500:])
+    total = 0
+    modules = {}
+    for line in err.decode("utf-8", "replace").splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:  # the header line
+            continue
+        name = fields[2][1:]  # one space after the bar, then the depth
+        if not name.startswith(" "):
+            total += cumulative
+        modules.setdefault(name.strip(), cumulative)
+    return wall, total, modules
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--runs", type=int, default=5,
+                        help="fresh interpreters per target")
+    parser.add_argument("--top", type=int, default=15,
+                        help="slowest top level packages listed")
+    args = parser.parse_args()
+
+    print("{0:18} {1:>10} {2:>10}".format("target", "wall ms", "import ms"))
+    first = None
+    for name, code in TARGETS:
+        try:
+            runs = [importtime(code) for _ in range(args.runs)]
+        except RuntimeError as error:
+            print("{0:18} failed: {1}".format(name, error))
+            continue
+        print("{0:18} {1:10.1f} {2:10.1f}".format(
+            name, median(run[0] for run in runs) * 1000,
+            median(run[1] for run in runs) / 1000))
+        first = first or runs
+
+    if first:
+        totals = {}
+        for _, _, modules in first:
+            for module, cumulative in modules.items():
+                if "." not in module:  # packages, their children summed in
+                    totals.setdefault(module, []).append(cumulative)
+        slowest = sorted(totals.items(), key=lambda i: -median(i[1]))
+        print("\nslowest packages of {0}:".format(TARGETS[0][0]))
+        for module, cumulative in slowest[:args.top]:
+            print("  {0:30} {1:8.1f} ms".format(module,
+                                              median(cumulative) / 1000))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
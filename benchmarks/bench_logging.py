@@ -0,0 +1,65 @@
+"""
+Per-request cost of the route logging: the former eager str.format with a
+synchronous file handler against lazy formatting through the queue, with
+and without sampling of the ping records.
+
+    python -m benchmarks.bench_logging --calls 20000
+
+"""
+import os
+import time
+import logging
+import argparse
+import tempfile
+from dataserv.logs import setup_logging, stop_logging
+
+
+ADDRESS = "1JdEaubcd36ufmT64drdVsGu5SN65A3Z1L"
+
+
+def eager(logger, count):
+    for _ in range(count):
+        logger.info("CALLED /api/ping/{0}".format(ADDRESS))
+
+
+def lazy(logger, count):
+    for _ in range(count):
+        logger.info("CALLED /api/ping/%s", ADDRESS)
+
+
+def measure(config, log, count):
+    setup_logging(config)
+    logger = logging.getLogger("bench")
+    begin = time.time()
+    log(logger, count)
+    elapsed = time.time() - begin
+    stop_logging()  # drains the queue, not part of the request time
+    return elapsed / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.log")
+    base = {"LOG_LEVEL": "DEBUG", "LOG_FILE": path,
+            "LOG_SAMPLED": ["CALLED /api/ping/"]}
+    cases = [
+        ("sync file, eager format", eager,
+         dict(base, LOG_QUEUE=False, LOG_SAMPLE_RATE=1.0)),
+        ("sync file, lazy format", lazy,
+         dict(base, LOG_QUEUE=False, LOG_SAMPLE_RATE=1.0)),
+        ("queue, lazy format", lazy,
+         dict(base, LOG_QUEUE=True, LOG_SAMPLE_RATE=1.0)),
+        ("queue, lazy, 1% sampled", lazy,
+         dict(base, LOG_QUEUE=True, LOG_SAMPLE_RATE=0.01)),
+    ]
+    for name, log, config in cases:
+        print("{0:26} {1:8.2f} us per request".format(
+            name, measure(config, log, args.calls)))
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
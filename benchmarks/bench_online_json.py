@@ -0,0 +1,80 @@
+"""
+Bytes per second of the /api/online/json body for synthetic farmers,
+comparing the old dumps/loads/jsonify path with the fragment pipeline,
+on FarmerRecords and on plain rows with epoch second times.
+
+    python -m benchmarks.bench_online_json --farmers 10000
+
+"""
+import json
+import time
+import argparse
+from datetime import datetime
+from datetime import timedelta
+from flask import jsonify
+from dataserv.run import app
+from dataserv.Farmer import FarmerRecord
+from dataserv.serialize import FragmentCache
+from dataserv.epochtime import to_epoch
+
+
+def synthetic_farmers(count):
+    now = datetime.utcnow()
+    return [FarmerRecord(i, "1Addr{0:029d}".format(i),
+                         "1Payout{0:027d}".format(i), count - i,
+                         now - timedelta(seconds=i % 300),
+                         now - timedelta(days=1 + i % 30), i % 86400)
+            for i in range(count)]
+
+
+def old_pipeline(farmers):
+    payload = {"farmers": [json.loads(f.to_json()) for f in farmers]}
+    return jsonify(payload).get_data()
+
+
+def new_pipeline(cache):
+    def render(farmers):
+        return cache.render(farmers).encode("utf-8")
+    return render
+
+
+def rows_pipeline(cache):
+    def render(rows):
+        return cache.render_rows(rows, int(time.time())).encode("utf-8")
+    return render
+
+
+def measure(render, farmers, seconds):
+    render(farmers)  # warm up, fills the fragment cache
+    runs = 0
+    size = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        size += len(render(farmers))
+        runs += 1
+    elapsed = time.time() - start
+    return runs / elapsed, size / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--farmers", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    farmers = synthetic_farmers(args.farmers)
+    rows = [farmer[:4] + (to_epoch(farmer.last_seen),
+                          to_epoch(farmer.reg_time), farmer.uptime)
+            for farmer in farmers]
+    with app.test_request_context():
+        for name, render, data in [
+                ("dumps/loads/jsonify", old_pipeline, farmers),
+                ("fragments", new_pipeline(FragmentCache()), farmers),
+                ("epoch rows", rows_pipeline(FragmentCache()), rows)]:
+            per_sec, bytes_per_sec = measure(render, data, args.seconds)
+            print("{0:20} {1:8.2f} bodies/s {2:8.2f} MB/s".format(
+                name, per_sec, bytes_per_sec / 1024 ** 2))
+
+
+if __name__ == "__main__":
+    main()
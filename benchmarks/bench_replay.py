@@ -0,0 +1,75 @@
+"""
+Throughput and memory of the replay guard at a sustained request rate,
+next to the cost of the signature check it saves on a replay.
+
+    python -m benchmarks.bench_replay --rate 10000 --seconds 60
+
+"""
+import time
+import argparse
+import tracemalloc
+from datetime import datetime
+from email.utils import formatdate
+import storjcore
+from btctxstore import BtcTxStore
+from dataserv.run import app
+from dataserv.replay import ReplayGuard
+
+
+def simulate(guard, rate, seconds, start):
+    """Accept rate distinct header sets per second, timed."""
+    elapsed = 0.0
+    for second in range(seconds):
+        now = start + second
+        date = formatdate(timeval=now, usegmt=True)
+        headers = [{"Date": date, "Authorization": "{0}-{1}".format(second, i)}
+                   for i in range(rate)]
+        begin = time.time()
+        for h in headers:
+            if not guard.seen("1Sender", h, now):
+                guard.add("1Sender", h, now)
+        elapsed += time.time() - begin
+    return rate * seconds / elapsed
+
+
+def signature_check(count):
+    btctxstore = BtcTxStore()
+    wif = btctxstore.create_key()
+    sender = btctxstore.get_address(wif)
+    date = formatdate(timeval=time.mktime(datetime.now().timetuple()),
+                      localtime=True, usegmt=True)
+    message = app.config["ADDRESS"] + " " + date
+    headers = {"Date": date,
+               "Authorization": btctxstore.sign_unicode(wif, message)}
+    begin = time.time()
+    for _ in range(count):
+        storjcore.auth.verify_headers(btctxstore, headers, 20, sender,
+                                      app.config["ADDRESS"])
+    return count / (time.time() - begin)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--rate", type=int, default=10000,
+                        help="accepted requests per second")
+    parser.add_argument("--seconds", type=int, default=60)
+    args = parser.parse_args()
+
+    timeout = app.config["AUTHENTICATION_TIMEOUT"]
+    per_sec = simulate(ReplayGuard(timeout, app.config["REPLAY_BUCKET"]),
+                       args.rate, args.seconds, 1e9)
+    guard = ReplayGuard(timeout, app.config["REPLAY_BUCKET"])
+    tracemalloc.start()  # slows everything down, so a separate run
+    simulate(guard, args.rate, args.seconds, 1e9)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("replay guard      {0:10.0f} checks/s".format(per_sec))
+    print("entries           {0:10d} ({1} s window)".format(len(guard),
+                                                           timeout))
+    print("memory            {0:10.2f} MB now, {1:.2f} MB peak".format(
+        current / 1024 ** 2, peak / 1024 ** 2))
+    print("signature check   {0:10.0f} checks/s".format(signature_check(50)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Snapshot and restore of a synthetic population in temporary SQLite
+databases: the time of each direction, the snapshot size against the
+database file and the peak memory of this process.
+
+    python -m benchmarks.bench_snapshot --farmers 1000000
+
+The restore goes into a second, empty database. The peak memory is
+reported after populating and again after each direction, it should not
+grow with the number of farmers.
+
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+
+
+def peak_mb():
+    """Peak resident memory of this process, kilobytes on Linux."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--farmers", type=int, default=1000000,
+                        help="farmers in the snapshot")
+    parser.add_argument("--chunk", type=int, default=None,
+                        help="rows per compressed chunk")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        from dataserv.app import app, db
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
+            directory, "source.db")
+        import sqlalchemy as sa
+        import dataserv.Farmer  # noqa, the tables
+        from dataserv.population import populate_database
+        from dataserv.snapshot import (CHUNK, restore_snapshot, row_counts,
+                                       take_snapshot, tables)
+        chunk = args.chunk or CHUNK
+        db.create_all()
+        begin = time.time()
+        populate_database(args.farmers)
+        print("populated {0} farmers in {1:.1f}s, peak {2:.0f} MB".format(
+            args.farmers, time.time() - begin, peak_mb()))
+
+        path = os.path.join(directory, "node.snapshot")
+        begin = time.time()
+        counts = take_snapshot(db.engine, path, chunk)
+        seconds = time.time() - begin
+        size = os.path.getsize(path)
+        database = os.path.getsize(os.path.join(directory, "source.db"))
+        print("snapshot {0:8.1f}s {1:9.0f} rows/s {2:6.1f} MB ({3:.0%} of "
+              "the database), peak {4:.0f} MB".format(
+                  seconds, counts["farmer"] / seconds, size / 1024.0 ** 2,
+                  size / float(database), peak_mb()))
+
+        target = sa.create_engine("sqlite:///" + os.path.join(
+            directory, "target.db"))
+        db.metadata.create_all(target, tables=tables())
+        begin = time.time()
+        restored = restore_snapshot(target, path)
+        seconds = time.time() - begin
+        print("restore  {0:8.1f}s {1:9.0f} rows/s, peak {2:.0f} MB".format(
+            seconds, restored["farmer"] / seconds, peak_mb()))
+        if row_counts(target) != counts:
+            print("restored rows differ: {0} != {1}".format(
+                row_counts(target), counts))
+            return 1
+        target.dispose()
+        db.session.remove()
+        db.engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+Concurrent pings against one SQLite file, as several gunicorn threads
+would send them, in the default mode, with WAL only and with WAL and the
+single writer thread. Every ping is accepted (MAX_PING 0) and so a write,
+while reader threads keep fetching the online list.
+
+    python -m benchmarks.bench_sqlite_concurrency --threads 16 --seconds 10
+
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+
+MODES = [
+    ("default", False, False),
+    ("wal", True, False),
+    ("wal+writer", True, True),
+]
+
+
+def hammer(app, addresses, seconds, readers):
+    """Ping the addresses from one thread each, counted per status code."""
+    latencies = []
+    codes = {}
+    reads = []
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def pings(btc_addr):
+        client = app.test_client()
+        while time.time() < deadline:
+            begin = time.time()
+            code = client.get("/api/ping/{0}".format(btc_addr)).status_code
+            with lock:
+                latencies.append(time.time() - begin)
+                codes[code] = codes.get(code, 0) + 1
+
+    def online():
+        client = app.test_client()
+        while time.time() < deadline:
+            client.get("/api/online/json")
+            with lock:
+                reads.append(1)
+
+    threads = [threading.Thread(target=pings, args=(a,)) for a in addresses]
+    threads += [threading.Thread(target=online) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+
+    def percentile(share):
+        if not latencies:
+            return 0.0
+        return latencies[int(len(latencies) * share)] * 1000
+
+    return {
+        "pings_per_sec": len(latencies) / seconds,
+        "accepted": codes.get(200, 0),
+        "failed": len(latencies) - codes.get(200, 0),
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+        "reads_per_sec": len(reads) / seconds,
+    }
+
+
+def run(mode, wal, writer, args, directory):
+    from dataserv.app import app, db
+    from dataserv.population import populate_database
+    from dataserv.walmode import get_writer, reset_writers
+
+    reset_writers()
+    app.config["SQLITE_WAL"] = wal
+    app.config["SQLITE_WRITER"] = writer
+    path = os.path.join(directory, mode.replace("+", "_") + ".db")
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    db.create_all()
+    addresses = populate_database(args.farmers, online=0.05)
+    result = hammer(app, addresses[:args.threads], args.seconds,
+                    args.readers)
+    if writer:
+        result["transactions"] = get_writer().groups
+    reset_writers()
+    db.session.remove()
+    db.engine.dispose()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--threads", type=int, default=16,
+                        help="pinging threads, one farmer each")
+    parser.add_argument("--readers", type=int, default=2,
+                        help="threads reading /api/online/json")
+    parser.add_argument("--farmers", type=int, default=10000,
+                        help="registered farmers")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    from dataserv.app import app
+    import dataserv.Farmer  # noqa, the tables
+    app.config["MAX_PING"] = 0
+    app.config["SKIP_AUTHENTICATION"] = True
+    app.config["DISABLE_CACHING"] = True
+    directory = tempfile.mkdtemp()
+    try:
+        print("{0:12} {1:>9} {2:>8} {3:>8} {4:>9} {5:>9} {6:>9}".format(
+            "mode", "pings/s", "failed", "p50 ms", "p99 ms", "reads/s",
+            "commits"))
+        for mode, wal, writer in MODES:
+            r = run(mode, wal, writer, args, directory)
+            print("{0:12} {1[pings_per_sec]:9.1f} {1[failed]:8d} "
+                  "{1[p50_ms]:8.2f} {1[p99_ms]:9.2f} {1[reads_per_sec]:9.1f} "
+                  "{2:>9}".format(mode, r, r.get("transactions", r["accepted"])))
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""
+Latency and throughput of the dataserv hot paths on synthetic farmer
+populations in SQLite, saved per git commit for comparison.
+
+    python -m benchmarks.suite --sizes 1000,100000,1000000
+    python -m benchmarks.suite --compare 24a9628 HEAD
+
+Results are written to benchmarks/results/<commit>.json.
+
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import subprocess
+from time import mktime
+from datetime import datetime
+from datetime import timedelta
+from email.utils import formatdate
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+ONLINE = 0.01  # share of the population pinged in the last minutes
+
+
+def git_commit():
+    commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"])
+    commit = commit.decode("ascii").strip()
+    if subprocess.call(["git", "diff", "--quiet", "HEAD", "--", "dataserv"]):
+        commit += "-dirty"
+    return commit
+
+
+def measure(func, args, limit, seconds, prepare=None):
+    """
+    Call func(arg) for up to limit args or seconds, latencies in ms.
+    prepare(arg) runs untimed before every call and returns its arg.
+
+    """
+    latencies = []
+    deadline = time.time() + seconds
+    for arg in args[:limit]:
+        if prepare is not None:
+            arg = prepare(arg)
+        begin = time.time()
+        func(arg)
+        latencies.append((time.time() - begin) * 1000)
+        if time.time() > deadline:
+            break
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        "calls": len(latencies),
+        "mean_ms": total / len(latencies),
+        "median_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[int(len(latencies) * 0.95)],
+        "ops_per_sec": len(latencies) / (total / 1000) if total else 0.0,
+    }
+
+
+def signed_headers(btctxstore, wif, address):
+    header_date = formatdate(timeval=mktime(datetime.now().timetuple()),
+                             localtime=True, usegmt=True)
+    message = address + " " + header_date
+    return {"Date": header_date,
+            "Authorization": btctxstore.sign_unicode(wif, message)}
+
+
+def run_size(size, calls, seconds):
+    from btctxstore import BtcTxStore
+    from dataserv.app import app, db
+    from dataserv.Farmer import Farmer, is_btc_address
+    from dataserv.population import populate_database, random_address
+
+    db.drop_all()
+    db.create_all()
+    begin = time.time()
+    addresses = populate_database(size, online=ONLINE)
+    print("seeded {0} farmers in {1:.1f}s".format(size, time.time() - begin))
+    random.shuffle(addresses)
+    client = app.test_client()
+
+    def get(url):
+        rv = client.get(url)
+        assert rv.status_code == 200, (url, rv.status_code)
+
+    # every accepted ping or height update needs a farmer not seen lately
+    old = iter(db.session.query(Farmer.btc_addr).filter(
+        Farmer.last_seen < datetime.utcnow() - timedelta(hours=1)).limit(
+        calls * 2))
+    accepted = [row[0] for row in old]
+    throttled = addresses[0]
+    get("/api/ping/{0}".format(throttled))
+
+    btctxstore = BtcTxStore()
+    wif = btctxstore.create_key()
+    farmer = Farmer(btctxstore.get_address(wif))
+    signed = []  # (signed at, headers)
+
+    def fresh_headers(_):
+        # the earlier cases or a long case outlast AUTHENTICATION_TIMEOUT
+        max_age = app.config["AUTHENTICATION_TIMEOUT"] / 2.0
+        if not signed or time.time() - signed[0][0] > max_age:
+            signed[:] = [(time.time(), signed_headers(
+                btctxstore, wif, app.config["ADDRESS"]))]
+        return signed[0][1]
+    prepare = {"authenticate": fresh_headers}
+
+    cases = [
+        ("register", lambda a: get("/api/register/{0}".format(a)),
+         [random_address() for _ in range(calls)]),
+        ("ping_throttled", lambda a: get("/api/ping/{0}".format(a)),
+         [throttled] * calls),
+        ("ping_accepted", lambda a: get("/api/ping/{0}".format(a)),
+         accepted[:calls]),
+        ("set_height", lambda a: get("/api/height/{0}/10".format(a)),
+         accepted[calls:]),
+        ("online", lambda _: get("/api/online"), [None] * calls),
+        ("online_json", lambda _: get("/api/online/json"), [None] * calls),
+        ("total", lambda _: get("/api/total"), [None] * calls),
+        ("authenticate", farmer.authenticate, [None] * calls),
+        ("is_btc_address", is_btc_address, addresses[:calls]),
+    ]
+    results = {}
+    for name, func, args in cases:
+        app.config["SKIP_AUTHENTICATION"] = name != "authenticate"
+        results[name] = measure(func, args, calls, seconds,
+                                prepare.get(name))
+        print("  {0:16} {1[ops_per_sec]:10.1f} ops/s {1[median_ms]:8.3f} ms "
+              "median {1[p95_ms]:8.3f} ms p95".format(name, results[name]))
+    return results
+
+
+def run(sizes, calls, seconds):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    from dataserv.app import app
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    app.config["DISABLE_CACHING"] = True  # measure the work, not the cache
+    app.config["REPLAY_PROTECTION"] = False  # the same headers are reused
+    app.config["SKIP_AUTHENTICATION"] = True  # but for the authenticate case
+    report = {
+        "commit": git_commit(),
+        "date": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "sizes": {},
+    }
+    for size in sizes:
+        report["sizes"][str(size)] = run_size(size, calls, seconds)
+    os.remove(path)
+    if not os.path.isdir(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+    out = os.path.join(RESULTS_DIR, report["commit"] + ".json")
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("saved " + out)
+
+
+def load(commit):
+    if commit == "HEAD":
+        commit = git_commit()
+    with open(os.path.join(RESULTS_DIR, commit + ".json")) as f:
+        return json.load(f)
+
+
+def compare(base, head):
+    """Print the ops/s change of every case from base to head."""
+    base, head = load(base), load(head)
+    print("{0:>8} {1:16} {2:>12} {3:>12} {4:>8}".format(
+        "size", "case", base["commit"], head["commit"], "change"))
+    for size in sorted(set(base["sizes"]) & set(head["sizes"]), key=int):
+        for name in sorted(head["sizes"][size]):
+            if name not in base["sizes"][size]:
+                continue
+            old = base["sizes"][size][name]["ops_per_sec"]
+            new = head["sizes"][size][name]["ops_per_sec"]
+            change = (new - old) / old * 100 if old else 0.0
+            print("{0:>8} {1:16} {2:12.1f} {3:12.1f} {4:+7.1f}%".format(
+                size, name, old, new, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--sizes", default="1000,100000,1000000",
+                        help="comma separated population sizes")
+    parser.add_argument("--calls", type=int, default=200,
+                        help="most calls per case")
+    parser.add_argument("--seconds", type=float, default=10.0,
+                        help="most seconds per case")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"),
+                        help="compare two saved results instead")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    run([int(size) for size in args.sizes.split(",")], args.calls,
+        args.seconds)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,53 @@
 import json
+import time
 import hashlib
-import storjcore
+from collections import namedtuple
 from datetime import datetime
 from datetime import timedelta
 from sqlalchemy import DateTime
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
 from dataserv.run import db, app
-from btctxstore import BtcTxStore
+from dataserv.sharding import get_shards
+from dataserv.replay import get_guard, request_target
+from dataserv.metrics import observe_signature
+from dataserv.walmode import get_writer
+from dataserv.epochtime import EpochDateTime
 
 
 from dataserv.config import logging
 logger = logging.getLogger(__name__)
-is_btc_address = BtcTxStore().validate_address
+# column type of the farmer times, the models see datetimes either way
+Timestamp = EpochDateTime if app.config["EPOCH_TIMES"] else DateTime
+
+
+# callables run as callback(event, record, previous) after a farmer change
+# is committed, event is "register", "ping" or "height" and record and
+# previous are FarmerRecord copies of the row after and before the change
+_observers = []
+
+
+# storjcore and btctxstore take longer to import than the rest of the app,
+# they are imported on first use (or before forking, see dataserv.wsgi)
+_btctxstore = []
+
+
+def get_btctxstore():
+    """The BtcTxStore shared by the requests of this process."""
+    if not _btctxstore:
+        from btctxstore import BtcTxStore
+        _btctxstore.append(BtcTxStore())
+    return _btctxstore[0]
+
+
+def is_btc_address(address):
+    return get_btctxstore().validate_address(address)
+
+
+def auth_error():
+    """storjcore's AuthError, for except clauses."""
+    import storjcore.auth
+    return storjcore.auth.AuthError
 
 
 def sha256(content):
@@ -19,17 +56,103 @@ def sha256(content):
     return hashlib.sha256(content).hexdigest()
 
 
-class Farmer(db.Model):
+def observe(callback):
+    """Register a callback for committed farmer changes."""
+    if callback not in _observers:
+        _observers.append(callback)
+
+
+def notify(event, record, previous=None):
+    for callback in _observers:
+        callback(event, record, previous)
+
+
+def calculate_uptime(reg_time, last_seen, uptime):
+    """Calculate uptime percentage from the registration date."""
+    # save datetime.utcnow() to avoid a difference
+    utcnow = datetime.utcnow()
+    # time delta from registration and ping
+    delta_reg = utcnow - reg_time
+    delta_ping = utcnow - last_seen
+
+    # in case registration happened a short bit ago
+    if delta_reg < timedelta(seconds=1):
+        return 100
+
+    if delta_ping <= timedelta(minutes=app.config["ONLINE_TIME"]):
+        farmer_uptime = uptime + delta_ping.seconds
+    else:
+        farmer_uptime = uptime + timedelta(minutes=app.config["ONLINE_TIME"]).seconds
+    uptime = round(timedelta(seconds=farmer_uptime).total_seconds() / delta_reg.total_seconds(), 3)
+    # clip if we completed the audit recently (which sends us over 100%)
+    uptime *= 100  # covert from decimal to percentage
+
+    return round(uptime, 3)
+
+
+def ping_values(ping_time, last_seen, uptime):
+    """
+    Column values of an accepted ping, None if the farmer pinged less
+    than MAX_PING seconds ago.
+
+    """
+    # find time delta since we last pinged
+    delta_ping = ping_time - last_seen
+
+    # if we are above the time limit, update last seen
+    if delta_ping < timedelta(seconds=app.config["MAX_PING"]):
+        return None
+    values = {"last_seen": ping_time}
+    # if the farmer has been online in the last ONLINE_TIME seconds
+    # then we can update their uptime statistic
+    if delta_ping <= timedelta(minutes=app.config["ONLINE_TIME"]):
+        values["uptime"] = uptime + delta_ping.seconds
+    else:
+        values["uptime"] = uptime + timedelta(minutes=app.config["ONLINE_TIME"]).seconds
+    return values
+
+
+class FarmerPayload(object):
+    """JSON payload shared by farmer rows and their detached copies."""
+
+    def to_dict(self):
+        """Object to plain dict payload."""
+        return {
+            "btc_addr": self.btc_addr,
+            "payout_addr": self.payout_addr,
+            "last_seen": (datetime.utcnow() - self.last_seen).seconds,
+            "height": self.height,
+            "uptime": self.calculate_uptime()
+        }
+
+    def to_json(self):
+        """Object to JSON payload."""
+        return json.dumps(self.to_dict())
+
+
+class FarmerRecord(FarmerPayload, namedtuple("FarmerRecord", [
+        "id", "btc_addr", "payout_addr", "height",
+        "last_seen", "reg_time", "uptime"])):
+    """Read only copy of a farmer row, safe to keep outside a session."""
+    __slots__ = ()
+
+    def calculate_uptime(self):
+        return calculate_uptime(self.reg_time, self.last_seen, self.uptime)
+
+
+class Farmer(FarmerPayload, db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
     btc_addr = db.Column(db.String(35), unique=True)
     payout_addr = db.Column(db.String(35))
     height = db.Column(db.Integer, default=0)
 
-    last_seen = db.Column(DateTime, index=True, default=datetime.utcnow)
-    reg_time = db.Column(DateTime, default=datetime.utcnow)
+    last_seen = db.Column(Timestamp, index=True, default=datetime.utcnow)
+    reg_time = db.Column(Timestamp, default=datetime.utcnow)
     uptime = db.Column(db.Integer, default=0)
 
+    _archived_id = None  # archived row moved back with the next write
+
     def __init__(self, btc_addr, last_seen=None):
         """
         A farmer is a un-trusted client that provides some disk space
@@ -47,6 +170,83 @@ class Farmer(db.Model):
     def __repr__(self):
         return '<Farmer BTC Address: %r>' % self.btc_addr
 
+    def record(self):
+        """Detached FarmerRecord copy of this farmer."""
+        return FarmerRecord(self.id, self.btc_addr, self.payout_addr,
+                            self.height, self.last_seen, self.reg_time,
+                            self.uptime)
+
+    def column_values(self):
+        """{column: value} of the columns set."""
+        values = {}
+        for column in Farmer.__table__.columns:
+            value = getattr(self, column.name)
+            if value is not None:
+                values[column.name] = value
+        return values
+
+    def insert(self, writer, before=None):
+        """Insert this farmer with the writer, after before(connection)."""
+        table = Farmer.__table__
+        values = self.column_values()
+
+        def insert(connection):
+            if before is not None:
+                before(connection)
+            result = connection.execute(table.insert().values(**values))
+            row = dict(result.last_inserted_params())
+            row["id"] = result.inserted_primary_key[0]
+            return row
+
+        for name, value in writer.submit(insert).items():
+            setattr(self, name, value)
+
+    def write(self, farmer, values):
+        """
+        Set and commit column values of a farmer from lookup. Returns a
+        FarmerRecord of the changed row if there are observers.
+
+        """
+        writer = get_writer()
+        if writer is None:
+            for name, value in values.items():
+                setattr(farmer, name, value)
+            # copied before the commit expires the attributes
+            record = farmer.record() if _observers else None
+            self.session_for(self.btc_addr).commit()
+            return record
+        if farmer._archived_id is not None:
+            self.write_revived(writer, farmer, values)
+            return farmer.record() if _observers else None
+        table = Farmer.__table__
+        farmer_id = farmer.id
+        writer.submit(lambda connection: connection.execute(
+            table.update().where(table.c.id == farmer_id).values(**values)))
+        for name, value in values.items():  # without making it dirty
+            set_committed_value(farmer, name, value)
+        return farmer.record() if _observers else None
+
+    def write_revived(self, writer, farmer, values):
+        """Insert a farmer from revive and delete the archived row."""
+        for name, value in values.items():
+            setattr(farmer, name, value)
+        table = FarmerArchive.__table__
+        archived_id = farmer._archived_id
+        farmer.insert(writer, lambda connection: connection.execute(
+            table.delete().where(table.c.id == archived_id)))
+        farmer._archived_id = None
+        make_transient_to_detached(farmer)
+        self.session_for(self.btc_addr).add(farmer)
+        logger.info("Revived archived farmer %s", self.btc_addr)
+
+    @staticmethod
+    def session_for(btc_addr):
+        """Database session holding the farmer with this address."""
+        shards = get_shards()
+        if shards is None:
+            return db.session
+        return shards.session_for(btc_addr)
+
     @staticmethod
     def get_server_address():
         return app.config["ADDRESS"]
@@ -58,18 +258,36 @@ class Farmer(db.Model):
     def authenticate(self, headers):
         if app.config["SKIP_AUTHENTICATION"]:
             return True
+        import storjcore.auth
 
         if not headers.get("Authorization"):
             raise storjcore.auth.AuthError("Authorization header required!")
         if not headers.get("Date"):
             raise storjcore.auth.AuthError("Date header required!")
 
-        btctxstore = BtcTxStore()
+        # reject replayed headers before the expensive signature check
+        guard = get_guard()
+        sender_address = self.btc_addr
+        target = request_target()
+        if guard is not None and guard.seen(sender_address, headers,
+                                            time.time(), target):
+            raise storjcore.auth.AuthError("Authorization header replayed!")
+
+        btctxstore = get_btctxstore()
         timeout = self.get_server_authentication_timeout()
         recipient_address = self.get_server_address()
-        sender_address = self.btc_addr
-        return storjcore.auth.verify_headers(btctxstore, headers, timeout,
-                                             sender_address, recipient_address)
+        begin = time.time()
+        try:
+            storjcore.auth.verify_headers(btctxstore, headers, timeout,
+                                          sender_address, recipient_address)
+        except storjcore.auth.AuthError:
+            observe_signature(time.time() - begin, False)
+            raise
+        observe_signature(time.time() - begin, True)
+        if guard is not None and not guard.add(sender_address, headers,
+                                               time.time(), target):
+            raise storjcore.auth.AuthError("Authorization header replayed!")
+        return True
 
     def validate(self, registering=False):
         """Make sure this farmer fits the rules for this node."""
@@ -87,17 +305,63 @@ class Farmer(db.Model):
         """Add the farmer to the database."""
         self.payout_addr = payout_addr if payout_addr else self.btc_addr
         self.validate(registering=True)
-        db.session.add(self)
-        db.session.commit()
+        writer = get_writer()
+        if writer is not None:
+            self.insert(writer)
+        else:
+            session = self.session_for(self.btc_addr)
+            session.add(self)
+            session.commit()
+        if _observers:
+            notify("register", self.record())
 
     def exists(self):
         """Check to see if this address is already listed."""
-        return Farmer.query.filter(Farmer.btc_addr ==
-                                   self.btc_addr).count() > 0
+        session = self.session_for(self.btc_addr)
+        if session.query(Farmer).filter(Farmer.btc_addr ==
+                                        self.btc_addr).count() > 0:
+            return True
+        return session.query(FarmerArchive).filter(
+            FarmerArchive.btc_addr == self.btc_addr).count() > 0
+
+    def revive(self, session):
+        """
+        Move the archived farmer with this address back to the farmer
+        table, uncommitted so that a failed authentication undoes it.
+        With the writer the move is queued with the first write of the
+        farmer instead, in the same transaction.
+
+        """
+        archived = session.query(FarmerArchive).filter_by(
+            btc_addr=self.btc_addr).first()
+        if archived is None:
+            return None
+        farmer = Farmer(archived.btc_addr, archived.last_seen)
+        farmer.payout_addr = archived.payout_addr
+        farmer.height = archived.height
+        farmer.reg_time = archived.reg_time
+        farmer.uptime = archived.uptime
+        if session.query(Farmer.id).filter_by(id=archived.id).first():
+            logger.warning("Id %s of archived farmer %s was reused",
+                           archived.id, self.btc_addr)
+        else:
+            farmer.id = archived.id
+        if get_writer() is not None:
+            session.expunge(archived)
+            farmer._archived_id = archived.id
+            return farmer
+        session.delete(archived)
+        session.add(farmer)
+        session.flush()
+        logger.info("Revived archived farmer %s", self.btc_addr)
+        return farmer
 
     def lookup(self):
         """Return the Farmer object for the bitcoin address passed."""
-        farmer = Farmer.query.filter_by(btc_addr=self.btc_addr).first()
+        session = self.session_for(self.btc_addr)
+        farmer = session.query(Farmer).filter_by(btc_addr=self.btc_addr).first()
+        if not farmer:
+            farmer = self.revive(session)
         if not farmer:
             msg = "Address not registered: {0}".format(self.btc_addr)
             logger.warning(msg)
@@ -114,22 +378,15 @@ class Farmer(db.Model):
 
         # make sure the farmer is valid
         farmer = self.lookup()
-        # find time delta since we last pinged
-        delta_ping = ping_time - farmer.last_seen
-
-        # if we are above the time limit, update last seen
-        if delta_ping >= timedelta(seconds=app.config["MAX_PING"]):
-            farmer.last_seen = ping_time
-            # if the farmer has been online in the last ONLINE_TIME seconds
-            # then we can update their uptime statistic
-            if delta_ping <= timedelta(minutes=app.config["ONLINE_TIME"]):
-                farmer.uptime += delta_ping.seconds
-            else:
-                farmer.uptime += timedelta(minutes=app.config["ONLINE_TIME"]).seconds
+        values = ping_values(ping_time, farmer.last_seen, farmer.uptime)
+        if values is not None:
+            previous = farmer.record() if _observers else None
             # call to the authentication module
             if before_commit_callback:
                 before_commit_callback()
-            db.session.commit()
+            record = self.write(farmer, values)
+            if _observers:
+                notify("ping", record, previous)
 
     # TODO: Actually do an audit.
     def audit(self):
@@ -143,42 +400,36 @@ class Farmer(db.Model):
     def set_height(self, height):
         """Set the farmers advertised height."""
         farmer = self.lookup()
-        farmer.height = height
+        previous = farmer.record() if _observers else None
+        self.write(farmer, {"height": height})
         self.ping() #better 2 db commits than implementing ping with update calculation again
-        db.session.commit()
+        record = farmer.record() if _observers else None
+        if _observers:
+            notify("height", record, previous)
         return self.height
 
     def calculate_uptime(self):
         """Calculate uptime from registration date."""
-        farmer = self.lookup()
-        
-        # save datetime.utcnow() to avoid a difference
-        utcnow = datetime.utcnow()
-        # time delta from registration and ping
-        delta_reg = utcnow - farmer.reg_time
-        delta_ping = utcnow - farmer.last_seen
-
-        # in case registration happened a short bit ago
-        if delta_reg < timedelta(seconds=1):
-            return 100
-
-        if delta_ping <= timedelta(minutes=app.config["ONLINE_TIME"]):
-            farmer_uptime = farmer.uptime + delta_ping.seconds
-        else:
-            farmer_uptime = farmer.uptime + timedelta(minutes=app.config["ONLINE_TIME"]).seconds
-        uptime = round(timedelta(seconds=farmer_uptime).total_seconds() / delta_reg.total_seconds(), 3)
-        # clip if we completed the audit recently (which sends us over 100%)
-        uptime *= 100  # covert from decimal to percentage
+        # rows loaded from the database need no second lookup
+        farmer = self if self.id is not None else self.lookup()
+        return calculate_uptime(farmer.reg_time, farmer.last_seen,
+                                farmer.uptime)
 
-        return round(uptime, 3)
 
-    def to_json(self):
-        """Object to JSON payload."""
-        payload = {
-            "btc_addr": self.btc_addr,
-            "payout_addr": self.payout_addr,
-            "last_seen": (datetime.utcnow() - self.last_seen).seconds,
-            "height": self.height,
-            "uptime": self.calculate_uptime()
-        }
-        return json.dumps(payload)
+class FarmerArchive(db.Model):
+    """Farmers offline for longer than ARCHIVE_AFTER days."""
+    __tablename__ = "farmer_archive"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    btc_addr = db.Column(db.String(35), unique=True)
+    payout_addr = db.Column(db.String(35))
+    height = db.Column(db.Integer, default=0)
+
+    last_seen = db.Column(Timestamp)
+    reg_time = db.Column(Timestamp)
+    uptime = db.Column(db.Integer, default=0)
+    archived = db.Column(Timestamp, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<FarmerArchive BTC Address: %r>' % self.btc_addr
@@ -0,0 +1,53 @@
+"""
+Requests of the node operator, signed like farmer requests but by the
+key of ADMIN_ADDRESS.
+
+"""
+import time
+from flask import has_request_context, request
+from dataserv.run import app
+from dataserv.replay import get_guard, request_target
+from dataserv.Farmer import get_btctxstore
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+def is_admin(headers):
+    """
+    True if the headers are signed by the configured admin address. The
+    answer is kept for the rest of the request, so a second check, for
+    example by the profiler and then the route, is no replay.
+
+    """
+    if not has_request_context():
+        return check_admin(headers)
+    if "dataserv.admin" not in request.environ:
+        request.environ["dataserv.admin"] = check_admin(headers)
+    return request.environ["dataserv.admin"]
+
+
+def check_admin(headers):
+    admin_address = app.config["ADMIN_ADDRESS"]
+    if not admin_address:
+        return False
+    if not headers.get("Authorization") or not headers.get("Date"):
+        return False
+    guard = get_guard()
+    target = request_target()
+    if guard is not None and guard.seen(admin_address, headers, time.time(),
+                                        target):
+        return False
+    import storjcore.auth
+    import storjcore.sanitize
+    try:
+        storjcore.auth.verify_headers(get_btctxstore(), headers,
+                                      app.config["AUTHENTICATION_TIMEOUT"],
+                                      admin_address, app.config["ADDRESS"])
+    except (storjcore.auth.AuthError, storjcore.sanitize.ValidationError):
+        msg = "Invalid admin authentication headers."
+        logger.warning(msg)
+        return False
+    return guard is None or guard.add(admin_address, headers, time.time(),
+                                      target)
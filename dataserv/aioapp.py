@@ -0,0 +1,506 @@
+"""
+Asyncio entry point serving the farmer and online routes with aiohttp,
+an alternative to the Flask app for many concurrent pings:
+
+    python -m dataserv.aioapp --port 5000
+    gunicorn dataserv.aioapp:create_app -k aiohttp.GunicornWebWorker
+
+`/api/register`, `/api/ping`, `/api/height`, `/api/online`,
+`/api/online/json` and `/api/total` answer with the same bodies and status
+codes as the Flask routes. The database is used through aiosqlite or
+asyncpg and the signatures are checked in ASYNC_VERIFY_PROCESSES worker
+processes, so a request waiting for either holds no thread. Writes queued
+while a sqlite transaction runs are committed together in the next one.
+
+The other routes, the event stream, the metrics and the time wheel or
+shared table stay with the Flask app, sharding is not supported. Needs
+Python 3.5+ and the `async` extra (async_requirements.txt).
+
+"""
+import copy
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+from datetime import datetime
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import aiosqlite
+import storjcore
+from aiohttp import web
+from btctxstore import BtcTxStore
+from sqlalchemy.dialects import postgresql, sqlite
+from dataserv.app import (app as flask_app, db, secs_to_mins, total_payload,
+                          query_online_records)
+from dataserv.Farmer import (Farmer, FarmerRecord, is_btc_address, notify,
+                             ping_values)
+from dataserv.events import get_hub
+from dataserv.replay import get_guard
+from dataserv.metrics import observe_signature
+from dataserv.serialize import FragmentCache
+try:  # optional, only for PostgreSQL
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+FIELDS = "id, btc_addr, payout_addr, height, last_seen, reg_time, uptime"
+INSERT = ("INSERT INTO farmer (btc_addr, payout_addr, height, last_seen, "
+          "reg_time, uptime) VALUES (?, ?, ?, ?, ?, ?)")
+REVIVE = ("INSERT INTO farmer (id, btc_addr, payout_addr, height, last_seen, "
+          "reg_time, uptime) VALUES (?, ?, ?, ?, ?, ?, ?)")
+
+
+def verify_signature(headers, timeout, sender, recipient):
+    """Check signed headers in an executor, (seconds, error or None)."""
+    begin = time.time()
+    try:
+        storjcore.auth.verify_headers(BtcTxStore(), headers, timeout, sender,
+                                      recipient)
+    except storjcore.auth.AuthError as e:
+        return time.time() - begin, str(e) or "Invalid signature!"
+    return time.time() - begin, None
+
+
+class Database(object):
+
+    def __init__(self, dialect):
+        """Farmer table of an async driver, times as the model stores them."""
+        column_type = Farmer.__table__.c.last_seen.type.dialect_impl(dialect)
+        self.bind = column_type.bind_processor(dialect) or (lambda v: v)
+        self.result = column_type.result_processor(dialect, None) or \
+            (lambda v: v)
+
+    def record(self, row):
+        (id, btc_addr, payout_addr, height, last_seen, reg_time,
+         uptime) = tuple(row)
+        return FarmerRecord(id, btc_addr, payout_addr, height,
+                            self.result(last_seen), self.result(reg_time),
+                            uptime)
+
+
+class SQLiteDatabase(Database):
+    integrity_errors = (sqlite3.IntegrityError,)
+
+    def __init__(self, path, pragmas):
+        """A reading and a writing aiosqlite connection to path."""
+        Database.__init__(self, sqlite.dialect())
+        self.path = path
+        self.pragmas = pragmas
+        self.pending = []  # (statements, future)
+        self.flushing = None
+        self.reader = self.writer = None
+
+    async def open(self):
+        self.reader = await aiosqlite.connect(self.path, isolation_level=None)
+        self.writer = await aiosqlite.connect(self.path, isolation_level=None)
+        for connection in (self.reader, self.writer):
+            for pragma in self.pragmas:
+                await connection.execute(pragma)
+
+    async def close(self):
+        if self.flushing is not None:
+            await self.flushing
+        await self.reader.close()
+        await self.writer.close()
+
+    async def fetch(self, sql, params=()):
+        async with self.reader.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    def write(self, statements):
+        """Commit [(sql, params)] in one transaction, a future of the last
+        inserted row id."""
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((statements, future))
+        if self.flushing is None or self.flushing.done():
+            self.flushing = asyncio.ensure_future(self.flush())
+        return future
+
+    async def flush(self):
+        # whatever is queued during a commit goes into the next one
+        while self.pending:
+            batch, self.pending = self.pending, []
+            await self.commit(batch)
+
+    async def commit(self, batch):
+        """Commit the batch, each alone if one of them fails."""
+        try:
+            await self.writer.execute("BEGIN IMMEDIATE")
+            row_ids = []
+            try:
+                for statements, _ in batch:
+                    row_id = None
+                    for sql, params in statements:
+                        cursor = await self.writer.execute(sql, params)
+                        row_id = cursor.lastrowid
+                    row_ids.append(row_id)
+            except Exception:
+                await self.writer.execute("ROLLBACK")
+                raise
+            await self.writer.execute("COMMIT")
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    await self.commit([item])
+                return
+            if not batch[0][1].done():
+                batch[0][1].set_exception(e)
+            return
+        for (_, future), row_id in zip(batch, row_ids):
+            if not future.done():  # the client may have gone
+                future.set_result(row_id)
+
+
+class PostgresDatabase(Database):
+
+    def __init__(self, dsn):
+        """An asyncpg connection pool to dsn."""
+        Database.__init__(self, postgresql.dialect())
+        self.integrity_errors = (asyncpg.IntegrityConstraintViolationError,)
+        self.dsn = dsn
+        self.pool = None
+        self.numbered = {}  # sql with ? placeholders: sql with $n ones
+
+    def number(self, sql):
+        if sql not in self.numbered:
+            parts = sql.split("?")
+            self.numbered[sql] = parts[0] + "".join(
+                "${0}{1}".format(i, part)
+                for i, part in enumerate(parts[1:], 1))
+        return self.numbered[sql]
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(self.dsn)
+
+    async def close(self):
+        await self.pool.close()
+
+    async def fetch(self, sql, params=()):
+        async with self.pool.acquire() as connection:
+            return await connection.fetch(self.number(sql), *params)
+
+    async def write(self, statements):
+        """Commit [(sql, params)] in one transaction, the last inserted id."""
+        row_id = None
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                for sql, params in statements:
+                    if sql.startswith("INSERT"):
+                        row_id = await connection.fetchval(
+                            self.number(sql) + " RETURNING id", *params)
+                    else:
+                        await connection.execute(self.number(sql), *params)
+        return row_id
+
+
+def open_database(config):
+    """The async Database of the configured SQLALCHEMY_DATABASE_URI."""
+    if config["SHARD_DATABASE_URIS"]:
+        raise ValueError("The asyncio app does not support sharding")
+    url = copy.copy(db.engine.url)  # with the sqlite path made absolute
+    if url.drivername.startswith("sqlite"):
+        pragmas = ["PRAGMA busy_timeout=5000"]
+        if config["SQLITE_WAL"]:
+            pragmas.append("PRAGMA journal_mode=WAL")
+            pragmas.extend("PRAGMA {0}={1}".format(name, value) for name, value
+                           in sorted(config["SQLITE_PRAGMAS"].items()))
+        return SQLiteDatabase(url.database, pragmas)
+    if url.drivername.startswith("postgresql") and asyncpg is not None:
+        url.drivername = "postgresql"
+        return PostgresDatabase(str(url))
+    raise ValueError("No async driver for {0}".format(url.drivername))
+
+
+def text_response(body, status=200):
+    return web.Response(text=body, status=status, content_type="text/html")
+
+
+def json_response(body):
+    response = web.Response(text=body, content_type="application/json")
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+def failure(msg, status, error_msg="{0}"):
+    logger.warning(msg)
+    return text_response(error_msg.format(msg), status)
+
+
+class Service(object):
+
+    def __init__(self, config):
+        """The routes of the asyncio app, on the Flask app's config."""
+        self.config = config
+        self.database = open_database(config)
+        self.executor = None
+        self.fragments = FragmentCache()
+        self.cache = {}  # path: (expires, body)
+
+    async def start(self, application):
+        await self.database.open()
+        processes = self.config["ASYNC_VERIFY_PROCESSES"]
+        if processes == 0:
+            self.executor = ThreadPoolExecutor(1)
+        else:
+            self.executor = ProcessPoolExecutor(processes)
+
+    async def stop(self, application):
+        await self.database.close()
+        self.executor.shutdown()
+
+    # farmers
+
+    async def lookup(self, btc_addr):
+        """
+        (FarmerRecord, archived) of the address or (None, False). An
+        archived farmer is revived by the update of an accepted request.
+
+        """
+        for table in ("farmer", "farmer_archive"):
+            rows = await self.database.fetch(
+                "SELECT " + FIELDS + " FROM " + table + " WHERE btc_addr = ?",
+                (btc_addr,))
+            if rows:
+                return self.database.record(rows[0]), table != "farmer"
+        return None, False
+
+    async def revive(self, record):
+        """Move an archived farmer back with the values of record."""
+        bind = self.database.bind
+        values = (record.btc_addr, record.payout_addr, record.height,
+                  bind(record.last_seen), bind(record.reg_time),
+                  record.uptime)
+        if await self.database.fetch("SELECT 1 FROM farmer WHERE id = ?",
+                                     (record.id,)):
+            logger.warning("Id %s of archived farmer %s was reused",
+                           record.id, record.btc_addr)
+            insert = (INSERT, values)
+        else:
+            insert = (REVIVE, (record.id,) + values)
+        row_id = await self.database.write([
+            ("DELETE FROM farmer_archive WHERE id = ?", (record.id,)),
+            insert])
+        logger.info("Revived archived farmer %s", record.btc_addr)
+        return record._replace(id=row_id)
+
+    async def exists(self, btc_addr):
+        rows = await self.database.fetch(
+            "SELECT 1 FROM farmer WHERE btc_addr = ? UNION ALL "
+            "SELECT 1 FROM farmer_archive WHERE btc_addr = ?",
+            (btc_addr, btc_addr))
+        return bool(rows)
+
+    async def update(self, record, values, archived=False):
+        """Commit column values of a farmer, return the new record."""
+        if archived:  # in the same transaction as the revive
+            return await self.revive(record._replace(**values))
+        names = sorted(values)
+        params = [self.database.bind(values[name])
+                  if name == "last_seen" else values[name] for name in names]
+        sql = "UPDATE farmer SET {0} WHERE id = ?".format(
+            ", ".join(name + " = ?" for name in names))
+        await self.database.write([(sql, tuple(params) + (record.id,))])
+        return record._replace(**values)
+
+    async def authenticate(self, btc_addr, request):
+        """The checks of Farmer.authenticate, the signature in the executor."""
+        if self.config["SKIP_AUTHENTICATION"]:
+            return
+        headers = dict((name, request.headers[name])
+                       for name in ("Authorization", "Date")
+                       if name in request.headers)
+        if not headers.get("Authorization"):
+            raise storjcore.auth.AuthError("Authorization header required!")
+        if not headers.get("Date"):
+            raise storjcore.auth.AuthError("Date header required!")
+        guard = get_guard()
+        target = "{0} {1}".format(request.method, request.path)
+        if guard is not None and guard.seen(btc_addr, headers, time.time(),
+                                            target):
+            raise storjcore.auth.AuthError("Authorization header replayed!")
+        seconds, error = await asyncio.get_event_loop().run_in_executor(
+            self.executor, verify_signature, headers,
+            self.config["AUTHENTICATION_TIMEOUT"], btc_addr,
+            self.config["ADDRESS"])
+        observe_signature(seconds, error is None)
+        if error is not None:
+            raise storjcore.auth.AuthError(error)
+        if guard is not None and not guard.add(btc_addr, headers,
+                                               time.time(), target):
+            raise storjcore.auth.AuthError("Authorization header replayed!")
+
+    # online farmers
+
+    async def online_rows(self):
+        cutoff = datetime.utcnow() - timedelta(
+            minutes=self.config["ONLINE_TIME"])
+        return await self.database.fetch(
+            "SELECT " + FIELDS + " FROM farmer WHERE last_seen > ? "
+            "ORDER BY height DESC, id", (self.database.bind(cutoff),))
+
+    async def online_records(self):
+        return [self.database.record(row) for row in await self.online_rows()]
+
+    async def cached(self, request, build):
+        """Body of build() kept for CACHING_TIME like the Flask routes."""
+        if self.config["DISABLE_CACHING"]:
+            return await build()
+        now = time.time()
+        entry = self.cache.get(request.path)
+        if entry is None or entry[0] <= now:
+            entry = now + self.config["CACHING_TIME"], await build()
+            self.cache[request.path] = entry
+        return entry[1]
+
+    def delta(self, since):
+        with flask_app.app_context():
+            return get_hub(query_online_records).delta(since)
+
+    # routes
+
+    async def register(self, request):
+        btc_addr = request.match_info["btc_addr"]
+        payout_addr = request.match_info.get("payout_addr", btc_addr)
+        logger.info("CALLED /api/register/%s/%s", btc_addr, payout_addr)
+        error_msg = "Registration Failed: {0}"
+        if not is_btc_address(btc_addr):
+            return failure("Invalid Bitcoin address.", 400, error_msg)
+        try:
+            await self.authenticate(btc_addr, request)
+        except storjcore.auth.AuthError:
+            return failure("Invalid authentication headers.", 401, error_msg)
+        if not is_btc_address(payout_addr):
+            return failure("Invalid Bitcoin address.", 400, error_msg)
+        if await self.exists(btc_addr):
+            return failure("Address already is registered.", 409, error_msg)
+        now = datetime.utcnow()
+        stamp = self.database.bind(now)
+        try:
+            row_id = await self.database.write([
+                (INSERT, (btc_addr, payout_addr, 0, stamp, stamp, 0))])
+        except self.database.integrity_errors:
+            return failure("Address already is registered.", 409, error_msg)
+        record = FarmerRecord(row_id, btc_addr, payout_addr, 0, now, now, 0)
+        notify("register", record)
+        return text_response(record.to_json())
+
+    async def ping(self, request):
+        btc_addr = request.match_info["btc_addr"]
+        logger.info("CALLED /api/ping/%s", btc_addr)
+        error_msg = "Ping Failed: {0}"
+        if not is_btc_address(btc_addr):
+            return failure("Invalid Bitcoin address.", 400, error_msg)
+        record, archived = await self.lookup(btc_addr)
+        if record is None:
+            return failure("Farmer not found.", 404, error_msg)
+        values = ping_values(datetime.utcnow(), record.last_seen,
+                             record.uptime)
+        if values is not None:
+            try:  # lazy authentication, only for accepted pings
+                await self.authenticate(btc_addr, request)
+            except storjcore.auth.AuthError:
+                return failure("Invalid authentication headers.", 401,
+                               error_msg)
+            notify("ping", await self.update(record, values, archived),
+                   record)
+        return text_response("Ping accepted.")
+
+    async def set_height(self, request):
+        btc_addr = request.match_info["btc_addr"]
+        height = int(request.match_info["height"])
+        logger.info("CALLED /api/height/%s/%s", btc_addr, height)
+        if not is_btc_address(btc_addr):
+            return failure("Invalid Bitcoin address.", 400)
+        try:
+            await self.authenticate(btc_addr, request)
+        except storjcore.auth.AuthError:
+            return failure("Invalid authentication headers.", 401,
+                           "Set height failed: {0}")
+        if height > self.config["HEIGHT_LIMIT"]:
+            return failure("Height limit exceeded.", 413)
+        record, archived = await self.lookup(btc_addr)
+        if record is None:
+            return failure("Farmer not found.", 404)
+        values = ping_values(datetime.utcnow(), record.last_seen,
+                             record.uptime) or {}
+        pinged = bool(values)
+        values["height"] = height
+        updated = await self.update(record, values, archived)
+        if pinged:
+            notify("ping", updated, record)
+        notify("height", updated, record)
+        return text_response("Height accepted.")
+
+    async def online(self, request):
+        logger.info("CALLED /api/online")
+
+        async def build():
+            now = datetime.utcnow()
+            line = "{0} |  Last Seen: {1} | Height: {2}<br/>"
+            return "".join(line.format(
+                farmer.payout_addr,
+                secs_to_mins((now - farmer.last_seen).seconds), farmer.height)
+                for farmer in await self.online_records())
+
+        return text_response(await self.cached(request, build))
+
+    async def online_json(self, request):
+        logger.info("CALLED /api/online/json")
+        if "since" in request.query:
+            # the changes since a version token, from the in memory hub
+            delta = await asyncio.get_event_loop().run_in_executor(
+                None, self.delta, request.query["since"])
+            return json_response(json.dumps(delta, indent=2, sort_keys=True))
+
+        async def build():
+            if self.config["EPOCH_TIMES"]:
+                return self.fragments.render_rows(
+                    await self.online_rows(), int(time.time()))
+            return self.fragments.render(await self.online_records())
+
+        return json_response(await self.cached(request, build))
+
+    async def total(self, request):
+        logger.info("CALLED /api/total")
+
+        async def build():
+            payload = total_payload(await self.online_records())
+            return json.dumps(payload, indent=2, sort_keys=True)
+
+        return json_response(await self.cached(request, build))
+
+
+def create_app():
+    """The aiohttp application, also a gunicorn app factory."""
+    service = Service(flask_app.config)
+    application = web.Application()
+    application["service"] = service
+    application.on_startup.append(service.start)
+    application.on_cleanup.append(service.stop)
+    router = application.router
+    router.add_get("/api/register/{btc_addr}", service.register)
+    router.add_get("/api/register/{btc_addr}/{payout_addr}", service.register)
+    router.add_get("/api/ping/{btc_addr}", service.ping)
+    router.add_get("/api/height/{btc_addr}/{height:\\d+}", service.set_height)
+    router.add_get("/api/online", service.online)
+    router.add_get("/api/online/json", service.online_json)
+    router.add_get("/api/total", service.total)
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
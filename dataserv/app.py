@@ -3,16 +3,32 @@ from __future__ import division
 
 
 import sys
-import json
+import time
 import os.path
 import datetime
-import storjcore
-from flask import make_response, jsonify, request
+from functools import wraps
+from flask import Response, make_response, jsonify, request
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from sqlalchemy import desc
-from dataserv.run import app, db, cache, manager
-from dataserv.Farmer import Farmer
+from sqlalchemy import desc, select, type_coerce, Integer
+from dataserv.run import app, db, cache
+from dataserv.Farmer import Farmer, auth_error
+from dataserv.sharding import get_shards
+from dataserv.timewheel import get_wheel
+from dataserv.serialize import online_fragments
+from dataserv.sharedtable import get_table
+from dataserv.events import get_hub, stream
+from dataserv.archive import start_archiver
+from dataserv.history import (parse_period, query_history,
+                              start_history)
+from dataserv.heightlog import install_height_log
+from dataserv.breaker import (breaker, fail_fast, install_breaker,
+                              serve_stale, shed_ping)
+from dataserv.bloom import may_be_registered, start_bloom_filter
+from dataserv.metrics import instrument, exposition
+from dataserv.profiler import profile_requests
+from dataserv.slowlog import record_slow_queries, slow_queries
+from dataserv.admin import is_admin
 from dataserv.config import logging
 
 
@@ -30,6 +46,39 @@ def secs_to_mins(seconds):
 
 
 def online_farmers():
+    # served from the table shared by all workers if configured
+    table = shared_table()
+    if table is not None:
+        records = table.read()
+        if records is not None:
+            online_time = datetime.timedelta(minutes=app.config["ONLINE_TIME"])
+            time_ago = datetime.datetime.utcnow() - online_time
+            return [r for r in records if r.last_seen > time_ago]
+
+    # served from memory if the time wheel is enabled
+    wheel = get_wheel(query_online_records)
+    if wheel is not None:
+        return wheel.online()
+    return query_online_farmers()
+
+
+def shared_table():
+    """The shared online table refreshed if stale, None if disabled."""
+    path = app.config["SHARED_TABLE_PATH"]
+    if not path:
+        return None
+    table = get_table(path, app.config["SHARED_TABLE_CAPACITY"])
+    # wait for a refresh if the table was never written
+    table.refresh(query_online_records, app.config["SHARED_TABLE_REFRESH"],
+                  block=table.header()[0] == 0)
+    return table
+
+
+def query_online_records(btc_addrs=None):
+    return [farmer.record() for farmer in query_online_farmers(btc_addrs)]
+
+
+def query_online_farmers(btc_addrs=None):
     # maximum number of minutes since the last check in for
     # the farmer to be considered an online farmer
     online_time = app.config["ONLINE_TIME"]
@@ -39,16 +88,115 @@ def online_farmers():
     time_ago = current_time - datetime.timedelta(minutes=online_time)
 
     # give us all farmers that have been around for the past online_time
-    q = db.session.query(Farmer)
-    q = q.filter(Farmer.last_seen > time_ago)
-    q = q.order_by(desc(Farmer.height), Farmer.id)
-    return q.all()
+    def query(session):
+        q = session.query(Farmer)
+        q = q.filter(Farmer.last_seen > time_ago)
+        if btc_addrs is not None:  # only these farmers
+            q = q.filter(Farmer.btc_addr.in_(btc_addrs))
+        q = q.order_by(desc(Farmer.height), Farmer.id)
+        return q.all()
+
+    shards = get_shards()
+    if shards is not None:
+        return shards.gather_sorted(query, lambda f: (-f.height, f.id))
+    return query(db.session)
+
+
+def query_online_rows():
+    """Online farmers as rows in FarmerRecord field order, epoch times."""
+    table = Farmer.__table__
+    # the stored integers, not converted to datetimes
+    last_seen = type_coerce(table.c.last_seen, Integer)
+    reg_time = type_coerce(table.c.reg_time, Integer)
+    cutoff = int(time.time()) - app.config["ONLINE_TIME"] * 60
+    query = select([table.c.id, table.c.btc_addr, table.c.payout_addr,
+                    table.c.height, last_seen, reg_time, table.c.uptime])
+    query = query.where(last_seen > cutoff)
+    query = query.order_by(desc(table.c.height), table.c.id)
+
+    def rows(session):
+        return session.execute(query).fetchall()
+
+    shards = get_shards()
+    if shards is not None:
+        return shards.gather_sorted(rows, lambda row: (-row[3], row[0]))
+    return rows(db.session)
+
+
+def online_json_body():
+    # with epoch times and no in memory online set the rows are rendered
+    # as read, with integer math instead of a datetime per farmer
+    if app.config["EPOCH_TIMES"] and not app.config["SHARED_TABLE_PATH"] \
+            and get_wheel(query_online_records) is None:
+        return online_fragments.render_rows(query_online_rows(),
+                                            int(time.time()))
+    return online_fragments.render(online_farmers())
+
+
+def total_payload(all_farmers):
+    # Add up number of shards
+    total_shards = sum([farmer.height for farmer in all_farmers])
+    total_farmers = len(all_farmers)
+
+    # BYTE_SIZE / 1 TB
+    total_size = (total_shards * (app.config["BYTE_SIZE"] / (1024 ** 4)))
+
+    # Increment by 1 every TOTAL_UPDATE minutes
+    epoch = datetime.datetime(1970, 1, 1)
+    epoch_mins = (datetime.datetime.utcnow() - epoch).total_seconds()/60
+    id_val = epoch_mins / app.config["TOTAL_UPDATE"]
+
+    json_data = {'id': int(id_val),
+                 'total_TB': round(total_size, 2),
+                 'total_farmers': total_farmers}
+    return json_data
+
+
+def federation():
+    if not app.config["PEER_NODES"]:
+        return None
+    # imported here, the aggregator needs Python 3.5+ for asyncio
+    from dataserv.federation import get_federation
+    return get_federation(app.config["PEER_NODES"],
+                          app.config["PEER_TIMEOUT"],
+                          app.config["PEER_MAX_AGE"])
 
 
 def disable_caching():
     return app.config["DISABLE_CACHING"]
 
 
+def disable_caching_for_delta():
+    # the cache key ignores the query string
+    return disable_caching() or "since" in request.args
+
+
+def read_only(view):
+    """Serve the view from the read replica if one is configured."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with db.replica():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+@app.before_first_request
+def warm_start():
+    # load the time wheel before serving the first request
+    get_wheel(query_online_records)
+    start_archiver()
+    start_history()
+    start_bloom_filter()
+
+
+if app.config["METRICS"]:
+    instrument(app, cache)
+profile_requests(app)
+record_slow_queries(app)
+install_height_log()
+install_breaker()
+
+
 # Routes
 @app.route('/')
 def index():
@@ -57,13 +205,14 @@ def index():
 
 @app.route('/api/register/<btc_addr>', methods=["GET"])
 def register(btc_addr):
-    logger.info("CALLED /api/register/{0}".format(btc_addr))
+    logger.info("CALLED /api/register/%s", btc_addr)
     return register_with_payout(btc_addr, btc_addr)
 
 
 @app.route('/api/register/<btc_addr>/<payout_addr>', methods=["GET"])
+@fail_fast
 def register_with_payout(btc_addr, payout_addr):
-    logger.info("CALLED /api/register/{0}/{1}".format(btc_addr, payout_addr))
+    logger.info("CALLED /api/register/%s/%s", btc_addr, payout_addr)
     error_msg = "Registration Failed: {0}"
     try:
         user = Farmer(btc_addr)
@@ -78,7 +227,7 @@ def register_with_payout(btc_addr, payout_addr):
         msg = "Address already is registered."
         logger.warning(msg)
         return make_response(error_msg.format(msg), 409)
-    except storjcore.auth.AuthError:
+    except auth_error():
         msg = "Invalid authentication headers."
         logger.warning(msg)
         return make_response(error_msg.format(msg), 401)
@@ -86,10 +235,14 @@ def register_with_payout(btc_addr, payout_addr):
 
 @app.route('/api/ping/<btc_addr>', methods=["GET"])
 def ping(btc_addr):
-    logger.info("CALLED /api/ping/{0}".format(btc_addr))
+    logger.info("CALLED /api/ping/%s", btc_addr)
     error_msg = "Ping Failed: {0}"
     try:
         user = Farmer(btc_addr)
+        if not may_be_registered(btc_addr):  # without a query
+            raise LookupError(btc_addr)
+        if not breaker.allow():  # the database is struggling
+            return shed_ping(btc_addr)
 
         def before_commit():  # lazy authentication
             user.authenticate(dict(request.headers))
@@ -104,7 +257,7 @@ def ping(btc_addr):
         msg = "Farmer not found."
         logger.warning(msg)
         return make_response(error_msg.format(msg), 404)
-    except storjcore.auth.AuthError:
+    except auth_error():
         msg = "Invalid authentication headers."
         logger.warning(msg)
         return make_response(error_msg.format(msg), 401)
@@ -119,6 +272,8 @@ def get_address():
 
 @app.route('/api/online', methods=["GET"])
 @cache.cached(timeout=app.config["CACHING_TIME"], unless=disable_caching)
+@serve_stale
+@read_only
 def online():
     """Display a readable list of online farmers."""
     logger.info("CALLED /api/online")
@@ -134,53 +289,116 @@ def online():
 
 
 @app.route('/api/online/json', methods=["GET"])
-@cache.cached(timeout=app.config["CACHING_TIME"], unless=disable_caching)
+@cache.cached(timeout=app.config["CACHING_TIME"],
+              unless=disable_caching_for_delta)
+@serve_stale
+@read_only
 def online_json():
     """Display a machine readable list of online farmers."""
     logger.info("CALLED /api/online/json")
-    payload = {
-        "farmers": [
-            json.loads(farmer.to_json()) for farmer in online_farmers()
-        ]
-    }
-    resp = jsonify(payload)
+    if "since" in request.args:
+        # only the changes since a version token from a previous call
+        hub = get_hub(query_online_records)
+        resp = jsonify(hub.delta(request.args["since"]))
+    else:
+        resp = make_response(online_json_body(), 200)
+        resp.mimetype = "application/json"
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+
+@app.route('/api/online/events', methods=["GET"])
+@fail_fast
+def online_events():
+    """Push join, leave and height changes of the online farmers."""
+    logger.info("CALLED /api/online/events")
+    hub = get_hub(query_online_records)
+    resp = Response(stream(hub, app.config["EVENTS_KEEPALIVE"]),
+                    mimetype="text/event-stream")
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
     resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
 
 @app.route('/api/total', methods=["GET"])
 @cache.cached(timeout=app.config["CACHING_TIME"], unless=disable_caching)
+@serve_stale
+@read_only
 def total():
     logger.info("CALLED /api/total")
+    resp = jsonify(total_payload(online_farmers()))
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
 
-    # Add up number of shards
-    all_farmers = online_farmers()
-    total_shards = sum([farmer.height for farmer in all_farmers])
-    total_farmers = len(all_farmers)
 
-    # BYTE_SIZE / 1 TB
-    total_size = (total_shards * (app.config["BYTE_SIZE"] / (1024 ** 4)))
+@app.route('/api/total/history', methods=["GET"])
+@serve_stale
+@read_only
+def total_history():
+    """Recorded totals, ?from= and ?to= epoch seconds and ?resolution="""
+    logger.info("CALLED /api/total/history")
+    try:
+        end = int(request.args.get("to", time.time()))
+        begin = int(request.args.get("from", end - 7 * 86400))
+        period = parse_period(request.args.get("resolution", "auto"))
+    except ValueError:
+        msg = "Invalid range or resolution."
+        logger.warning(msg)
+        return make_response(msg, 400)
+    period, rows = query_history(begin, end, period)
+    resp = jsonify({"from": begin, "to": end, "resolution": period,
+                    "totals": [row.to_dict() for row in rows]})
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
 
-    # Increment by 1 every TOTAL_UPDATE minutes
-    epoch = datetime.datetime(1970, 1, 1)
-    epoch_mins = (datetime.datetime.utcnow() - epoch).total_seconds()/60
-    id_val = epoch_mins / app.config["TOTAL_UPDATE"]
 
-    json_data = {'id': int(id_val),
-                 'total_TB': round(total_size, 2),
-                 'total_farmers': total_farmers}
+@app.route('/api/network/total', methods=["GET"])
+@cache.cached(timeout=app.config["CACHING_TIME"], unless=disable_caching)
+@serve_stale
+@read_only
+def network_total():
+    """Totals of this node and all configured peer nodes."""
+    logger.info("CALLED /api/network/total")
+    peers = federation()
+    if peers is None:
+        return make_response("No peer nodes configured.", 404)
+    peers.refresh()
+    farmers = online_farmers()
+    resp = jsonify(peers.network_total(
+        total_payload(farmers), [farmer.to_dict() for farmer in farmers],
+        app.config["BYTE_SIZE"]))
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
 
-    resp = jsonify(json_data)
+
+@app.route('/api/network/online/json', methods=["GET"])
+@cache.cached(timeout=app.config["CACHING_TIME"], unless=disable_caching)
+@serve_stale
+@read_only
+def network_online_json():
+    """Online farmers of this node and all configured peer nodes."""
+    logger.info("CALLED /api/network/online/json")
+    peers = federation()
+    if peers is None:
+        return make_response("No peer nodes configured.", 404)
+    peers.refresh()
+    local = [farmer.to_dict() for farmer in online_farmers()]
+    resp = jsonify({"farmers": peers.network_farmers(local),
+                    "peers": peers.status()})
     resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
 
 @app.route('/api/height/<btc_addr>/<int:height>', methods=["GET"])
+@fail_fast
 def set_height(btc_addr, height):
-    logger.info("CALLED /api/height/{0}/{1}".format(btc_addr, height))
+    logger.info("CALLED /api/height/%s/%s", btc_addr, height)
     error_msg = "Set height failed: {0}"
     try:
         user = Farmer(btc_addr)
+        if not may_be_registered(btc_addr):  # without a query
+            raise LookupError(btc_addr)
         user.authenticate(dict(request.headers))
         if height <= app.config["HEIGHT_LIMIT"]:
             user.set_height(height)
@@ -201,11 +419,32 @@ def set_height(btc_addr, height):
         msg = "Farmer not found."
         logger.warning(msg)
         return make_response(msg, 404)
-    except storjcore.auth.AuthError:
+    except auth_error():
         msg = "Invalid authentication headers."
         logger.warning(msg)
         return make_response(error_msg.format(msg), 401)
 
 
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    """Request, database, signature and cache metrics for Prometheus."""
+    if not app.config["METRICS"]:
+        return make_response("Metrics are disabled.", 404)
+    return Response(exposition(app),
+                    mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/api/admin/slow-queries', methods=["GET"])
+def slow_query_log():
+    """Recent slow statements, for the node operator only."""
+    if not is_admin(dict(request.headers)):
+        msg = "Invalid admin authentication headers."
+        logger.warning(msg)
+        return make_response(msg, 401)
+    return jsonify({"threshold": app.config["SLOW_QUERY_TIME"],
+                    "queries": slow_queries.recent()})
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    from dataserv.manage import manager
+    manager.run()
\ No newline at end of file
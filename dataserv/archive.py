@@ -0,0 +1,128 @@
+"""
+Farmers offline for more than ARCHIVE_AFTER days are moved from `farmer`
+to `farmer_archive` in chunks of ARCHIVE_CHUNK, which keeps the farmer
+table and its indexes to the farmers that still come around. An archived
+farmer is moved back by `Farmer.lookup()` on its next ping, with the same
+id unless a new registration took it meanwhile.
+
+    python app.py archive --days 30
+
+Set ARCHIVE_INTERVAL to also run it from a background thread, in a
+single worker or with the command from cron when running several.
+
+"""
+import time
+import threading
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import and_, literal, select
+from sqlalchemy.exc import DBAPIError
+from dataserv.run import app, db
+from dataserv.Farmer import Farmer, FarmerArchive
+from dataserv.sharding import get_shards
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+COLUMNS = ["id", "btc_addr", "payout_addr", "height", "last_seen", "reg_time",
+           "uptime"]
+
+
+def engines():
+    shards = get_shards()
+    return [db.engine] if shards is None else shards.engines
+
+
+def archive_chunk(engine, cutoff, chunk):
+    """Move up to chunk farmers last seen before cutoff, return how many."""
+    farmer = Farmer.__table__
+    archive = FarmerArchive.__table__
+    with engine.begin() as connection:
+        # locked so a concurrent ping can not slip between copy and delete
+        ids = [row[0] for row in connection.execute(
+            select([farmer.c.id]).where(farmer.c.last_seen < cutoff)
+            .order_by(farmer.c.id).limit(chunk).with_for_update())]
+        if not ids:
+            return 0
+        offline = and_(farmer.c.id.in_(ids), farmer.c.last_seen < cutoff)
+        columns = [farmer.c[name] for name in COLUMNS]
+        connection.execute(archive.insert().from_select(
+            COLUMNS + ["archived"],
+            select(columns + [literal(datetime.utcnow(),
+                                     archive.c.archived.type)])
+            .where(offline)))
+        connection.execute(farmer.delete().where(offline))
+        return len(ids)
+
+
+def archive_farmers(days, chunk):
+    """Archive the farmers offline for more than days, return how many."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved = 0
+    for engine in engines():
+        while True:
+            count = archive_chunk(engine, cutoff, chunk)
+            moved += count
+            if count < chunk:
+                break
+    return moved
+
+
+def table_sizes(engine):
+    """{table or index name: bytes} of the farmer tables, {} if unknown."""
+    if engine.dialect.name == "sqlite":
+        query = ("SELECT name, SUM(pgsize) FROM dbstat "
+                 "WHERE name LIKE '%farmer%' GROUP BY name")
+    elif engine.dialect.name == "postgresql":
+        query = ("SELECT c.relname, pg_relation_size(c.oid) FROM pg_class c "
+                 "LEFT JOIN pg_index i ON i.indexrelid = c.oid "
+                 "LEFT JOIN pg_class t ON t.oid = i.indrelid "
+                 "WHERE c.relname IN ('farmer', 'farmer_archive') "
+                 "OR t.relname IN ('farmer', 'farmer_archive')")
+    else:
+        return {}
+    try:
+        with engine.connect() as connection:
+            return dict((name, int(size)) for name, size
+                        in connection.execute(query))
+    except DBAPIError:  # sqlite built without dbstat
+        return {}
+
+
+def vacuum(engine):
+    """Give the space of the moved rows back to the file system."""
+    statement = "VACUUM" if engine.dialect.name == "sqlite" else \
+        "VACUUM ANALYZE farmer"
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+            statement)
+
+
+def run_archiver(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                moved = archive_farmers(app.config["ARCHIVE_AFTER"],
+                                        app.config["ARCHIVE_CHUNK"])
+            if moved:
+                logger.info("Archived %s farmers", moved)
+        except Exception:  # keep the job alive over database hiccups
+            logger.exception("Archiving farmers failed")
+
+
+_archiver = []
+
+
+def start_archiver():
+    """Start the background job once if ARCHIVE_INTERVAL is set."""
+    interval = app.config["ARCHIVE_INTERVAL"]
+    if not interval or _archiver:
+        return None
+    thread = threading.Thread(target=run_archiver, args=(interval,))
+    thread.daemon = True
+    thread.start()
+    _archiver.append(thread)
+    return thread
@@ -0,0 +1,288 @@
+"""
+Bloom filter of the registered addresses, so that pings and height
+updates of addresses that never registered are answered with 404 without
+a database query.
+
+Every process builds its filter from the farmer and farmer_archive
+tables (archived farmers are revived by their next ping) in a background
+thread and serves every address as a possible farmer until it is done.
+Farmers registered by the process are added right away, those of other
+processes are read by id when an address misses and the last catch-up
+is BLOOM_REFRESH seconds old, so a farmer that registered with another
+worker may get a 404 for that long. Sized for twice the addresses at
+BLOOM_ERROR_RATE false positives, which still query the database, the
+filter is rebuilt when it holds more than that and every BLOOM_REBUILD
+seconds. For 1M farmers it takes 2.3 MB and 3 s to build.
+
+"""
+import math
+import time
+import struct
+import hashlib
+import threading
+from sqlalchemy import func, select
+from dataserv.run import app
+from dataserv.Farmer import Farmer, FarmerArchive, observe
+from dataserv.archive import engines
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+CHUNK = 10000  # rows per fetch
+# ids handed out by a sequence may commit out of order, a catch-up
+# reads again the last OVERLAP ids before the highest one seen
+OVERLAP = 1000
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate):
+        """Bit array sized for capacity keys at error_rate."""
+        self.capacity = capacity
+        self.error_rate = error_rate
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = max(64, int(math.ceil(bits)))
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+                                       math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0  # keys that set a new bit
+        # adds of two threads to the same byte could lose a bit, a
+        # false negative; lookups only read and take no lock
+        self._lock = threading.Lock()
+
+    def positions(self, key):
+        # k positions from two hashes (Kirsch and Mitzenmacher)
+        first, second = struct.unpack(
+            "<QQ", hashlib.sha1(key.encode("utf-8")).digest()[:16])
+        second |= 1
+        return [(first + i * second) % self.size
+                for i in range(self.hashes)]
+
+    def add(self, key):
+        with self._lock:
+            return self._add(key)
+
+    def update(self, keys):
+        """Add many keys under one lock."""
+        with self._lock:
+            for key in keys:
+                self._add(key)
+
+    def _add(self, key):
+        new = False
+        for position in self.positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+def sources():
+    """(key, engine, table) of the farmer tables of all shards."""
+    return [((index, table.name), engine, table)
+            for index, engine in enumerate(engines())
+            for table in (Farmer.__table__, FarmerArchive.__table__)]
+
+
+def load(engine, table, bloom, after):
+    """Add the addresses of the rows with ids above after, the last id."""
+    last = after
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            select([table.c.id, table.c.btc_addr])
+            .where(table.c.id > after).order_by(table.c.id))
+        while True:
+            rows = result.fetchmany(CHUNK)
+            if not rows:
+                return last
+            bloom.update(btc_addr for _, btc_addr in rows)
+            last = rows[-1][0]
+
+
+def max_id(engine, table):
+    with engine.connect() as connection:
+        return connection.execute(select([func.max(table.c.id)])).scalar()
+
+
+def count_rows():
+    total = 0
+    for _, engine, table in sources():
+        with engine.connect() as connection:
+            total += connection.execute(
+                select([func.count()]).select_from(table)).scalar()
+    return total
+
+
+class RegisteredAddresses(object):
+
+    def __init__(self, error_rate, min_capacity, refresh, rebuild):
+        """Bloom filter of the registered addresses, kept up to date."""
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.refresh = refresh
+        self.rebuild = rebuild
+        self.filter = None  # None until built
+        self.watermarks = {}  # source key: highest id read
+        self.built = 0
+        self.caught_up = 0
+        self.rebuilding = False
+        self.rebuild_again = False
+        self.catching = False
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    def may_contain(self, btc_addr, now=None):
+        """False only if btc_addr is certainly not registered."""
+        bloom = self.filter
+        if bloom is None or btc_addr in bloom:
+            return True
+        now = time.time() if now is None else now
+        if now - self.caught_up < self.refresh:
+            return False  # a definite miss
+        self.catch_up(now)
+        bloom = self.filter
+        return bloom is None or btc_addr in bloom
+
+    def add(self, btc_addr):
+        bloom = self.filter
+        if bloom is not None:
+            bloom.add(btc_addr)
+
+    def build(self, now=None):
+        """Read all addresses into a new filter, swapped in when done."""
+        now = time.time() if now is None else now
+        bloom = BloomFilter(max(self.min_capacity, 2 * count_rows()),
+                            self.error_rate)
+        watermarks = dict((key, load(engine, table, bloom, 0))
+                          for key, engine, table in sources())
+        with self._lock:
+            self.filter = bloom
+            self.watermarks = watermarks
+            self.built = now
+            self.caught_up = 0
+        # farmers registered while reading, they went to the old filter
+        self.catch_up(now, force=True)
+        logger.info("Built the address filter, %s addresses", bloom.count)
+        return bloom
+
+    def catch_up(self, now=None, force=False):
+        """
+        Add the farmers registered since the last catch-up. The shards
+        are read without the lock by one thread at a time, the others go
+        on with the filter as it is.
+
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            bloom = self.filter
+            if bloom is None or now - self.caught_up < self.refresh or \
+                    (self.catching and not force):
+                return
+            self.catching = True
+            watermarks = dict(self.watermarks)
+        try:
+            emptied = self.read_new(bloom, watermarks)
+        finally:
+            with self._lock:
+                self.catching = False
+        with self._lock:
+            if self.filter is not bloom:
+                return  # a new filter was built meanwhile
+            if emptied:
+                self.filter = None  # every address may be a farmer
+            else:
+                self.watermarks = watermarks
+                self.caught_up = now
+        if emptied or bloom.count > bloom.capacity or \
+                now - self.built >= self.rebuild:
+            self.start_rebuild()
+
+    def read_new(self, bloom, watermarks):
+        """Add the rows above the watermarks, True if a table emptied."""
+        for key, engine, table in sources():
+            mark = watermarks.get(key, 0)
+            # farmers are only deleted by the archiver, which rarely
+            # takes the newest, so fewer ids mean an emptied or
+            # restored table (revives delete archived ones all along)
+            if table is Farmer.__table__ and mark and \
+                    (max_id(engine, table) or 0) < mark:
+                return True
+            last = load(engine, table, bloom, max(0, mark - OVERLAP))
+            watermarks[key] = max(mark, last)
+        return False
+
+    def start_rebuild(self):
+        """
+        Build a new filter in a background thread, once at a time. Asked
+        during a build, another one follows it.
+
+        """
+        with self._rebuild_lock:
+            if self.rebuilding:
+                self.rebuild_again = True
+                return None
+            self.rebuilding = True
+        thread = threading.Thread(target=self.run_rebuild)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run_rebuild(self):
+        while True:
+            with self._rebuild_lock:
+                self.rebuild_again = False
+            try:
+                with app.app_context():
+                    self.build()
+            except Exception:  # the old filter keeps serving
+                logger.exception("Building the address filter failed")
+            with self._rebuild_lock:
+                if not self.rebuild_again:
+                    self.rebuilding = False
+                    return
+
+
+_registry = []
+
+
+def get_registry():
+    """The RegisteredAddresses of this process, None if disabled."""
+    return _registry[0] if _registry else None
+
+
+def may_be_registered(btc_addr):
+    """False only if btc_addr is certainly not a farmer of this node."""
+    registry = get_registry()
+    return registry is None or registry.may_contain(btc_addr)
+
+
+def on_farmer_change(event, record, previous):
+    if event == "register":
+        registry = get_registry()
+        if registry is not None:
+            registry.add(record.btc_addr)
+
+
+def start_bloom_filter():
+    """Start building the filter once if BLOOM_FILTER is set."""
+    if not app.config["BLOOM_FILTER"] or _registry:
+        return None
+    registry = RegisteredAddresses(app.config["BLOOM_ERROR_RATE"],
+                                   app.config["BLOOM_MIN_CAPACITY"],
+                                   app.config["BLOOM_REFRESH"],
+                                   app.config["BLOOM_REBUILD"])
+    observe(on_farmer_change)
+    _registry.append(registry)
+    return registry.start_rebuild()
@@ -0,0 +1,329 @@
+"""
+Circuit breaker around the database.
+
+SQLAlchemy cursor events feed the outcome of every statement into a
+rolling window of one second buckets. If BREAKER_FAILURE_RATE of the
+statements of the last BREAKER_WINDOW seconds failed (operational and
+connection errors) or took BREAKER_SLOW_TIME or longer, the breaker opens
+and for BREAKER_COOLDOWN seconds the routes leave the database alone
+instead of piling up request threads on it:
+
+    ping        accepted from memory if it is throttled, within MAX_PING
+                of the last accepted ping this process saw, else 503
+    reads       the last good response of the same URL with an Age and a
+                stale Warning header, 503 if there is none
+    the rest    503 with Retry-After
+
+After the cooldown one request at a time is let through as a probe. A
+fast statement of the probe closes the breaker, a slow or failed one
+opens it again. Statements of other threads, like the background jobs,
+and statements that started before the probe do not decide it. Only
+statements of requests count, a slow archiver or history job never
+opens it. The state is kept per process.
+
+"""
+import math
+import time
+import threading
+from functools import wraps
+from collections import OrderedDict, deque
+from datetime import datetime
+from datetime import timedelta
+from flask import Response, has_request_context, make_response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import InterfaceError, OperationalError
+from dataserv.run import app
+from dataserv.Farmer import observe
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, window=10, min_calls=20, slow_time=1.0,
+                 failure_rate=0.5, cooldown=5):
+        """Rolling statement outcomes and the open or closed state."""
+        self._lock = threading.Lock()
+        self.configure(window, min_calls, slow_time, failure_rate, cooldown)
+        self.reset()
+
+    def configure(self, window, min_calls, slow_time, failure_rate,
+                  cooldown):
+        with self._lock:
+            self.window = window
+            self.min_calls = min_calls
+            self.slow_time = slow_time
+            self.failure_rate = failure_rate
+            self.cooldown = cooldown
+
+    def reset(self):
+        with self._lock:
+            self.buckets = deque()  # [second, statements, failed or slow]
+            self.opened = None  # time it opened, None while closed
+            self.probing = None  # time the last probe was let through
+            self.prober = None  # thread ident of that probe
+            self.trips = 0
+
+    def state(self, now=None):
+        """"closed", "open" or "half-open" while waiting for a probe."""
+        now = time.time() if now is None else now
+        opened = self.opened
+        if opened is None:
+            return "closed"
+        return "open" if now < opened + self.cooldown else "half-open"
+
+    def record(self, duration, failed, now=None, thread=None):
+        """Add the outcome of one statement run by thread (this one)."""
+        now = time.time() if now is None else now
+        thread = threading.current_thread().ident if thread is None \
+            else thread
+        bad = failed or duration >= self.slow_time
+        with self._lock:
+            if self.opened is not None:
+                # only the statements of the probe decide, the ones still
+                # running when it opened and other threads are ignored
+                started = now - duration + 0.001  # float rounding
+                if self.probing is not None and thread == self.prober and \
+                        started >= self.probing:
+                    if bad:
+                        self._open(now)
+                    else:
+                        self._close()
+                return
+            second = int(now)
+            if self.buckets and self.buckets[-1][0] == second:
+                bucket = self.buckets[-1]
+            else:
+                bucket = [second, 0, 0]
+                self.buckets.append(bucket)
+            bucket[1] += 1
+            bucket[2] += bad
+            while self.buckets[0][0] <= second - self.window:
+                self.buckets.popleft()
+            if not bad:
+                return
+            calls = sum(b[1] for b in self.buckets)
+            failures = sum(b[2] for b in self.buckets)
+            if calls >= self.min_calls and \
+                    failures >= calls * self.failure_rate:
+                self._open(now)
+
+    def _open(self, now):
+        if self.opened is None:
+            self.trips += 1
+            logger.warning("Database circuit breaker opened")
+        self.opened = now
+        self.probing = None
+        self.prober = None
+        self.buckets.clear()
+
+    def _close(self):
+        self.opened = None
+        self.probing = None
+        self.prober = None
+        logger.warning("Database circuit breaker closed")
+
+    def allow(self, now=None):
+        """
+        May a request use the database? Let through single probes, the
+        calling thread is the probe.
+
+        """
+        if self.opened is None:
+            return True
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.opened is None:
+                return True
+            if now < self.opened + self.cooldown:
+                return False
+            if self.probing is not None and \
+                    now < self.probing + self.cooldown:
+                return False
+            self.probing = now
+            self.prober = threading.current_thread().ident
+            return True
+
+    def retry_after(self, now=None):
+        """Whole seconds until the next probe, at least 1."""
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.opened is None:
+                return 1
+            until = max(self.opened, self.probing or 0) + self.cooldown
+            return max(1, int(math.ceil(until - now)))
+
+
+class RecentPings(object):
+
+    def __init__(self):
+        """Last accepted ping per address, kept for about MAX_PING."""
+        self.current = {}
+        self.previous = {}
+        self.rotated = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, btc_addr, last_seen, max_age, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            # older entries cannot throttle a ping any more
+            if now - self.rotated >= max_age:
+                self.previous, self.current = self.current, {}
+                self.rotated = now
+            self.current[btc_addr] = last_seen
+
+    def throttled(self, btc_addr, max_ping):
+        """Would a ping of btc_addr now change nothing?"""
+        last_seen = self.current.get(btc_addr) or \
+            self.previous.get(btc_addr)
+        if last_seen is None:
+            return False
+        return datetime.utcnow() - last_seen < timedelta(seconds=max_ping)
+
+    def clear(self):
+        with self._lock:
+            self.current = {}
+            self.previous = {}
+
+
+class StaleResponses(object):
+
+    def __init__(self, max_bytes):
+        """Last good response per URL, the least recent evicted first."""
+        self.entries = OrderedDict()  # url: (time, status, headers, body)
+        self.size = 0
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def put(self, url, response, now=None):
+        now = time.time() if now is None else now
+        body = response.get_data()
+        if len(body) > self.max_bytes:
+            return
+        entry = (now, response.status_code, list(response.headers), body)
+        with self._lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.size -= len(old[3])
+            self.entries[url] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old[3])
+
+    def get(self, url):
+        with self._lock:
+            return self.entries.get(url)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+
+breaker = CircuitBreaker()
+recent_pings = RecentPings()
+stale_responses = StaleResponses(64 * 1024 * 1024)
+_installed = []
+
+
+def unavailable():
+    """503 telling the client when to try again."""
+    response = make_response("Database unavailable, try again later.", 503)
+    response.headers["Retry-After"] = str(breaker.retry_after())
+    return response
+
+
+def stale(url):
+    """The last good response of url, 503 if there is none."""
+    entry = stale_responses.get(url)
+    if entry is None:
+        return unavailable()
+    stored, status, headers, body = entry
+    response = Response(body, status, headers)
+    response.headers["Age"] = str(int(time.time() - stored))
+    response.headers["Warning"] = '110 - "Response is Stale"'
+    return response
+
+
+def shed_ping(btc_addr):
+    """Accept a throttled ping without the database, it changes nothing."""
+    if recent_pings.throttled(btc_addr, app.config["MAX_PING"]):
+        return make_response("Ping accepted.", 200)
+    return unavailable()
+
+
+def serve_stale(view):
+    """Keep the good responses of a read view, served while open."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not breaker.allow():
+            return stale(request.full_path)
+        response = make_response(view(*args, **kwargs))
+        if _installed and response.status_code == 200 and \
+                not response.is_streamed:
+            stale_responses.put(request.full_path, response)
+        return response
+    return wrapper
+
+
+def fail_fast(view):
+    """Answer 503 instead of waiting for the database while open."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not breaker.allow():
+            return unavailable()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault("breaker_start", []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = conn.info["breaker_start"].pop()
+    if has_request_context():  # not the background jobs
+        breaker.record(time.time() - start, False)
+
+
+def handle_error(context):
+    starts = None
+    if context.connection is not None:
+        starts = context.connection.info.get("breaker_start")
+    duration = time.time() - starts.pop() if starts else 0.0
+    if not has_request_context():
+        return
+    # constraint violations and the like are answers of a working database
+    failed = context.is_disconnect or isinstance(
+        context.sqlalchemy_exception, (OperationalError, InterfaceError))
+    breaker.record(duration, failed)
+
+
+def on_farmer_change(event, record, previous):
+    recent_pings.add(record.btc_addr, record.last_seen,
+                     app.config["MAX_PING"])
+
+
+def install_breaker():
+    """Watch the statements if CIRCUIT_BREAKER is set at startup."""
+    if not app.config["CIRCUIT_BREAKER"]:
+        return False
+    breaker.configure(app.config["BREAKER_WINDOW"],
+                      app.config["BREAKER_MIN_CALLS"],
+                      app.config["BREAKER_SLOW_TIME"],
+                      app.config["BREAKER_FAILURE_RATE"],
+                      app.config["BREAKER_COOLDOWN"])
+    stale_responses.max_bytes = app.config["BREAKER_STALE_BYTES"]
+    if not _installed:
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
+        observe(on_farmer_change)
+        _installed.append(True)
+    return True
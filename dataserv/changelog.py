@@ -0,0 +1,58 @@
+import time
+import threading
+from collections import deque
+
+
+class ChangeLog(object):
+
+    def __init__(self, retention, start=None):
+        """
+        Log of the EventHub events, keeping the last `retention` entries.
+        It subscribes to the hub like a client that never falls behind.
+
+        Entries carry the time they were logged and tokens are a time
+        watermark: every change committed before it is already in the
+        state the client got. Any worker can answer a token from another
+        worker on the same clock, it holds every change logged since
+        `start`.
+
+        """
+        self.entries = deque(maxlen=retention)  # (logged, event, btc_addr)
+        self.start = time.time() if start is None else start
+        self.discarded = None  # time of the newest dropped entry
+        self.dropped = False
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        version, event, data = item
+        with self._lock:
+            if len(self.entries) == self.entries.maxlen:
+                self.discarded = self.entries[0][0]
+            self.entries.append((time.time(), event, data["btc_addr"]))
+
+    def token(self, watermark):
+        return repr(float(watermark))
+
+    def since(self, token):
+        """
+        {btc_addr: (first event, last event)} of the changes at or after
+        the token, None if it is invalid, from the future or older than
+        this log.
+
+        """
+        try:
+            watermark = float(token)
+        except ValueError:
+            return None
+        with self._lock:
+            if watermark > time.time() or watermark < self.start:
+                return None
+            if self.discarded is not None and watermark <= self.discarded:
+                return None  # changes were already discarded
+            changes = {}
+            for logged, event, btc_addr in self.entries:
+                if logged < watermark:
+                    continue
+                first, _ = changes.get(btc_addr, (event, None))
+                changes[btc_addr] = (first, event)
+            return changes
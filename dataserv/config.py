@@ -4,6 +4,58 @@ import logging
 
 ONLINE_TIME = 5  # minutes
 
+# keep the online farmers in a per process time wheel fed by pings instead
+# of querying them, resynced from the database every TIMEWHEEL_RESYNC
+# seconds to see pings handled by other worker processes (0 = never)
+ONLINE_TIMEWHEEL = bool(os.environ.get("DATASERV_ONLINE_TIMEWHEEL"))
+if os.environ.get("DATASERV_TIMEWHEEL_RESYNC"):
+    TIMEWHEEL_RESYNC = int(os.environ.get("DATASERV_TIMEWHEEL_RESYNC"))
+else:
+    TIMEWHEEL_RESYNC = 60  # seconds
+
+# share the online farmers between worker processes through a memory
+# mapped file, refreshed by one worker every SHARED_TABLE_REFRESH seconds
+# example `export DATASERV_SHARED_TABLE="/dev/shm/dataserv-online"`
+SHARED_TABLE_PATH = os.environ.get("DATASERV_SHARED_TABLE")
+SHARED_TABLE_REFRESH = 10  # seconds
+SHARED_TABLE_CAPACITY = 100000  # farmers, grows if needed
+
+# server-sent events of the online set, subscribers with more than
+# EVENTS_QUEUE_SIZE undelivered events are disconnected
+EVENTS_QUEUE_SIZE = 1000
+EVENTS_KEEPALIVE = 15  # seconds
+
+# online set changes kept for /api/online/json?since=<version>, older
+# version tokens get the full list, tokens are valid across workers
+# resynced every TIMEWHEEL_RESYNC seconds
+CHANGELOG_RETENTION = 10000  # changes
+
+
+# store the farmer times as integer epoch seconds instead of DATETIME,
+# converted by the `epoch times` migration (see dataserv.epochtime)
+EPOCH_TIMES = bool(os.environ.get("DATASERV_EPOCH_TIMES"))
+
+
+# height changes appended to binary segment files in HEIGHT_LOG_DIR, each
+# process writes and fsyncs its changes every HEIGHT_LOG_FLUSH seconds,
+# see dataserv.heightlog, compacted by `python app.py compact_heights`
+HEIGHT_LOG_DIR = os.environ.get("DATASERV_HEIGHT_LOG_DIR")
+HEIGHT_LOG_FLUSH = 1.0  # seconds
+HEIGHT_LOG_SEGMENT = 64 * 1024 * 1024  # bytes, 4M changes
+
+# farmers offline for more than ARCHIVE_AFTER days are moved to the
+# archive table by `python app.py archive` or, if ARCHIVE_INTERVAL is set,
+# by a background thread every ARCHIVE_INTERVAL seconds
+if os.environ.get("DATASERV_ARCHIVE_AFTER"):
+    ARCHIVE_AFTER = float(os.environ.get("DATASERV_ARCHIVE_AFTER"))
+else:
+    ARCHIVE_AFTER = 30  # days
+ARCHIVE_CHUNK = 1000  # farmers per transaction
+if os.environ.get("DATASERV_ARCHIVE_INTERVAL"):
+    ARCHIVE_INTERVAL = int(os.environ.get("DATASERV_ARCHIVE_INTERVAL"))
+else:
+    ARCHIVE_INTERVAL = 0  # seconds, 0 = no background job
+
 
 # MAX_PING is the most a client may ping
 if os.environ.get("DATASERV_MAX_PING"):
@@ -11,6 +63,32 @@ if os.environ.get("DATASERV_MAX_PING"):
 else:
     MAX_PING = 60  # default seconds
 
+# circuit breaker around the database, off unless DATASERV_CIRCUIT_BREAKER
+# is set: if BREAKER_FAILURE_RATE of the request statements of the last
+# BREAKER_WINDOW seconds (at least BREAKER_MIN_CALLS) failed or took
+# BREAKER_SLOW_TIME or longer, the routes skip the database for
+# BREAKER_COOLDOWN seconds; throttled pings are accepted from memory,
+# the read routes serve their last good response (BREAKER_STALE_BYTES in
+# total) and the others answer 503, see dataserv.breaker
+CIRCUIT_BREAKER = bool(os.environ.get("DATASERV_CIRCUIT_BREAKER"))
+BREAKER_WINDOW = 10  # seconds
+BREAKER_MIN_CALLS = 20  # statements
+BREAKER_SLOW_TIME = 1.0  # seconds
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_COOLDOWN = 5  # seconds
+BREAKER_STALE_BYTES = 64 * 1024 * 1024
+
+# answer pings and height updates of unregistered addresses with 404 from a
+# per process Bloom filter of the registered ones, see dataserv.bloom; new
+# farmers of other processes are read at most every BLOOM_REFRESH seconds
+# and the filter is rebuilt every BLOOM_REBUILD seconds or when it holds
+# more addresses than it was sized for
+BLOOM_FILTER = bool(os.environ.get("DATASERV_BLOOM_FILTER"))
+BLOOM_ERROR_RATE = 0.01  # false positives, these query the database
+BLOOM_REFRESH = 1.0  # seconds
+BLOOM_REBUILD = 3600  # seconds
+BLOOM_MIN_CAPACITY = 100000  # addresses
+
 
 # db setup
 # example `export DATASERV_DATABASE_URI="postgresql:///dataserv"`
@@ -20,22 +98,144 @@ else:  # default to sqlite
     SQLALCHEMY_DATABASE_URI = "sqlite:///dataserv.db"
 
 
+# optional read-only replica used by the online and total endpoints
+# example `export DATASERV_READ_DATABASE_URI="postgresql://replica/dataserv"`
+if os.environ.get("DATASERV_READ_DATABASE_URI"):
+    SQLALCHEMY_BINDS = {"replica": os.environ.get("DATASERV_READ_DATABASE_URI")}
+else:
+    SQLALCHEMY_BINDS = None
+
+
+# optional hash sharding of farmers over several databases
+# example `export DATASERV_SHARD_URIS="postgresql:///shard0,postgresql:///shard1"`
+if os.environ.get("DATASERV_SHARD_URIS"):
+    SHARD_DATABASE_URIS = os.environ.get("DATASERV_SHARD_URIS").split(",")
+else:
+    SHARD_DATABASE_URIS = []
+
+
+# connection pool tuning, None keeps the SQLAlchemy defaults
+# (sizing is ignored for sqlite which does not use a sized pool unless
+# SQLITE_WAL is set)
+SQLALCHEMY_POOL_SIZE = None
+SQLALCHEMY_MAX_OVERFLOW = None
+SQLALCHEMY_POOL_RECYCLE = None  # seconds
+if os.environ.get("DATASERV_POOL_SIZE"):
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get("DATASERV_POOL_SIZE"))
+if os.environ.get("DATASERV_MAX_OVERFLOW"):
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get("DATASERV_MAX_OVERFLOW"))
+if os.environ.get("DATASERV_POOL_RECYCLE"):
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ.get("DATASERV_POOL_RECYCLE"))
+
+# sqlite tuned for concurrent requests: write-ahead logging with the
+# SQLITE_PRAGMAS on every connection, a connection pool instead of a new
+# connection per request, and the farmer writes committed in groups of
+# up to SQLITE_WRITER_BATCH by one writer thread per process
+SQLITE_WAL = bool(os.environ.get("DATASERV_SQLITE_WAL"))
+SQLITE_WRITER = SQLITE_WAL and \
+    not os.environ.get("DATASERV_DISABLE_SQLITE_WRITER")
+SQLITE_WRITER_BATCH = 500  # writes per transaction
+SQLITE_PRAGMAS = {
+    "synchronous": "NORMAL",  # WAL stays consistent, syncs on checkpoints
+    "mmap_size": 256 * 1024 * 1024,  # bytes
+    "cache_size": -64 * 1024,  # negative is KiB
+    "busy_timeout": 5000,  # milliseconds
+}
+
+# test connections before use to survive database restarts
+SQLALCHEMY_POOL_PRE_PING = bool(os.environ.get("DATASERV_POOL_PRE_PING"))
+
+
 DATA_DIR = 'data/'
 BYTE_SIZE = 1024*1024*128  # 128 MB FIXME rename, very confusing name
 HEIGHT_LIMIT = 200000  # around 25 TB
 
 ADDRESS = "16ZcxFDdkVJR1P8GMNmWFyhS4EKrRMsWNG"  # unique per server address
+
+# other dataserv nodes summed up by the /api/network endpoints
+# example `export DATASERV_PEERS="http://node1:5000,http://node2:5000"`
+if os.environ.get("DATASERV_PEERS"):
+    PEER_NODES = os.environ.get("DATASERV_PEERS").split(",")
+else:
+    PEER_NODES = []
+PEER_TIMEOUT = 5  # seconds
+PEER_MAX_AGE = 300  # seconds a failing peer's last farmers are still counted
+
 AUTHENTICATION_TIMEOUT = 20  # seconds
 SKIP_AUTHENTICATION = False  # only for testing
 
-_log_format = "%(asctime)s %(levelname)s %(name)s %(lineno)d: %(message)s"
-logging.basicConfig(format=_log_format, filename='dataserv.log',
-                    level=logging.DEBUG)
+# accept every signed header set only once per request method and path,
+# a client repeating the same request must wait for the next second
+REPLAY_PROTECTION = bool(os.environ.get("DATASERV_REPLAY_PROTECTION"))
+REPLAY_BUCKET = 5  # seconds of header dates per expiry bucket
+
+# logging, set up by dataserv.logs.setup_logging, LOG_FILE "-" is stderr
+LOG_LEVEL = os.environ.get("DATASERV_LOG_LEVEL", "DEBUG").upper()
+LOG_FILE = os.environ.get("DATASERV_LOG_FILE", "dataserv.log")
+# write from a background thread instead of the request thread
+LOG_QUEUE = not os.environ.get("DATASERV_DISABLE_LOG_QUEUE")
+# keep only LOG_SAMPLE_RATE of the INFO records of the busiest routes,
+# for example 0.01 to log one in a hundred pings
+if os.environ.get("DATASERV_LOG_SAMPLE_RATE"):
+    LOG_SAMPLE_RATE = float(os.environ.get("DATASERV_LOG_SAMPLE_RATE"))
+else:
+    LOG_SAMPLE_RATE = 1.0
+LOG_SAMPLED = ["CALLED /api/ping/"]
 TOTAL_UPDATE = 30  # minutes
 
+# network totals recorded once per TOTAL_UPDATE epoch for /api/total/history
+# by `python app.py history` from cron or, if TOTAL_HISTORY is set, by a
+# background thread; the epoch rows are kept HISTORY_RETENTION days, the
+# hourly rollups HISTORY_HOURLY_RETENTION days and the daily ones forever
+TOTAL_HISTORY = bool(os.environ.get("DATASERV_TOTAL_HISTORY"))
+HISTORY_RETENTION = 30  # days
+HISTORY_HOURLY_RETENTION = 365  # days
+HISTORY_MAX_POINTS = 500  # rows per response
+
 if os.environ.get("DATASERV_CACHING_TIME"):
     CACHING_TIME = int(os.environ.get("DATASERV_CACHING_TIME"))
 else:
     CACHING_TIME = 30  # seconds
     
 DISABLE_CACHING = not bool(CACHING_TIME)
+
+# request metrics on /metrics, off unless DATASERV_METRICS is set, with
+# several workers set METRICS_DIR to a directory they share, emptied before
+# they start
+# example `export DATASERV_METRICS_DIR="/dev/shm/dataserv-metrics"`
+METRICS = bool(os.environ.get("DATASERV_METRICS"))
+METRICS_DIR = os.environ.get("DATASERV_METRICS_DIR")
+METRICS_FLUSH = 5  # seconds between writes of a worker's metrics file
+
+# statements slower than SLOW_QUERY_TIME seconds are logged and kept for
+# /api/admin/slow-queries (0 = off), optionally with their EXPLAIN plan
+if os.environ.get("DATASERV_SLOW_QUERY_TIME"):
+    SLOW_QUERY_TIME = float(os.environ.get("DATASERV_SLOW_QUERY_TIME"))
+else:
+    SLOW_QUERY_TIME = 0.5  # seconds
+SLOW_QUERY_LOG_SIZE = 100  # statements
+SLOW_QUERY_EXPLAIN = bool(os.environ.get("DATASERV_SLOW_QUERY_EXPLAIN"))
+
+# worker processes checking signatures for the asyncio app (dataserv/aioapp.py),
+# None for one per CPU, 0 for a thread of the serving process
+if os.environ.get("DATASERV_ASYNC_VERIFY_PROCESSES"):
+    ASYNC_VERIFY_PROCESSES = int(
+        os.environ.get("DATASERV_ASYNC_VERIFY_PROCESSES"))
+else:
+    ASYNC_VERIFY_PROCESSES = None
+
+# bitcoin address of the node operator, requests signed by its key may
+# use the admin features
+ADMIN_ADDRESS = os.environ.get("DATASERV_ADMIN_ADDRESS")
+
+# profile a fraction of the requests (0.0 - 1.0) and admin requests with
+# an `X-Profile` header, stats are written to PROFILE_DIR per route
+if os.environ.get("DATASERV_PROFILE_RATE"):
+    PROFILE_RATE = float(os.environ.get("DATASERV_PROFILE_RATE"))
+else:
+    PROFILE_RATE = 0.0
+PROFILE_DIR = os.environ.get("DATASERV_PROFILE_DIR", "profiles")
+PROFILE_DUMP = 30  # seconds between writes of a route's stats
+
+# encode farmer payloads with ujson if it is installed
+FAST_JSON = not os.environ.get("DATASERV_DISABLE_FAST_JSON")
@@ -0,0 +1,118 @@
+"""
+Farmer timestamps as integer epoch seconds.
+
+With EPOCH_TIMES the farmer time columns are INTEGER seconds since the
+epoch (UTC) instead of DATETIME. The models still see naive UTC
+datetimes, but bulk reads can select the raw integers and do the online
+window and uptime math on plain ints, without a datetime per row.
+
+The `epoch times` migration converts the columns to match EPOCH_TIMES.
+To switch an existing database, change the setting, then downgrade by
+one revision and upgrade again:
+
+    python app.py db downgrade 3a1f2b7c9d4e && python app.py db upgrade
+
+"""
+import calendar
+from datetime import datetime
+import sqlalchemy as sa
+from sqlalchemy.types import TypeDecorator
+
+
+# time columns per table
+COLUMNS = {
+    "farmer": ["last_seen", "reg_time"],
+    "farmer_archive": ["last_seen", "reg_time", "archived"],
+}
+
+
+def to_epoch(when):
+    """Naive UTC datetime to whole epoch seconds."""
+    return calendar.timegm(when.utctimetuple())
+
+
+def from_epoch(seconds):
+    """Epoch seconds to a naive UTC datetime."""
+    return datetime.utcfromtimestamp(seconds)
+
+
+class EpochDateTime(TypeDecorator):
+    """Naive UTC datetime stored as integer epoch seconds."""
+    impl = sa.Integer
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime):
+            return to_epoch(value)
+        return value  # raw seconds pass as they are
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else from_epoch(value)
+
+
+def uptime_percent(now, reg_time, last_seen, uptime, online_time):
+    """
+    Farmer.calculate_uptime on epoch seconds, online_time in seconds.
+    Plain integer math for rows read without building datetimes.
+
+    """
+    registered = now - reg_time
+    if registered < 1:  # in case registration happened a short bit ago
+        return 100
+    uptime += min(now - last_seen, online_time)
+    return round(round(uptime / float(registered), 3) * 100, 3)
+
+
+def convert(op, epoch):
+    """
+    Convert the time columns of an alembic migration's database to
+    epoch seconds or back to datetimes. Columns already of the wanted
+    type and columns missing in the schema are left alone.
+
+    """
+    connection = op.get_bind()
+    dialect = connection.dialect.name
+    inspector = sa.inspect(connection)
+    tables = inspector.get_table_names()
+    for table, names in sorted(COLUMNS.items()):
+        if table not in tables:
+            continue
+        types = dict((c["name"], c["type"]) for c in
+                     inspector.get_columns(table))
+        names = [n for n in names if n in types and
+                 isinstance(types[n], sa.Integer) != epoch]
+        if not names:
+            continue
+        if dialect == "sqlite":
+            convert_sqlite(op, table, names, epoch)
+        elif dialect == "postgresql":
+            convert_postgresql(op, table, names, epoch)
+        else:
+            raise NotImplementedError("Converting {0} times on {1} is not "
+                                      "supported".format(table, dialect))
+
+
+def convert_sqlite(op, table, names, epoch):
+    # the table copy of a batch migration casts the old values, which
+    # only keeps them intact while they are integers
+    if epoch:
+        for name in names:
+            op.execute("UPDATE {0} SET {1} = CAST(strftime('%s', {1}) AS "
+                       "INTEGER) WHERE {1} IS NOT NULL".format(table, name))
+    with op.batch_alter_table(table) as batch:
+        for name in names:
+            batch.alter_column(name, type_=sa.Integer() if epoch else
+                               sa.DateTime())
+    if not epoch:
+        for name in names:
+            op.execute("UPDATE {0} SET {1} = datetime({1}, 'unixepoch') "
+                       "WHERE {1} IS NOT NULL".format(table, name))
+
+
+def convert_postgresql(op, table, names, epoch):
+    for name in names:
+        if epoch:
+            using = "EXTRACT(EPOCH FROM {0})::integer".format(name)
+        else:
+            using = "to_timestamp({0}) AT TIME ZONE 'UTC'".format(name)
+        op.alter_column(table, name, postgresql_using=using,
+                        type_=sa.Integer() if epoch else sa.DateTime())
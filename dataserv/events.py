@@ -0,0 +1,266 @@
+"""
+Join, leave and height change events of the online set, pushed to
+server-sent events subscribers.
+
+Waiting subscribers block on a condition variable, not on a socket, so
+under a cooperative gunicorn worker (`gunicorn -k gevent`) thousands of
+idle connections share one process instead of holding a thread each.
+
+The hub only observes the pings of its own process and expires farmers
+from its own state. With a loader it is loaded from the database on
+first use and resynced every `resync` seconds, so the joins handled by
+other workers show up; in between, farmers that time out are looked up
+by address before they leave, so their pings to other workers are not
+taken for leaves.
+
+"""
+import json
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from dataserv.run import app
+from dataserv.Farmer import observe
+from dataserv.timewheel import TimeWheel
+from dataserv.changelog import ChangeLog
+
+
+CONFIRM_CHUNK = 500  # addresses looked up per query
+
+class Subscriber(object):
+
+    def __init__(self, maxsize):
+        """Bounded event queue of one connected client."""
+        self.maxsize = maxsize
+        self.queue = deque()
+        self.dropped = False
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        """Queue an event, drop the subscriber if it fell too far behind."""
+        with self._cond:
+            if len(self.queue) >= self.maxsize:
+                self.dropped = True
+            else:
+                self.queue.append(event)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """All queued events, waiting up to timeout seconds for one."""
+        with self._cond:
+            if not self.queue and not self.dropped:
+                self._cond.wait(timeout)
+            events = list(self.queue)
+            self.queue.clear()
+            return events
+
+
+class EventHub(object):
+
+    def __init__(self, online_time, queue_size, retention=10000, loader=None,
+                 resync=0):
+        """
+        Tracks the online set with a TimeWheel fed by farmer changes and
+        fans the resulting events out to the subscribers. Every event gets
+        the next version number and is kept in a ChangeLog for delta sync.
+        loader(btc_addrs=None) returns the online records of the database,
+        of the given addresses only if set.
+
+        """
+        self.wheel = TimeWheel(online_time)
+        self.online_time = online_time
+        self.loader = loader
+        self.resync = resync
+        self.synced = None  # time of the last sync with the database
+        self.queue_size = queue_size
+        self.changelog = ChangeLog(retention)
+        self.subscribers = set([self.changelog])
+        self.version = 0
+        self._lock = threading.RLock()
+
+    def publish(self, event, data):
+        with self._lock:
+            self.version += 1
+            item = (self.version, event, data)
+            for subscriber in list(self.subscribers):
+                subscriber.put(item)
+                if subscriber.dropped:
+                    self.subscribers.discard(subscriber)
+            return item
+
+    def on_farmer_change(self, event, record, previous):
+        with self._lock:
+            was_online = record.btc_addr in self.wheel.records
+            self.wheel.update(record)
+            if not was_online:
+                self.publish("join", record.to_dict())
+            elif previous is not None and previous.height != record.height:
+                self.publish("height", record.to_dict())
+
+    def load(self, now=None):
+        """Start from the online records of the database, no events."""
+        with self._lock:
+            self.synced = time.time()
+            self.wheel.load(self.loader(), now)
+
+    def sync(self, now=None):
+        """Publish the differences to the online records of the database."""
+        with self._lock:
+            started = datetime.utcnow()
+            self.synced = time.time()
+            fresh = TimeWheel(self.online_time)
+            fresh.load(self.loader(), now)
+            for btc_addr, record in list(self.wheel.records.items()):
+                if btc_addr not in fresh.records and \
+                        record.last_seen >= started:
+                    fresh.update(record, now)  # committed after the read
+            for btc_addr in self.wheel.records:
+                if btc_addr not in fresh.records:
+                    self.publish("leave", {"btc_addr": btc_addr})
+            for record in fresh.online(now):
+                previous = self.wheel.records.get(record.btc_addr)
+                if previous is None:
+                    self.publish("join", record.to_dict())
+                elif previous.height != record.height:
+                    self.publish("height", record.to_dict())
+            self.wheel = fresh
+
+    def due(self):
+        if self.loader is None:
+            return False
+        return self.synced is None or (
+            self.resync and time.time() - self.synced >= self.resync)
+
+    def expire(self, now=None):
+        """Publish a leave event for every farmer out of the window."""
+        with self._lock:
+            if self.due():
+                self.sync(now)
+                return
+            expired = self.wheel.expire(now)
+            if expired and self.loader is not None and self.resync:
+                self.confirm(expired, now)  # other workers write too
+            for record in expired:
+                if record.btc_addr not in self.wheel.records:
+                    self.publish("leave", {"btc_addr": record.btc_addr})
+
+    def confirm(self, expired, now=None):
+        """Put back the expired farmers still online in the database."""
+        previous = dict((record.btc_addr, record) for record in expired)
+        btc_addrs = sorted(previous)
+        for start in range(0, len(btc_addrs), CONFIRM_CHUNK):
+            for record in self.loader(btc_addrs[start:start +
+                                                CONFIRM_CHUNK]):
+                self.wheel.update(record, now)
+                if record.btc_addr in self.wheel.records and \
+                        previous[record.btc_addr].height != record.height:
+                    self.publish("height", record.to_dict())
+
+    def subscribe(self):
+        """New Subscriber and the online snapshot it starts from."""
+        with self._lock:
+            self.expire()
+            subscriber = Subscriber(self.queue_size)
+            self.subscribers.add(subscriber)
+            return subscriber, self.wheel.online(), self.version
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def watermark(self):
+        """
+        Time before which every committed change is in the hub. That is
+        the start of the last sync if other workers write too, changes
+        seen since then are sent again with the next delta.
+
+        """
+        if self.loader is not None and self.resync:
+            return self.synced
+        return time.time()
+
+    def delta(self, token):
+        """
+        Farmers added, changed and removed since a version token, or the
+        full online list if the token is missing or too old to tell.
+
+        """
+        with self._lock:
+            self.expire()
+            changes = self.changelog.since(token) if token else None
+            if changes is None:
+                farmers = [record.to_dict() for record in self.wheel.online()]
+                return {"farmers": farmers, "full": True,
+                        "version": self.changelog.token(self.watermark())}
+            added, changed, removed = [], [], []
+            for btc_addr, (first, _) in sorted(changes.items()):
+                record = self.wheel.records.get(btc_addr)
+                if record is None:
+                    removed.append(btc_addr)
+                elif first == "join":
+                    added.append(record.to_dict())
+                else:
+                    changed.append(record.to_dict())
+            return {"added": added, "changed": changed, "removed": removed,
+                    "full": False,
+                    "version": self.changelog.token(self.watermark())}
+
+
+def format_event(version, event, data):
+    return "id: {0}\nevent: {1}\ndata: {2}\n\n".format(
+        version, event, json.dumps(data))
+
+
+def stream(hub, keepalive):
+    """Server-sent events: a snapshot followed by the changes."""
+    subscriber, snapshot, version = hub.subscribe()
+    try:
+        farmers = [record.to_dict() for record in snapshot]
+        yield format_event(version, "snapshot", {"farmers": farmers})
+        while not subscriber.dropped:
+            events = subscriber.get(keepalive)
+            hub.expire()
+            if not events:
+                yield ": keepalive\n\n"
+            for item in events:
+                yield format_event(*item)
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+_lock = threading.Lock()
+_hub = None
+
+
+def get_hub(loader):
+    """
+    The process wide EventHub, loaded with loader() on first use and
+    resynced every TIMEWHEEL_RESYNC seconds.
+
+    """
+    global _hub
+    with _lock:
+        if _hub is None:
+            def load(btc_addrs=None):
+                with app.app_context():  # also from the event stream
+                    return loader(btc_addrs)
+            hub = EventHub(app.config["ONLINE_TIME"],
+                           app.config["EVENTS_QUEUE_SIZE"],
+                           app.config["CHANGELOG_RETENTION"], load,
+                           app.config["TIMEWHEEL_RESYNC"])
+            hub.load()
+            observe(on_farmer_change)
+            _hub = hub
+        return _hub
+
+
+def reset_hub():
+    global _hub
+    with _lock:
+        _hub = None
+
+
+def on_farmer_change(event, record, previous):
+    hub = _hub
+    if hub is not None:
+        hub.on_farmer_change(event, record, previous)
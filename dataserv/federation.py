@@ -0,0 +1,163 @@
+"""
+Aggregate the online farmers of several dataserv nodes into one network
+view. Peers are queried concurrently with asyncio (Python 3.5+ only).
+
+"""
+import ssl
+import json
+import time
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+async def fetch_json(url, timeout):
+    """GET an url and decode the JSON body, raise on any failure."""
+    parts = urlsplit(url)
+    secure = parts.scheme == "https"
+    port = parts.port or (443 if secure else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    async def get():
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, port, ssl=ssl.create_default_context()
+            if secure else None)
+        try:
+            request = ("GET {0} HTTP/1.0\r\nHost: {1}\r\n"
+                       "Accept: application/json\r\n\r\n")
+            writer.write(request.format(path, parts.netloc).encode("ascii"))
+            return await reader.read()  # HTTP/1.0 closes after the body
+        finally:
+            writer.close()
+
+    response = await asyncio.wait_for(get(), timeout)
+    head, _, body = response.partition(b"\r\n\r\n")
+    status = int(head.split(None, 2)[1])
+    if status != 200:
+        raise ValueError("{0} returned status {1}".format(url, status))
+    return json.loads(body.decode("utf-8"))
+
+
+class PeerResult(object):
+
+    def __init__(self, farmers, fetched):
+        """Last good answer of a peer node."""
+        self.farmers = farmers
+        self.fetched = fetched
+
+
+class Federation(object):
+
+    def __init__(self, peers, timeout, max_age):
+        """
+        Fetches `/api/online/json` from peer nodes and remembers the last
+        good result per peer, so a slow or offline peer keeps contributing
+        its last known farmers for up to max_age seconds.
+
+        """
+        self.peers = [peer.rstrip("/") for peer in peers]
+        self.timeout = timeout
+        self.max_age = max_age
+        self.results = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    async def fetch_peer(self, peer):
+        online = await fetch_json(peer + "/api/online/json", self.timeout)
+        return PeerResult(online["farmers"], time.time())
+
+    async def fetch_all(self):
+        return await asyncio.gather(
+            *[self.fetch_peer(peer) for peer in self.peers],
+            return_exceptions=True
+        )
+
+    def refresh(self):
+        """Query all peers concurrently, keep the last good results."""
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(self.fetch_all())
+        finally:
+            loop.close()
+        with self._lock:
+            for peer, result in zip(self.peers, results):
+                if isinstance(result, Exception):
+                    msg = "Peer {0} failed: {1!r}".format(peer, result)
+                    logger.warning(msg)
+                    self.errors[peer] = repr(result)
+                else:
+                    self.results[peer] = result
+                    self.errors.pop(peer, None)
+
+    def fresh_results(self, now=None):
+        """The results not older than max_age."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return [result for result in self.results.values()
+                    if now - result.fetched <= self.max_age]
+
+    def status(self, now=None):
+        """Per peer state for the network view."""
+        now = time.time() if now is None else now
+        status = []
+        with self._lock:
+            for peer in self.peers:
+                result = self.results.get(peer)
+                age = now - result.fetched if result else None
+                status.append({
+                    "peer": peer,
+                    "ok": peer not in self.errors,
+                    "age": int(age) if result else None,
+                    "expired": result is None or age > self.max_age,
+                    "error": self.errors.get(peer)
+                })
+        return status
+
+    def network_total(self, local_total, local_farmers, byte_size):
+        """
+        The /api/total payload of the merged online lists, so a farmer
+        known to several nodes is counted once.
+
+        """
+        farmers = self.network_farmers(local_farmers)
+        shards = sum(farmer["height"] for farmer in farmers)
+        return {"id": local_total["id"],
+                "total_TB": round(shards * (byte_size / (1024 ** 4)), 2),
+                "total_farmers": len(farmers),
+                "peers": self.status()}
+
+    def network_farmers(self, local_farmers):
+        """
+        Merge the online lists, a farmer known to several nodes is listed
+        once with the most recent entry. Ordered by height like the nodes.
+        Peer results older than max_age are left out.
+
+        """
+        merged = {}
+        lists = [local_farmers] + [r.farmers for r in self.fresh_results()]
+        for farmers in lists:
+            for farmer in farmers:
+                known = merged.get(farmer["btc_addr"])
+                if known is None or farmer["last_seen"] < known["last_seen"]:
+                    merged[farmer["btc_addr"]] = farmer
+        return sorted(merged.values(),
+                      key=lambda f: (-f["height"], f["btc_addr"]))
+
+
+_lock = threading.Lock()
+_federations = {}
+
+
+def get_federation(peers, timeout, max_age):
+    """Shared Federation for a peer list so results survive requests."""
+    key = (tuple(peers), timeout, max_age)
+    with _lock:
+        if key not in _federations:
+            _federations[key] = Federation(peers, timeout, max_age)
+        return _federations[key]
@@ -0,0 +1,375 @@
+"""
+Append-only binary log of the farmer height changes in HEIGHT_LOG_DIR,
+fed by the "height" farmer observer. The farmer table only keeps the
+current height, the log keeps how it got there.
+
+Every process buffers its changes and a background thread appends them
+and fsyncs the segment every HEIGHT_LOG_FLUSH seconds, so a crash loses
+at most that much. Segments are rotated at HEIGHT_LOG_SEGMENT bytes and
+the appends and compactions of all processes are serialized by a lock
+file. Layout, little endian:
+
+    header  magic 8s, version uint32, record size uint32       16 bytes
+    record  btc_addr 36s (NUL padded), epoch seconds uint32,
+            old height uint32, new height uint32              48 bytes
+
+Records are keyed by address, row ids differ between shards and change
+when an archived farmer is revived.
+
+Segments are named by their number, `000000000007.hlog`. Compaction
+rewrites old sealed segments into one, keeping a single change per
+farmer and time bucket, named by the numbers it replaces,
+`000000000001-000000000006.hlog`, which hides those segments even if
+deleting them was interrupted.
+
+    python app.py compact_heights --days 7 --bucket 86400
+
+"""
+import os
+import re
+import mmap
+import time
+import fcntl
+import atexit
+import struct
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from dataserv.run import app
+from dataserv.Farmer import observe
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<36sIII")
+MAGIC = b"DSHEIGHT"
+VERSION = 1
+DAY = 86400
+
+HeightChange = namedtuple("HeightChange", ["btc_addr", "timestamp", "old",
+                                           "new"])
+Segment = namedtuple("Segment", ["first", "last", "path"])
+SEGMENT_NAME = re.compile(r"^(\d{12})(?:-(\d{12}))?\.hlog$")
+
+
+def pack_address(btc_addr):
+    return btc_addr.encode("ascii").ljust(36, b"\0")
+
+
+def pack_change(change):
+    btc_addr, timestamp, old, new = change
+    return RECORD.pack(pack_address(btc_addr), timestamp, old, new)
+
+
+def unpack_change(fields):
+    btc_addr, timestamp, old, new = fields
+    return HeightChange(btc_addr.rstrip(b"\0").decode("ascii"), timestamp,
+                        old, new)
+
+
+def segment_name(first, last=None):
+    if last is None:
+        return "{0:012d}.hlog".format(first)
+    return "{0:012d}-{1:012d}.hlog".format(first, last)
+
+
+def segments(directory):
+    """The visible segments in order, compacted ones hide what they cover."""
+    found = []
+    for name in os.listdir(directory):
+        match = SEGMENT_NAME.match(name)
+        if match:
+            first = int(match.group(1))
+            last = int(match.group(2) or first)
+            found.append(Segment(first, last, os.path.join(directory, name)))
+    found.sort(key=lambda s: (s.first, -s.last))
+    visible = []
+    for segment in found:
+        if not visible or segment.first > visible[-1].last:
+            visible.append(segment)
+    return visible
+
+
+@contextmanager
+def locked(directory):
+    """Exclusive lock of the log directory across processes."""
+    with open(os.path.join(directory, "lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def create_segment(path):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    write_all(fd, HEADER.pack(MAGIC, VERSION, RECORD.size))
+    return fd
+
+
+class HeightLog(object):
+
+    def __init__(self, directory, segment_size, interval):
+        """Buffered appender flushed by a background thread."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.interval = interval
+        self.pending = []
+        self.flushes = 0
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, btc_addr, timestamp, old, new):
+        record = pack_change((btc_addr, int(timestamp), old, new))
+        with self.lock:
+            self.pending.append(record)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:  # keep buffering over disk hiccups
+                logger.exception("Writing the height log failed")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+    def flush(self):
+        """Append and fsync the buffered changes, return how many."""
+        with self.flushing:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return 0
+            data = b"".join(pending)
+            try:
+                with locked(self.directory):
+                    fd = self.open_active(len(data))
+                    try:
+                        write_all(fd, data)
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            except Exception:
+                with self.lock:  # kept for the next flush
+                    self.pending[:0] = pending
+                raise
+            self.flushes += 1
+            return len(pending)
+
+    def open_active(self, size):
+        """Append fd of the last segment, rotated if size does not fit."""
+        found = segments(self.directory)
+        if found and found[-1].first == found[-1].last:
+            active = found[-1]
+            used = os.path.getsize(active.path)
+            if used <= HEADER.size or used + size <= self.segment_size:
+                return os.open(active.path, os.O_WRONLY | os.O_APPEND)
+        number = found[-1].last + 1 if found else 1
+        return create_segment(os.path.join(self.directory,
+                                           segment_name(number)))
+
+
+class HeightLogReader(object):
+
+    def __init__(self, directory):
+        """Memory mapped view of the segments written so far."""
+        self.maps = []
+        for segment in segments(directory):
+            with open(segment.path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size <= HEADER.size:
+                    continue
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, record_size = HEADER.unpack_from(mapped, 0)
+            if magic != MAGIC or record_size != RECORD.size:
+                mapped.close()
+                raise ValueError("Not a height log: {0}".format(
+                    segment.path))
+            # a torn record at the end of a crashed append is ignored
+            count = (size - HEADER.size) // RECORD.size
+            self.maps.append((segment, mapped, HEADER.size +
+                              count * RECORD.size))
+
+    def close(self):
+        for _, mapped, _ in self.maps:
+            mapped.close()
+        self.maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return sum((end - HEADER.size) // RECORD.size
+                   for _, _, end in self.maps)
+
+    def scan(self):
+        """All changes in the order they were written."""
+        for _, mapped, end in self.maps:
+            for offset in range(HEADER.size, end, RECORD.size):
+                yield unpack_change(RECORD.unpack_from(mapped, offset))
+
+    def history(self, btc_addr):
+        """The changes of one farmer, found by searching for its address."""
+        pattern = pack_address(btc_addr)
+        changes = []
+        for _, mapped, end in self.maps:
+            position = mapped.find(pattern, HEADER.size, end)
+            while position != -1:
+                if (position - HEADER.size) % RECORD.size:  # not a key
+                    position = mapped.find(pattern, position + 1, end)
+                    continue
+                changes.append(unpack_change(RECORD.unpack_from(
+                    mapped, position)))
+                position = mapped.find(pattern, position + RECORD.size, end)
+        return changes
+
+
+def merge(changes, bucket, drop_before=None):
+    """One change per farmer and bucket, from the first old height."""
+    merged = {}
+    for change in changes:
+        if drop_before is not None and change.timestamp < drop_before:
+            continue
+        key = (change.btc_addr, change.timestamp // bucket)
+        first = merged.get(key)
+        merged[key] = change if first is None else change._replace(
+            old=first.old)
+    return sorted(merged.values(), key=lambda c: (c.timestamp, c.btc_addr))
+
+
+def compact(directory, before, bucket=DAY, drop_before=None):
+    """
+    Rewrite the leading sealed segments whose changes all happened before
+    the epoch seconds `before` as one, changes before `drop_before` are
+    dropped. Returns (segments replaced, changes read, changes written).
+    The directory stays locked, so concurrent compactions and appends
+    wait for it.
+
+    """
+    with locked(directory):
+        return compact_locked(directory, before, bucket, drop_before)
+
+
+def compact_locked(directory, before, bucket, drop_before):
+    sealed = segments(directory)[:-1]  # not the one appended to
+    chosen = []
+    for segment in sealed:
+        last = last_timestamp(segment.path)
+        if last is not None and last >= before:
+            break
+        chosen.append(segment)
+    if not chosen or (len(chosen) == 1 and chosen[0].first != chosen[0].last
+                      and drop_before is None):
+        return 0, 0, 0
+    read = []
+    for segment in chosen:
+        read.extend(read_segment(segment.path))
+    changes = merge(read, bucket, drop_before)
+
+    path = os.path.join(directory, segment_name(chosen[0].first,
+                                                chosen[-1].last))
+    temporary = path + ".tmp"
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        write_all(fd, HEADER.pack(MAGIC, VERSION, RECORD.size))
+        write_all(fd, b"".join(pack_change(change) for change in changes))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(temporary, path)
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+    for segment in chosen:
+        if segment.path != path:
+            os.remove(segment.path)
+    return len(chosen), len(read), len(changes)
+
+
+def read_segment(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    end = HEADER.size + (len(data) - HEADER.size) // RECORD.size * RECORD.size
+    return [unpack_change(RECORD.unpack_from(data, offset))
+            for offset in range(HEADER.size, end, RECORD.size)]
+
+
+def last_timestamp(path):
+    """Time of the last change in a segment, None if it is empty."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        count = (size - HEADER.size) // RECORD.size
+        if count <= 0:
+            return None
+        f.seek(HEADER.size + (count - 1) * RECORD.size)
+        return unpack_change(RECORD.unpack(f.read(RECORD.size))).timestamp
+
+
+_lock = threading.Lock()
+_logs = {}  # pid: HeightLog, the flush thread is not forked
+
+
+def get_height_log():
+    """The HeightLog of this process or None if HEIGHT_LOG_DIR is unset."""
+    directory = app.config["HEIGHT_LOG_DIR"]
+    if not directory:
+        return None
+    with _lock:
+        log = _logs.get(os.getpid())
+        if log is None or log.directory != directory:
+            if log is not None:
+                log.stop()
+            log = HeightLog(directory, app.config["HEIGHT_LOG_SEGMENT"],
+                            app.config["HEIGHT_LOG_FLUSH"])
+            _logs[os.getpid()] = log
+        return log
+
+
+def stop_height_log():
+    """Flush and forget the HeightLog of this process."""
+    with _lock:
+        log = _logs.pop(os.getpid(), None)
+    if log is not None:
+        log.stop()
+
+
+atexit.register(stop_height_log)
+
+
+def on_farmer_change(event, record, previous):
+    if event != "height" or previous is None or \
+            record.height == previous.height:
+        return
+    log = get_height_log()
+    if log is not None:
+        log.append(record.btc_addr, time.time(), previous.height,
+                   record.height)
+
+
+def install_height_log():
+    """Log the height changes if HEIGHT_LOG_DIR is set at startup."""
+    if app.config["HEIGHT_LOG_DIR"]:
+        observe(on_farmer_change)
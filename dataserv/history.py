@@ -0,0 +1,212 @@
+"""
+Network totals over time. Once per TOTAL_UPDATE epoch a row with the
+online farmer count, their total height and TB and height percentiles is
+written to `network_total`. The hourly and daily rollups containing it
+are recomputed from the epoch rows, so long ranges of /api/total/history
+read a few rollup rows and never the farmer table.
+
+    python app.py history
+
+Run the command from cron every TOTAL_UPDATE minutes or set TOTAL_HISTORY
+for a background thread, in a single worker. An epoch is recorded once.
+
+"""
+import time
+import threading
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import and_, func, select
+from sqlalchemy.exc import IntegrityError
+from dataserv.run import app, db
+from dataserv.Farmer import Farmer
+from dataserv.sharding import get_shards
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+HOUR = 3600
+DAY = 86400
+PERCENTILES = [("height_p50", 0.5), ("height_p90", 0.9), ("height_p99", 0.99)]
+
+
+class NetworkTotal(db.Model):
+    """Totals of the online farmers, means over the epochs in rollups."""
+    __tablename__ = "network_total"
+
+    period = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    start = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    farmers = db.Column(db.Integer)
+    height = db.Column(db.BigInteger)
+    total_tb = db.Column(db.Float)
+    height_p50 = db.Column(db.Integer)
+    height_p90 = db.Column(db.Integer)
+    height_p99 = db.Column(db.Integer)
+    epochs = db.Column(db.Integer)  # rows in a rollup, 1 otherwise
+
+    def to_dict(self):
+        data = {"start": self.start, "total_farmers": self.farmers,
+                "total_height": self.height,
+                "total_TB": round(self.total_tb, 2), "epochs": self.epochs}
+        for name, _ in PERCENTILES:
+            data[name] = getattr(self, name)
+        return data
+
+
+def epoch_period():
+    return app.config["TOTAL_UPDATE"] * 60
+
+
+def periods():
+    """Row lengths in seconds, finest first."""
+    epoch = epoch_period()
+    return [epoch] + [period for period in (HOUR, DAY) if period > epoch]
+
+
+def retention(period):
+    """Seconds rows of this length are kept, None for ever."""
+    if period == epoch_period():
+        return app.config["HISTORY_RETENTION"] * DAY
+    if period < DAY:
+        return app.config["HISTORY_HOURLY_RETENTION"] * DAY
+    return None
+
+
+def online_heights():
+    online_time = timedelta(minutes=app.config["ONLINE_TIME"])
+    table = Farmer.__table__
+    query = select([table.c.height]).where(
+        table.c.last_seen > datetime.utcnow() - online_time)
+
+    def heights(session):
+        return [row[0] or 0 for row in session.execute(query)]
+
+    shards = get_shards()
+    if shards is not None:
+        return [height for result in shards.scatter(heights)
+                for height in result]
+    return heights(db.session)
+
+
+def measure(heights, start):
+    """The epoch row of these farmer heights."""
+    heights = sorted(heights)
+    total = sum(heights)
+    row = {"period": epoch_period(), "start": start,
+           "farmers": len(heights), "height": total,
+           "total_tb": total * (app.config["BYTE_SIZE"] / (1024 ** 4)),
+           "epochs": 1}
+    for name, share in PERCENTILES:
+        index = min(int(len(heights) * share), len(heights) - 1)
+        row[name] = heights[index] if heights else 0
+    return row
+
+
+def rollup(start, period):
+    """Recompute the period row at start from the epoch rows inside it."""
+    table = NetworkTotal.__table__
+    columns = ["farmers", "height", "total_tb"] + [n for n, _ in PERCENTILES]
+    inside = and_(table.c.period == epoch_period(), table.c.start >= start,
+                  table.c.start < start + period)
+    result = db.session.execute(select(
+        [func.count()] + [func.avg(table.c[name]) for name in columns]
+    ).where(inside)).first()
+    db.session.execute(table.delete().where(and_(
+        table.c.period == period, table.c.start == start)))
+    if result[0]:
+        row = {"period": period, "start": start, "epochs": result[0]}
+        for name, mean in zip(columns, result[1:]):
+            mean = float(mean)
+            row[name] = mean if name == "total_tb" else int(round(mean))
+        db.session.execute(table.insert(), row)
+    db.session.commit()
+
+
+def prune(now):
+    """Delete the rows older than their retention, return how many."""
+    table = NetworkTotal.__table__
+    deleted = 0
+    for period in periods():
+        kept = retention(period)
+        if kept is not None:
+            deleted += db.session.execute(table.delete().where(and_(
+                table.c.period == period,
+                table.c.start < now - kept))).rowcount
+    db.session.commit()
+    return deleted
+
+
+def record_totals(now=None):
+    """Record the epoch of now and its rollups, False if it already was."""
+    now = int(time.time() if now is None else now)
+    epoch = epoch_period()
+    start = now - now % epoch
+    try:
+        db.session.execute(NetworkTotal.__table__.insert(),
+                           measure(online_heights(), start))
+        db.session.commit()
+    except IntegrityError:  # another worker or cron was first
+        db.session.rollback()
+        return False
+    for period in periods()[1:]:
+        rollup(start - start % period, period)
+    prune(now)
+    return True
+
+
+def parse_period(resolution):
+    """Period of "epoch", "hour" or "day", None for "auto"."""
+    names = {"auto": None, "epoch": epoch_period(), "hour": HOUR, "day": DAY}
+    if resolution not in names or names[resolution] not in periods() + [None]:
+        raise ValueError("Unknown resolution: {0}".format(resolution))
+    return names[resolution]
+
+
+def choose_period(begin, end, now):
+    """Finest kept row length that covers begin to end in few rows."""
+    limit = app.config["HISTORY_MAX_POINTS"]
+    for period in periods():
+        kept = retention(period)
+        if (kept is None or begin >= now - kept) and \
+                (end - begin) // period <= limit:
+            return period
+    return periods()[-1]
+
+
+def query_history(begin, end, period=None, now=None):
+    """(period, rows) starting in [begin, end), limited to max points."""
+    now = int(time.time() if now is None else now)
+    if period is None:
+        period = choose_period(begin, end, now)
+    rows = NetworkTotal.query.filter(
+        NetworkTotal.period == period, NetworkTotal.start >= begin,
+        NetworkTotal.start < end).order_by(NetworkTotal.start).limit(
+        app.config["HISTORY_MAX_POINTS"]).all()
+    return period, rows
+
+
+def run_history():
+    while True:
+        epoch = epoch_period()
+        time.sleep(epoch - time.time() % epoch + 1)  # into the next epoch
+        try:
+            with app.app_context():
+                record_totals()
+        except Exception:  # keep the job alive over database hiccups
+            logger.exception("Recording the network totals failed")
+
+
+_recorder = []
+
+
+def start_history():
+    """Start the background job once if TOTAL_HISTORY is set."""
+    if not app.config["TOTAL_HISTORY"] or _recorder:
+        return None
+    thread = threading.Thread(target=run_history)
+    thread.daemon = True
+    thread.start()
+    _recorder.append(thread)
+    return thread
@@ -0,0 +1,95 @@
+"""
+Logging setup.
+
+By default records are put on a queue by the request thread and written
+to LOG_FILE by a background thread, so a slow disk never blocks a ping.
+INFO records of the high volume routes (LOG_SAMPLED message templates)
+are only kept for a LOG_SAMPLE_RATE fraction of the requests.
+
+The writer thread belongs to the process that called setup_logging, a
+forked worker has to call it again.
+
+"""
+import sys
+import atexit
+import random
+import logging
+import logging.handlers
+try:
+    from queue import Queue
+except ImportError:  # python 2
+    from Queue import Queue
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(lineno)d: %(message)s"
+
+_listener = []
+_handlers = []
+
+
+class SampleFilter(logging.Filter):
+
+    def __init__(self, templates, rate):
+        """Keep rate of the INFO and lower records of these templates."""
+        logging.Filter.__init__(self)
+        self.templates = tuple(templates)
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not isinstance(record.msg, str):
+            return True
+        if not record.msg.startswith(self.templates):
+            return True
+        return random.random() < self.rate
+
+
+if hasattr(logging.handlers, "QueueHandler"):
+    class LazyQueueHandler(logging.handlers.QueueHandler):
+        """Queue the record as is, the writer thread formats it."""
+
+        def prepare(self, record):
+            return record
+else:  # python 2, no queue
+    LazyQueueHandler = None
+
+
+def create_handler(filename):
+    if filename == "-":
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return handler
+
+
+def stop_logging():
+    """Flush the queue and remove the handlers of setup_logging."""
+    root = logging.getLogger()
+    while _listener:
+        _listener.pop().stop()
+    while _handlers:
+        handler = _handlers.pop()
+        root.removeHandler(handler)
+        handler.close()
+
+
+def setup_logging(config):
+    """Configure the root logger from the LOG_* settings of config."""
+    stop_logging()
+    root = logging.getLogger()
+    root.setLevel(config["LOG_LEVEL"])
+    handler = create_handler(config["LOG_FILE"])
+    if config["LOG_QUEUE"] and LazyQueueHandler is not None:
+        queue = Queue(-1)
+        listener = logging.handlers.QueueListener(queue, handler)
+        listener.start()
+        _listener.append(listener)
+        writer, handler = handler, LazyQueueHandler(queue)
+        _handlers.append(writer)  # closed after the listener stopped
+    handler.addFilter(SampleFilter(config["LOG_SAMPLED"],
+                                   config["LOG_SAMPLE_RATE"]))
+    root.addHandler(handler)
+    _handlers.insert(0, handler)
+
+
+atexit.register(stop_logging)
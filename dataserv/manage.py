@@ -0,0 +1,136 @@
+"""
+Command line of the node, `python app.py <command>` runs it too:
+
+    python -m dataserv.manage db upgrade
+    python -m dataserv.manage populate --count 1000
+
+Flask-Script, Flask-Migrate (alembic) and the commands are only
+imported here, so serving workers start without them.
+
+"""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import time
+from flask.ext.script import Manager
+from flask.ext.migrate import Migrate, MigrateCommand
+from dataserv.run import app, db
+import dataserv.Farmer  # noqa, the models for autogenerate
+from dataserv.population import populate_database
+from dataserv.archive import archive_farmers, engines, table_sizes, vacuum
+from dataserv.history import record_totals
+from dataserv.heightlog import DAY, compact
+from dataserv.snapshot import (CHUNK, node_engine, restore_snapshot,
+                               take_snapshot)
+
+
+manager = Manager(app)
+
+# found from any working directory
+migrate = Migrate(app, db, directory=os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "migrations"))
+manager.add_command('db', MigrateCommand)
+
+
+@manager.option("-n", "--count", dest="count", type=int, default=1000,
+                help="number of farmers")
+@manager.option("-k", "--keys", dest="keys", type=int, default=0,
+                help="number of farmers with a real private key")
+@manager.option("-f", "--key-file", dest="key_file", default=None,
+                help="save the keys as address,wif lines")
+@manager.option("-o", "--online", dest="online", type=float, default=0.05,
+                help="share of the farmers seen within ONLINE_TIME")
+@manager.option("-p", "--processes", dest="processes", type=int,
+                default=None, help="generating processes, default per cpu")
+def populate(count, keys, key_file, online, processes):
+    """Bulk insert synthetic farmers."""
+    begin = time.time()
+    populate_database(count, keys, online, processes, key_file)
+    print("Inserted {0} farmers in {1:.1f}s".format(
+        count, time.time() - begin))
+
+
+@manager.option("-d", "--days", dest="days", type=float, default=None,
+                help="archive farmers offline longer, default ARCHIVE_AFTER")
+@manager.option("-c", "--chunk", dest="chunk", type=int, default=None,
+                help="farmers moved per transaction, default ARCHIVE_CHUNK")
+@manager.option("--vacuum", dest="vacuum_after", action="store_true",
+                default=False, help="vacuum the database afterwards")
+def archive(days, chunk, vacuum_after):
+    """Move long offline farmers to the archive table."""
+    days = app.config["ARCHIVE_AFTER"] if days is None else days
+    chunk = app.config["ARCHIVE_CHUNK"] if chunk is None else chunk
+    before = [table_sizes(engine) for engine in engines()]
+    begin = time.time()
+    moved = archive_farmers(days, chunk)
+    print("Archived {0} farmers offline for more than {1} days in "
+          "{2:.1f}s".format(moved, days, time.time() - begin))
+    if vacuum_after:
+        for engine in engines():
+            vacuum(engine)
+    for engine, sizes in zip(engines(), before):
+        after = table_sizes(engine)
+        print(engine.url)
+        for name in sorted(set(sizes) | set(after)):
+            print("  {0:32} {1:12,d} -> {2:12,d} bytes".format(
+                name, sizes.get(name, 0), after.get(name, 0)))
+
+
+@manager.option("--now", dest="now", type=int, default=None,
+                help="epoch seconds of the recorded epoch, default now")
+def history(now):
+    """Record the network totals of the current TOTAL_UPDATE epoch."""
+    if record_totals(now):
+        print("Recorded the network totals.")
+    else:
+        print("The network totals of this epoch were already recorded.")
+
+
+@manager.option("-d", "--days", dest="days", type=float, default=7,
+                help="compact segments with changes older than days only")
+@manager.option("-b", "--bucket", dest="bucket", type=int, default=DAY,
+                help="seconds of changes merged into one per farmer")
+@manager.option("--drop-days", dest="drop_days", type=float, default=None,
+                help="drop the changes older than days")
+def compact_heights(days, bucket, drop_days):
+    """Rewrite old height log segments with fewer changes."""
+    directory = app.config["HEIGHT_LOG_DIR"]
+    if not directory:
+        print("HEIGHT_LOG_DIR is not set.")
+        return
+    now = time.time()
+    drop_before = None if drop_days is None else int(now - drop_days * DAY)
+    replaced, read, written = compact(directory, int(now - days * DAY),
+                                      bucket, drop_before)
+    print("Compacted {0} segments, {1} -> {2} changes".format(
+        replaced, read, written))
+
+
+@manager.option("-f", "--file", dest="path", required=True,
+                help="snapshot file to write")
+@manager.option("-c", "--chunk", dest="chunk", type=int, default=CHUNK,
+                help="rows per compressed chunk")
+def snapshot(path, chunk):
+    """Write the farmer tables to a snapshot file."""
+    begin = time.time()
+    counts = take_snapshot(node_engine(), path, chunk)
+    print("Wrote {0} in {1:.1f}s, {2} bytes".format(
+        ", ".join("{0} {1}".format(n, c) for n, c in sorted(counts.items())),
+        time.time() - begin, os.path.getsize(path)))
+
+
+@manager.option("-f", "--file", dest="path", required=True,
+                help="snapshot file to load")
+@manager.option("--replace", dest="replace", action="store_true",
+                default=False, help="delete the farmers of this node first")
+def restore(path, replace):
+    """Load a snapshot file into the farmer tables."""
+    begin = time.time()
+    counts = restore_snapshot(node_engine(), path, replace)
+    print("Restored {0} in {1:.1f}s".format(
+        ", ".join("{0} {1}".format(n, c) for n, c in sorted(counts.items())),
+        time.time() - begin))
+
+if __name__ == '__main__':
+    manager.run()
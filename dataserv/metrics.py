@@ -0,0 +1,286 @@
+"""
+Request metrics in the Prometheus text format.
+
+Every request adds its latency to a histogram per route and method and
+counts its status code. SQLAlchemy cursor events count the statements
+and database time of the request, `authenticate` reports its signature
+checks and the view cache its hits and misses.
+
+Values are kept per process. With several workers set METRICS_DIR to a
+directory they share (emptied before the workers start), every worker
+writes its values to a file of its own at most every METRICS_FLUSH
+seconds and /metrics sums all files.
+
+"""
+import os
+import json
+import time
+import glob
+import threading
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flask import request
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIGNATURE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    "dataserv_requests_total": (
+        "counter", "Requests by route, method and status code.", None),
+    "dataserv_request_seconds": (
+        "histogram", "Request latency by route and method.",
+        LATENCY_BUCKETS),
+    "dataserv_db_statements_total": (
+        "counter", "Database statements run by requests, by route.", None),
+    "dataserv_db_seconds_total": (
+        "counter", "Seconds spent in database statements, by route.", None),
+    "dataserv_request_db_statements": (
+        "histogram", "Database statements per request by route.",
+        STATEMENT_BUCKETS),
+    "dataserv_signature_seconds": (
+        "histogram", "Signature verifications by result.",
+        SIGNATURE_BUCKETS),
+    "dataserv_cache_requests_total": (
+        "counter", "View cache lookups by view and result.", None),
+}
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = (lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"')
+              .replace("\n", "\\n"))
+    return "{" + ",".join('{0}="{1}"'.format(k, escape(v))
+                          for k, v in labels) + "}"
+
+
+class Registry(object):
+
+    def __init__(self):
+        """Counters and histograms of this process."""
+        self.counters = {}  # (name, labels): value
+        self.histograms = {}  # (name, labels): [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(buckets), 0.0, 0]
+                self.histograms[key] = histogram
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        """JSON serializable copy of the values."""
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels),
+                             value in self.counters.items()],
+                "histograms": [[name, list(labels), list(counts), total,
+                                count] for (name, labels), (counts, total,
+                                count) in self.histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        """Add the values of a snapshot, for example of another worker."""
+        for name, labels, value in snapshot["counters"]:
+            self.inc(name, tuple(tuple(label) for label in labels), value)
+        with self._lock:
+            for name, labels, counts, total, count in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = self.histograms.setdefault(
+                    key, [[0] * len(counts), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted(METRICS):
+                kind, help_text, buckets = METRICS[name]
+                lines.append("# HELP {0} {1}".format(name, help_text))
+                lines.append("# TYPE {0} {1}".format(name, kind))
+                if kind == "counter":
+                    for (metric, labels), value in sorted(
+                            self.counters.items()):
+                        if metric == name:
+                            lines.append("{0}{1} {2}".format(
+                                name, format_labels(labels),
+                                format_value(value)))
+                    continue
+                for (metric, labels), (counts, total, count) in sorted(
+                        self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket in zip(buckets + (float("inf"),),
+                                             counts + [count - sum(counts)]):
+                        cumulative += bucket
+                        lines.append("{0}_bucket{1} {2}".format(
+                            name, format_labels(labels + (
+                                ("le", format_value(bound)),)), cumulative))
+                    lines.append("{0}_sum{1} {2}".format(
+                        name, format_labels(labels), format_value(total)))
+                    lines.append("{0}_count{1} {2}".format(
+                        name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+_request = threading.local()  # route, start, statements, db_time
+_flushed = [0.0]
+_worker_file = None
+_installed = []
+
+
+def observe_signature(seconds, valid):
+    registry.observe("dataserv_signature_seconds",
+                     (("result", "valid" if valid else "invalid"),), seconds)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault("metrics_start", []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = conn.info["metrics_start"].pop()
+    if getattr(_request, "start", None) is not None:
+        _request.statements += 1
+        _request.db_time += time.time() - start
+
+
+def handle_error(context):
+    # failed statements skip after_cursor_execute
+    if context.connection is not None:
+        starts = context.connection.info.get("metrics_start")
+        if starts:
+            starts.pop()
+
+
+def before_request():
+    _request.start = time.time()
+    _request.statements = 0
+    _request.db_time = 0.0
+
+
+def record(status):
+    start = getattr(_request, "start", None)
+    if start is None:
+        return  # already recorded
+    _request.start = None
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    route = (("route", rule),)
+    labels = route + (("method", request.method),)
+    registry.observe("dataserv_request_seconds", labels, time.time() - start)
+    registry.inc("dataserv_requests_total", labels + (("status", status),))
+    registry.inc("dataserv_db_statements_total", route, _request.statements)
+    registry.inc("dataserv_db_seconds_total", route, _request.db_time)
+    registry.observe("dataserv_request_db_statements", route,
+                     _request.statements)
+
+
+def after_request(response):
+    record(response.status_code)
+    return response
+
+
+def teardown_request(exc):
+    if exc is not None:
+        record(500)  # unhandled exceptions skip after_request
+
+
+def count_cache_lookups(backend):
+    """Count hits and misses of the view cache backend."""
+    get = backend.get
+
+    def counting_get(key):
+        value = get(key)
+        view = key[len("view/"):] if key.startswith("view/") else key
+        result = "miss" if value is None else "hit"
+        registry.inc("dataserv_cache_requests_total",
+                     (("view", view), ("result", result)))
+        return value
+    backend.get = counting_get
+
+
+def flush(directory, max_age):
+    """Write the values of this process to its file in directory."""
+    global _worker_file
+    now = time.time()
+    if now - _flushed[0] < max_age:
+        return
+    _flushed[0] = now
+    if _worker_file is None:
+        _worker_file = os.path.join(directory, "{0}-{1}.json".format(
+            os.getpid(), int(now * 1000)))
+    tmp_path = _worker_file + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(registry.snapshot(), f)
+    os.rename(tmp_path, _worker_file)
+
+
+def exposition(app):
+    """All metrics as text, summed over the workers if configured."""
+    directory = app.config["METRICS_DIR"]
+    if not directory:
+        return registry.render()
+    flush(directory, 0)
+    total = Registry()
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            with open(path) as f:
+                total.merge(json.load(f))
+        except (IOError, OSError, ValueError):
+            continue  # worker file vanished or half written
+    return total.render()
+
+
+def instrument(app, cache):
+    """Install the request, database and cache hooks once."""
+    if _installed:
+        return
+    _installed.append(True)
+    directory = app.config["METRICS_DIR"]
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(Engine, "handle_error", handle_error)
+    app.before_request(before_request)
+
+    def after(response):
+        after_request(response)
+        if directory:
+            flush(directory, app.config["METRICS_FLUSH"])
+        return response
+    app.after_request(after)
+    app.teardown_request(teardown_request)
+    count_cache_lookups(app.extensions["cache"][cache])
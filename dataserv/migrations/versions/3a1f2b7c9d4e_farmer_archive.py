@@ -0,0 +1,46 @@
+"""farmer archive table
+
+Revision ID: 3a1f2b7c9d4e
+Revises: 14d4ac0f0f1
+Create Date: 2026-10-19 10:12:41.318207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1f2b7c9d4e'
+down_revision = '14d4ac0f0f1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('farmer_archive',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('btc_addr', sa.String(length=35), nullable=True),
+    sa.Column('payout_addr', sa.String(length=35), nullable=True),
+    sa.Column('height', sa.Integer(), nullable=True),
+    sa.Column('last_seen', sa.DateTime(), nullable=True),
+    sa.Column('reg_time', sa.DateTime(), nullable=True),
+    sa.Column('uptime', sa.Integer(), nullable=True),
+    sa.Column('archived', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('btc_addr')
+    )
+
+
+def downgrade():
+    # keep the archived registrations with their ids, reg_time and uptime
+    # as far as the farmer table has them, `archived` is lost
+    existing = set(column["name"] for column in
+                   sa.inspect(op.get_bind()).get_columns('farmer'))
+    columns = ", ".join(name for name in
+                        ["btc_addr", "payout_addr", "height", "last_seen",
+                         "reg_time", "uptime"] if name in existing)
+    op.execute("INSERT INTO farmer (id, {0}) SELECT id, {0} "
+               "FROM farmer_archive WHERE id NOT IN (SELECT id FROM farmer)"
+               .format(columns))
+    op.execute("INSERT INTO farmer ({0}) SELECT {0} FROM farmer_archive "
+               "WHERE btc_addr NOT IN (SELECT btc_addr FROM farmer)"
+               .format(columns))
+    op.drop_table('farmer_archive')
@@ -0,0 +1,26 @@
+"""epoch times
+
+Revision ID: 5c8e0d6a2b71
+Revises: 3a1f2b7c9d4e
+Create Date: 2026-10-19 14:03:27.516830
+
+Stores the farmer times as integer epoch seconds if EPOCH_TIMES is set,
+see dataserv.epochtime.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c8e0d6a2b71'
+down_revision = '3a1f2b7c9d4e'
+
+from alembic import op
+from flask import current_app
+from dataserv.epochtime import convert
+
+
+def upgrade():
+    convert(op, current_app.config["EPOCH_TIMES"])
+
+
+def downgrade():
+    convert(op, False)
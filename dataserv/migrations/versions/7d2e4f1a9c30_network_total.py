@@ -0,0 +1,33 @@
+"""network total history
+
+Revision ID: 7d2e4f1a9c30
+Revises: 5c8e0d6a2b71
+Create Date: 2026-10-19 16:40:12.204517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d2e4f1a9c30'
+down_revision = '5c8e0d6a2b71'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('network_total',
+    sa.Column('period', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('start', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('farmers', sa.Integer(), nullable=True),
+    sa.Column('height', sa.BigInteger(), nullable=True),
+    sa.Column('total_tb', sa.Float(), nullable=True),
+    sa.Column('height_p50', sa.Integer(), nullable=True),
+    sa.Column('height_p90', sa.Integer(), nullable=True),
+    sa.Column('height_p99', sa.Integer(), nullable=True),
+    sa.Column('epochs', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('period', 'start')
+    )
+
+
+def downgrade():
+    op.drop_table('network_total')
@@ -0,0 +1,169 @@
+"""
+Synthetic farmer populations for load tests and benchmarks.
+
+    python app.py populate --count 1000000 --keys 1000 \
+        --key-file keys.csv
+
+Every farmer gets a valid bitcoin address, a heavy tailed height, a
+registration date and a `last_seen` spread where `--online` of them pinged
+within ONLINE_TIME. Deriving a key pair costs tens of milliseconds in pure
+python, so only the first `--keys` farmers get a real private key, saved
+as `address,wif` lines for clients that need to sign headers. The other
+addresses are made from random hashes, valid but without a known key.
+
+Chunks are generated by a pool of processes and written as they arrive,
+with COPY on PostgreSQL and executemany otherwise.
+
+"""
+import os
+import csv
+import random
+import multiprocessing
+from datetime import datetime
+from datetime import timedelta
+from btctxstore import BtcTxStore
+from pycoin.encoding import hash160_sec_to_bitcoin_address
+from dataserv.run import app, db
+from dataserv.Farmer import Farmer
+from dataserv.sharding import get_shards, shard_index
+try:
+    from cStringIO import StringIO  # python 2, csv writes byte strings
+except ImportError:
+    from io import StringIO
+
+
+CHUNK = 10000
+COLUMNS = ["btc_addr", "payout_addr", "height", "last_seen", "reg_time",
+           "uptime"]
+
+
+def random_address():
+    """Valid bitcoin address of a random hash, nobody holds its key."""
+    return hash160_sec_to_bitcoin_address(os.urandom(20))
+
+
+def new_key():
+    """(address, wif) of a new private key."""
+    btctxstore = BtcTxStore()
+    wif = btctxstore.create_key()
+    return btctxstore.get_address(wif), wif
+
+
+def random_farmer(btc_addr, now, online, online_time, height_limit):
+    if random.random() < online:
+        last_seen = now - timedelta(seconds=random.uniform(0, online_time))
+    else:  # gone for a few days on average
+        last_seen = now - timedelta(seconds=online_time +
+                                    random.expovariate(1.0 / (86400 * 3)))
+    reg_time = last_seen - timedelta(seconds=60 + random.expovariate(
+        1.0 / (86400 * 60)))
+    registered = (last_seen - reg_time).total_seconds()
+    # most farmers share little, a few share a lot (80/20)
+    height = min(int(random.paretovariate(1.16) * 50) - 50, height_limit)
+    return {
+        "btc_addr": btc_addr, "payout_addr": btc_addr, "height": height,
+        "last_seen": last_seen, "reg_time": reg_time,
+        "uptime": int(registered * random.uniform(0.3, 1.0)),
+    }
+
+
+def generate_chunk(args):
+    """Farmer rows and keys of one chunk, run in a worker process."""
+    size, keys, now, online, online_time, height_limit = args
+    random.seed()  # forked workers would share the parent state
+    key_pairs = [new_key() for _ in range(keys)]
+    addresses = [address for address, _ in key_pairs]
+    addresses += [random_address() for _ in range(size - keys)]
+    rows = [random_farmer(btc_addr, now, online, online_time, height_limit)
+            for btc_addr in addresses]
+    return rows, key_pairs
+
+
+def chunk_arguments(count, keys, online):
+    now = datetime.utcnow()
+    online_time = app.config["ONLINE_TIME"] * 60
+    for start in range(0, count, CHUNK):
+        size = min(CHUNK, count - start)
+        chunk_keys = max(0, min(size, keys - start))
+        yield (size, chunk_keys, now, online, online_time,
+               app.config["HEIGHT_LIMIT"])
+
+
+def copy_rows(engine, table, rows):
+    """Bulk load rows with PostgreSQL COPY."""
+    # COPY skips the column types, convert epoch second times here
+    processors = [(column, table.c[column].type.bind_processor(
+        engine.dialect)) for column in COLUMNS]
+    data = StringIO()
+    writer = csv.writer(data)
+    for row in rows:
+        writer.writerow([row[column] if processor is None else
+                         processor(row[column])
+                         for column, processor in processors])
+    data.seek(0)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH CSV".format(
+            table.name, ", ".join(COLUMNS)), data)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def insert_rows(engine, table, rows):
+    if engine.dialect.name == "postgresql":
+        copy_rows(engine, table, rows)
+    else:
+        with engine.begin() as connection:
+            connection.execute(table.insert(), rows)
+
+
+def store(rows):
+    """Write rows to the database, or to their shards if configured."""
+    table = Farmer.__table__
+    shards = get_shards()
+    if shards is None:
+        insert_rows(db.engine, table, rows)
+        return
+    parts = [[] for _ in range(len(shards))]
+    for row in rows:
+        parts[shard_index(row["btc_addr"], len(shards))].append(row)
+    for engine, part in zip(shards.engines, parts):
+        if part:
+            insert_rows(engine, table, part)
+
+
+def generate(count, keys=0, online=0.05, processes=None):
+    """
+    Yield the chunks of a new population as (rows, key pairs), generated
+    by a pool of processes.
+
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        arguments = chunk_arguments(count, keys, online)
+        for chunk in pool.imap(generate_chunk, arguments):
+            yield chunk
+    finally:
+        pool.terminate()
+
+
+def populate_database(count, keys=0, online=0.05, processes=None,
+                      key_file=None):
+    """Insert count synthetic farmers, return their addresses."""
+    addresses = []
+    writer = None
+    out = open(key_file, "w") if key_file else None
+    try:
+        if out is not None:
+            writer = csv.writer(out)
+        for rows, key_pairs in generate(count, keys, online, processes):
+            store(rows)
+            addresses.extend(row["btc_addr"] for row in rows)
+            if writer is not None:
+                writer.writerows(key_pairs)
+    finally:
+        if out is not None:
+            out.close()
+    return addresses
@@ -0,0 +1,121 @@
+"""
+cProfile of live requests.
+
+A PROFILE_RATE fraction of the requests, and every request sent with an
+`X-Profile` header signed by ADMIN_ADDRESS, runs under cProfile. The
+stats are summed per route and written to PROFILE_DIR as
+`<route>.<pid>.prof` in the pstats format, at most every PROFILE_DUMP
+seconds per route and right away for admin requests. Open them with
+`snakeviz`, `python -m pstats` or turn them into a flame graph with
+`flameprof`.
+
+The hooks are only installed if profiling is configured at startup, so
+a disabled profiler costs nothing.
+
+"""
+import os
+import re
+import time
+import random
+import pstats
+import cProfile
+import threading
+from flask import request
+from dataserv.admin import is_admin
+
+
+def route_name(rule):
+    """File name friendly route, `/api/ping/<btc_addr>` -> `api_ping_btc_addr`"""
+    name = re.sub(r"[^A-Za-z0-9]+", "_", rule).strip("_")
+    return name or "index"
+
+
+class RouteProfiles(object):
+
+    def __init__(self):
+        """Profile stats summed per route."""
+        self.stats = {}  # route: pstats.Stats
+        self.dumped = {}  # route: time of the last dump
+        self._lock = threading.Lock()
+
+    def add(self, route, profile):
+        with self._lock:
+            if route in self.stats:
+                self.stats[route].add(profile)
+            else:
+                self.stats[route] = pstats.Stats(profile)
+
+    def path(self, route, directory):
+        return os.path.join(directory, "{0}.{1}.prof".format(
+            route_name(route), os.getpid()))
+
+    def dump(self, route, directory, max_age=0):
+        """Write the stats of a route if the last dump is max_age old."""
+        with self._lock:
+            now = time.time()
+            if route not in self.stats:
+                return None
+            if now - self.dumped.get(route, 0) < max_age:
+                return None
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = self.path(route, directory)
+            self.stats[route].dump_stats(path)
+            self.dumped[route] = now
+            return path
+
+
+profiles = RouteProfiles()
+_request = threading.local()  # profile, admin
+_installed = []
+
+
+def wanted(app):
+    """Profile this request? Only signed admin requests are forced."""
+    if "X-Profile" in request.headers and is_admin(dict(request.headers)):
+        return True, True
+    rate = app.config["PROFILE_RATE"]
+    return bool(rate) and random.random() < rate, False
+
+
+def profile_requests(app):
+    """Install the profiling hooks if profiling is configured."""
+    if not app.config["PROFILE_RATE"] and not app.config["ADMIN_ADDRESS"]:
+        return False
+    if _installed:
+        return True
+    _installed.append(app)
+
+    def before_request():
+        profile, admin = wanted(app)
+        _request.admin = admin
+        _request.profile = cProfile.Profile() if profile else None
+        if profile:
+            _request.profile.enable()
+
+    def after_request(response):
+        profile = getattr(_request, "profile", None)
+        if profile is None:
+            return response
+        profile.disable()
+        _request.profile = None
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        profiles.add(route, profile)
+        directory = app.config["PROFILE_DIR"]
+        if _request.admin:
+            path = profiles.dump(route, directory)
+            response.headers["X-Profile"] = os.path.basename(path)
+        else:
+            profiles.dump(route, directory, app.config["PROFILE_DUMP"])
+        return response
+
+    def teardown_request(exc):
+        profile = getattr(_request, "profile", None)
+        if profile is not None:  # the request failed before after_request
+            profile.disable()
+            _request.profile = None
+
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    return True
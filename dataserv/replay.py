@@ -0,0 +1,117 @@
+"""
+Replay protection for the authentication headers.
+
+storjcore accepts a signed header set for AUTHENTICATION_TIMEOUT seconds
+around its Date, so the same headers could be sent again and again, each
+time costing a full signature verification. The guard remembers every
+accepted header set until its Date falls out of that window and rejects
+it before the signature is checked again.
+
+The signature only covers the node address and the one second Date, so
+the key also holds the method and path of the request: a farmer may send
+a ping and a height update signed in the same second, only the very same
+request is refused. Off unless REPLAY_PROTECTION is set.
+
+Entries are 64 bit integers taken from a sha256 digest of the sender,
+the request and the headers, grouped in buckets of REPLAY_BUCKET seconds of header Date.
+A bucket is dropped as a whole once all of its dates have timed out, so
+memory is bounded by the accepted requests per timeout window and not by
+uptime. The guard is per process, a header set may still be accepted once
+by each worker process.
+
+"""
+import hashlib
+import threading
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from flask import has_request_context, request
+from dataserv.run import app
+
+
+def request_target():
+    """`METHOD path` of the current Flask request, "" outside of one."""
+    if not has_request_context():
+        return ""
+    return "{0} {1}".format(request.method, request.path)
+
+
+def header_time(headers):
+    """Timestamp of the Date header, None if missing or malformed."""
+    try:
+        return mktime_tz(parsedate_tz(headers.get("Date")))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class ReplayGuard(object):
+
+    def __init__(self, timeout, width=5):
+        """
+        Remembers header sets valid for timeout seconds around their
+        Date, in buckets of width seconds.
+
+        """
+        self.timeout = timeout
+        self.width = width
+        self.buckets = {}  # bucket index: set of keys
+        self._lock = threading.Lock()
+
+    def key(self, sender, headers, target):
+        content = "{0} {1} {2} {3}".format(sender, target, headers.get("Date"),
+                                           headers.get("Authorization"))
+        return int(hashlib.sha256(content.encode("utf-8")).hexdigest()[:16],
+                   16)
+
+    def expire(self, now):
+        """Drop the buckets whose dates can no longer be accepted."""
+        oldest = int((now - self.timeout) // self.width)
+        for index in [index for index in self.buckets if index < oldest]:
+            del self.buckets[index]
+
+    def seen(self, sender, headers, now, target=""):
+        """True if this header set was already accepted for target."""
+        key = self.key(sender, headers, target)
+        with self._lock:
+            self.expire(now)
+            for bucket in self.buckets.values():
+                if key in bucket:
+                    return True
+        return False
+
+    def add(self, sender, headers, now, target=""):
+        """
+        Remember an accepted header set, False if it was already there,
+        for example because a concurrent request used the same headers.
+
+        """
+        date = header_time(headers)
+        if date is None:
+            return True  # verify_headers rejects it anyway
+        key = self.key(sender, headers, target)
+        with self._lock:
+            self.expire(now)
+            for bucket in self.buckets.values():
+                if key in bucket:
+                    return False
+            self.buckets.setdefault(int(date // self.width), set()).add(key)
+        return True
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(bucket) for bucket in self.buckets.values())
+
+
+_lock = threading.Lock()
+_guards = {}
+
+
+def get_guard():
+    """The process wide ReplayGuard, None if replay protection is off."""
+    if not app.config["REPLAY_PROTECTION"]:
+        return None
+    settings = (app.config["AUTHENTICATION_TIMEOUT"],
+                app.config["REPLAY_BUCKET"])
+    with _lock:
+        if settings not in _guards:
+            _guards[settings] = ReplayGuard(*settings)
+        return _guards[settings]
@@ -1,17 +1,67 @@
+import threading
+from contextlib import contextmanager
 from flask import Flask
+from sqlalchemy.pool import NullPool, QueuePool
 from flask.ext.cache import Cache
-from flask.ext.sqlalchemy import SQLAlchemy
-from flask.ext.script import Manager
-from flask.ext.migrate import Migrate, MigrateCommand
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from dataserv.logs import setup_logging
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends queries to the read replica when asked to."""
+
+    def get_bind(self, mapper=None, clause=None):
+        db = get_state(self.app).db
+        if db.use_replica():
+            return db.get_engine(self.app, bind="replica")
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class DataservSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy integration with pool tuning and read replica routing."""
+
+    def __init__(self, *args, **kwargs):
+        self._routing = threading.local()
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        pooled = info.drivername == "sqlite" and app.config.get("SQLITE_WAL")
+        if info.drivername == "sqlite" and not pooled:  # no sized pool
+            for key in ("pool_size", "max_overflow", "pool_timeout"):
+                options.pop(key, None)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if pooled and options.get("poolclass") is NullPool:
+            # keep the connections and their page cache, WAL lets the
+            # pooled connections read while another one writes
+            options["poolclass"] = QueuePool
+            options.setdefault("connect_args", {})["check_same_thread"] = False
+        if app.config.get("SQLALCHEMY_POOL_PRE_PING"):
+            options["pool_pre_ping"] = True
+
+    def use_replica(self):
+        """True if the current thread reads from a configured replica."""
+        binds = self.get_app().config.get("SQLALCHEMY_BINDS") or ()
+        return getattr(self._routing, "replica", False) and "replica" in binds
+
+    @contextmanager
+    def replica(self):
+        """Route the queries made inside the block to the read replica."""
+        previous = getattr(self._routing, "replica", False)
+        self._routing.replica = True
+        try:
+            yield
+        finally:
+            self._routing.replica = previous
+
 
 # Initialize the Flask application
 cache = Cache(config={'CACHE_TYPE': 'simple'})
 
 app = Flask(__name__)
 app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+setup_logging(app.config)
+db = DataservSQLAlchemy(app)
 cache.init_app(app)
-
-migrate = Migrate(app, db)
-manager = Manager(app)
-manager.add_command('db', MigrateCommand)
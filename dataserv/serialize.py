@@ -0,0 +1,89 @@
+"""
+Farmer payloads encoded once and joined straight into response bodies,
+instead of dumping, loading and encoding every farmer again.
+
+"""
+import json
+import threading
+from datetime import datetime
+from dataserv.run import app
+from dataserv.epochtime import uptime_percent
+
+try:  # optional faster encoder
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def dumps(obj):
+    """Encode with ujson when available and enabled."""
+    if ujson is not None and app.config["FAST_JSON"]:
+        return ujson.dumps(obj)
+    return json.dumps(obj)
+
+
+class FragmentCache(object):
+
+    def __init__(self):
+        """
+        Pre-encoded JSON of the farmer fields that only change on a height
+        or payout update. The time dependent last_seen and uptime fields
+        are appended per response, so unchanged farmers are not encoded
+        again between refreshes. Only farmers of the last render are kept.
+
+        """
+        self.fragments = {}  # btc_addr -> ((payout_addr, height), fragment)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def fragment(self, btc_addr, payout_addr, height, fragments):
+        key = (payout_addr, height)
+        cached = fragments.get(btc_addr)
+        if cached is not None and cached[0] == key:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        encoded = dumps({"btc_addr": btc_addr, "payout_addr": payout_addr,
+                         "height": height})
+        return key, encoded[:-1]  # left open for the dynamic fields
+
+    def render(self, farmers, now=None):
+        """The /api/online/json body for a list of farmers."""
+        now = now or datetime.utcnow()
+        parts = []
+        with self._lock:
+            fragments = {}
+            for farmer in farmers:
+                cached = self.fragment(farmer.btc_addr, farmer.payout_addr,
+                                       farmer.height, self.fragments)
+                fragments[farmer.btc_addr] = cached
+                parts.append('{0}, "last_seen": {1}, "uptime": {2!r}}}'.format(
+                    cached[1], (now - farmer.last_seen).seconds,
+                    farmer.calculate_uptime()))
+            self.fragments = fragments
+        return '{"farmers": [' + ", ".join(parts) + ']}'
+
+    def render_rows(self, rows, now):
+        """
+        The /api/online/json body for rows in FarmerRecord field order
+        with epoch second times, now in epoch seconds too.
+
+        """
+        online_time = app.config["ONLINE_TIME"] * 60
+        parts = []
+        with self._lock:
+            fragments = {}
+            for _, btc_addr, payout_addr, height, last_seen, reg_time, \
+                    uptime in rows:
+                cached = self.fragment(btc_addr, payout_addr, height,
+                                       self.fragments)
+                fragments[btc_addr] = cached
+                parts.append('{0}, "last_seen": {1}, "uptime": {2!r}}}'.format(
+                    cached[1], now - last_seen, uptime_percent(
+                        now, reg_time, last_seen, uptime, online_time)))
+            self.fragments = fragments
+        return '{"farmers": [' + ", ".join(parts) + ']}'
+
+
+online_fragments = FragmentCache()
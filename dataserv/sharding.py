@@ -0,0 +1,103 @@
+import heapq
+import hashlib
+import threading
+import sqlalchemy
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from multiprocessing.pool import ThreadPool
+from dataserv.run import app, db
+
+
+_lock = threading.Lock()
+_shard_sets = {}
+
+
+def shard_index(btc_addr, count):
+    """Stable shard number for a bitcoin address."""
+    digest = hashlib.sha256(btc_addr.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+def create_engine(uri):
+    """Create an engine with the same pool settings as the main database."""
+    info = make_url(uri)
+    options = {'convert_unicode': True}
+    db.apply_pool_defaults(app, options)
+    db.apply_driver_hacks(app, info, options)
+    return sqlalchemy.create_engine(info, **options)
+
+
+class ShardSet(object):
+
+    def __init__(self, uris):
+        """
+        Farmers spread over several databases by a hash of their bitcoin
+        address. Every shard holds a complete `farmer` table of its own.
+
+        """
+        self.uris = list(uris)
+        self.engines = [create_engine(uri) for uri in self.uris]
+        self.factories = [sessionmaker(bind=engine)
+                          for engine in self.engines]
+        self.sessions = [scoped_session(factory)
+                         for factory in self.factories]
+        self.pool = ThreadPool(len(self.uris))
+
+    def __len__(self):
+        return len(self.uris)
+
+    def session_for(self, btc_addr):
+        """Request scoped session of the shard owning the address."""
+        return self.sessions[shard_index(btc_addr, len(self))]
+
+    def remove_sessions(self):
+        for session in self.sessions:
+            session.remove()
+
+    def create_all(self):
+        for engine in self.engines:
+            db.Model.metadata.create_all(engine)
+
+    def drop_all(self):
+        for engine in self.engines:
+            db.Model.metadata.drop_all(engine)
+
+    def scatter(self, query):
+        """Run query(session) on every shard concurrently."""
+        def run(factory):
+            session = factory()
+            try:
+                return query(session)
+            finally:
+                session.close()
+        return self.pool.map(run, self.factories)
+
+    def gather_sorted(self, query, key):
+        """
+        Scatter a query whose per shard results are already ordered by key
+        and k-way merge them into one ordered list.
+
+        """
+        decorated = []
+        for shard, results in enumerate(self.scatter(query)):
+            decorated.append([(key(row), shard, row) for row in results])
+        return [row for _, _, row in heapq.merge(*decorated)]
+
+
+def get_shards():
+    """The configured ShardSet or None if sharding is disabled."""
+    uris = tuple(app.config.get("SHARD_DATABASE_URIS") or ())
+    if not uris:
+        return None
+    with _lock:
+        if uris not in _shard_sets:
+            _shard_sets[uris] = ShardSet(uris)
+        return _shard_sets[uris]
+
+
+@app.teardown_appcontext
+def remove_shard_sessions(response_or_exc):
+    shards = get_shards()
+    if shards is not None:
+        shards.remove_sessions()
+    return response_or_exc
@@ -0,0 +1,169 @@
+"""
+Online farmers in a memory mapped file shared by all worker processes.
+
+One worker at a time refreshes the table from the database, every other
+worker reads it without taking a lock. Writes are guarded by a seqlock:
+the generation counter is odd while the records are being replaced, and
+readers retry if it was odd or changed while they copied the records.
+
+Layout, little endian:
+
+    header  generation uint64, count uint64, refreshed float64,
+            capacity uint64                                  32 bytes
+    record  id uint32, btc_addr 35s, payout_addr 35s, height uint32,
+            last_seen float64, reg_time float64, uptime uint64 102 bytes
+
+so the table needs 102 bytes per farmer, 10.2 MB (9.7 MiB) for 100k
+online farmers. The file only grows, by doubling, if it is too small.
+
+"""
+import os
+import time
+import mmap
+import fcntl
+import struct
+import calendar
+import threading
+from datetime import datetime
+from dataserv.Farmer import FarmerRecord
+
+
+HEADER = struct.Struct("<QQdQ")
+RECORD = struct.Struct("<I35s35sIddQ")
+
+
+def to_timestamp(when):
+    return calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
+
+
+def from_timestamp(timestamp):
+    return datetime.utcfromtimestamp(timestamp)
+
+
+def pack(record):
+    return RECORD.pack(record.id, record.btc_addr.encode("ascii"),
+                       record.payout_addr.encode("ascii"), record.height,
+                       to_timestamp(record.last_seen),
+                       to_timestamp(record.reg_time), record.uptime)
+
+
+def unpack(buf, offset):
+    (id, btc_addr, payout_addr, height, last_seen,
+     reg_time, uptime) = RECORD.unpack_from(buf, offset)
+    return FarmerRecord(id, btc_addr.rstrip(b"\0").decode("ascii"),
+                        payout_addr.rstrip(b"\0").decode("ascii"), height,
+                        from_timestamp(last_seen), from_timestamp(reg_time),
+                        uptime)
+
+
+class SharedTable(object):
+
+    def __init__(self, path, capacity=100000):
+        """Open or create the shared table file at path."""
+        self.path = path
+        self.lock_path = path + ".lock"
+        self._map = None
+        self._decoded = (None, [])  # generation, records
+        self._lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size < HEADER.size:  # new file
+                os.ftruncate(fd, HEADER.size + capacity * RECORD.size)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, HEADER.pack(0, 0, 0.0, capacity))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._remap()
+
+    def _remap(self):
+        with open(self.path, "r+b") as f:
+            self._map = mmap.mmap(f.fileno(), 0)
+
+    def header(self):
+        """(generation, count, refreshed, capacity)"""
+        return HEADER.unpack_from(self._map, 0)
+
+    def age(self):
+        """Seconds since the last refresh."""
+        return time.time() - self.header()[2]
+
+    def write(self, records):
+        """Replace the content, only one writer may run at a time."""
+        data = b"".join(pack(record) for record in records)
+        count = len(data) // RECORD.size
+        generation, _, _, capacity = self.header()
+        if count > capacity:
+            while capacity < count:
+                capacity *= 2
+            with open(self.path, "r+b") as f:
+                f.truncate(HEADER.size + capacity * RECORD.size)
+            self._remap()
+        HEADER.pack_into(self._map, 0, generation + 1, 0, 0.0, capacity)
+        self._map[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(self._map, 0, generation + 2, count, time.time(),
+                         capacity)
+
+    def read(self, retries=1000):
+        """
+        Consistent copy of the records, None if no stable generation was
+        seen within retries, for example because a writer died mid write.
+
+        """
+        for _ in range(retries):
+            generation, count, _, _ = self.header()
+            if generation % 2:
+                time.sleep(0)
+                continue
+            if self._decoded[0] == generation:
+                return self._decoded[1]
+            size = HEADER.size + count * RECORD.size
+            if size > len(self._map):  # grown by another process
+                self._remap()
+            data = self._map[HEADER.size:size]
+            if self.header()[0] != generation:
+                continue
+            records = [unpack(data, offset)
+                       for offset in range(0, len(data), RECORD.size)]
+            self._decoded = (generation, records)
+            return records
+        return None
+
+    def refresh(self, loader, max_age, block=False):
+        """
+        Reload from loader() if older than max_age seconds. Only the
+        process holding the lock file refreshes, the others keep reading
+        the current content unless block is set.
+
+        """
+        if self.age() < max_age:
+            return False
+        with self._lock:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                flags = fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB
+                try:
+                    fcntl.flock(fd, flags)
+                except (IOError, OSError):
+                    return False  # someone else is refreshing
+                if self.age() < max_age:  # refreshed while we waited
+                    return False
+                self.write(loader())
+                return True
+            finally:
+                os.close(fd)  # also releases the lock
+
+    def close(self):
+        self._map.close()
+
+
+_lock = threading.Lock()
+_tables = {}
+
+
+def get_table(path, capacity):
+    with _lock:
+        if path not in _tables:
+            _tables[path] = SharedTable(path, capacity)
+        return _tables[path]
@@ -0,0 +1,134 @@
+"""
+Statements slower than SLOW_QUERY_TIME seconds, kept in a ring buffer of
+the last SLOW_QUERY_LOG_SIZE for the admin endpoint and logged.
+
+With SLOW_QUERY_EXPLAIN the plan of slow SELECT statements is captured
+too, by running EXPLAIN on the same connection right after the slow
+statement. That costs one more round trip per slow statement only. On
+PostgreSQL it runs inside a SAVEPOINT, a failed EXPLAIN would abort the
+transaction of the request otherwise.
+
+"""
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flask import has_request_context, request
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+MAX_PARAMETERS = 500  # characters of the parameters kept
+
+
+class SlowQueryLog(object):
+
+    def __init__(self, size):
+        """Ring buffer of the last size slow statements."""
+        self.entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        with self._lock:
+            self.entries.append(entry)
+
+    def recent(self):
+        """Entries, the most recent first."""
+        with self._lock:
+            return list(reversed(self.entries))
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def resize(self, size):
+        with self._lock:
+            self.entries = deque(self.entries, maxlen=size)
+
+
+slow_queries = SlowQueryLog(100)
+
+
+def explain(conn, statement, parameters):
+    """Plan of a SELECT statement as a list of lines, None if unknown."""
+    dialect = conn.dialect.name
+    if not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    if dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif dialect in ("postgresql", "mysql"):
+        prefix = "EXPLAIN "
+    else:
+        return None
+    # a failed statement aborts the whole transaction on PostgreSQL
+    savepoint = (dialect == "postgresql" and
+                 not getattr(conn.connection, "autocommit", False))
+    # the raw DBAPI cursor keeps the EXPLAIN out of the cursor events
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT slowlog_explain")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = [" ".join(str(column) for column in row)
+                    for row in cursor.fetchall()]
+        except Exception as e:  # a plan is nice to have, never fail
+            plan = ["EXPLAIN failed: {0}".format(e)]
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT slowlog_explain")
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT slowlog_explain")
+        return plan
+    finally:
+        cursor.close()
+
+
+def record_slow_queries(app):
+    """Install the cursor event hooks if a threshold is configured."""
+    if not app.config["SLOW_QUERY_TIME"]:
+        return False
+    slow_queries.resize(app.config["SLOW_QUERY_LOG_SIZE"])
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault("slowlog_start", []).append(time.time())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        duration = time.time() - conn.info["slowlog_start"].pop()
+        threshold = app.config["SLOW_QUERY_TIME"]
+        if not threshold or duration < threshold:
+            return
+        route = None
+        if has_request_context() and request.url_rule:
+            route = request.url_rule.rule
+        plan = None
+        if app.config["SLOW_QUERY_EXPLAIN"] and not executemany:
+            plan = explain(conn, statement, parameters)
+        slow_queries.add({
+            "statement": statement,
+            "parameters": repr(parameters)[:MAX_PARAMETERS],
+            "duration": round(duration, 6),
+            "route": route,
+            "time": datetime.utcnow().isoformat(),
+            "plan": plan,
+        })
+        msg = "Slow query {0:.3f}s on {1}: {2}".format(duration, route,
+                                                       statement)
+        logger.warning(msg)
+
+    def handle_error(context):
+        # failed statements skip after_cursor_execute
+        if context.connection is not None:
+            starts = context.connection.info.get("slowlog_start")
+            if starts:
+                starts.pop()
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(Engine, "handle_error", handle_error)
+    return True
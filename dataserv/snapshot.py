@@ -0,0 +1,302 @@
+"""
+Node snapshots: the farmer and farmer_archive tables in one compressed
+columnar file, read in a single transaction and restored with bulk
+loading, COPY on PostgreSQL and executemany on SQLite, in one
+transaction. Both directions stream CHUNK rows at a time, the ids are
+kept.
+
+    python app.py snapshot --file node.snapshot
+    python app.py restore --file node.snapshot
+
+Layout, little endian:
+
+    header  magic 8s, length uint32, JSON {"version", "tables":
+            [{"name", "columns": [[name, kind], ...]}, ...]}
+    chunk   table index uint16, rows uint32, then per column
+            length uint32 and the zlib compressed column data
+    end     0xffff uint16, rows written uint32
+
+Column data is int64 for "int", the differences to the previous id for
+"id", microseconds since 1970 for "time" (NULL is -2**63) and for "str"
+the int64 byte lengths of the UTF-8 values (NULL is -1) followed by the
+values. The times are stored as datetimes, so a snapshot loads with or
+without EPOCH_TIMES.
+
+"""
+import os
+import csv
+import json
+import zlib
+import struct
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import DateTime, Integer, String, func, select
+from dataserv.run import db
+from dataserv.Farmer import Farmer, FarmerArchive
+from dataserv.epochtime import EpochDateTime
+from dataserv.sharding import get_shards
+try:
+    from cStringIO import StringIO  # python 2, csv writes byte strings
+except ImportError:
+    from io import StringIO
+
+
+MAGIC = b"DSSNAP01"
+VERSION = 2
+LENGTH = struct.Struct("<I")
+CHUNK_HEADER = struct.Struct("<HI")
+END = 0xffff
+NULL = -2 ** 63
+EPOCH = datetime(1970, 1, 1)
+CHUNK = 100000  # rows
+
+
+def tables():
+    return [Farmer.__table__, FarmerArchive.__table__]
+
+
+def column_kind(column):
+    if isinstance(column.type, (EpochDateTime, DateTime)):
+        return "time"
+    if isinstance(column.type, Integer):
+        return "id" if column.primary_key else "int"
+    if isinstance(column.type, String):
+        return "str"
+    raise ValueError("No snapshot encoding for {0}".format(column))
+
+
+def ints_to_bytes(values):
+    return struct.pack("<%dq" % len(values), *values)
+
+
+def bytes_to_ints(data):
+    if len(data) % 8:
+        raise ValueError("Snapshot column is damaged.")
+    return struct.unpack("<%dq" % (len(data) // 8), data)
+
+
+def to_micros(when):
+    delta = when - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def encode(kind, values):
+    if kind == "str":
+        encoded = [None if value is None else value.encode("utf-8")
+                   for value in values]
+        lengths = [-1 if value is None else len(value) for value in encoded]
+        return ints_to_bytes(lengths) + b"".join(
+            value for value in encoded if value is not None)
+    if kind == "time":
+        values = [NULL if value is None else to_micros(value)
+                  for value in values]
+    elif kind == "id":
+        previous = 0
+        deltas = []
+        for value in values:
+            deltas.append(value - previous)
+            previous = value
+        values = deltas
+    else:
+        values = [NULL if value is None else value for value in values]
+    return ints_to_bytes(values)
+
+
+def decode(kind, data, count):
+    if kind == "str":
+        if len(data) < 8 * count:
+            raise ValueError("Snapshot column is damaged.")
+        strings = []
+        position = 8 * count
+        for length in bytes_to_ints(data[:position]):
+            if length < 0:
+                strings.append(None)
+                continue
+            strings.append(data[position:position + length].decode("utf-8"))
+            position += length
+        if position != len(data):
+            raise ValueError("Snapshot column is damaged.")
+        return strings
+    values = bytes_to_ints(data)
+    if kind == "id":
+        total = 0
+        ids = []
+        for delta in values:
+            total += delta
+            ids.append(total)
+        return ids
+    if kind == "time":
+        return [None if value == NULL else
+                EPOCH + timedelta(microseconds=value) for value in values]
+    return [None if value == NULL else value for value in values]
+
+
+@contextmanager
+def read_transaction(engine):
+    """A connection that sees one state of the database until closed."""
+    with engine.connect() as connection:
+        if engine.dialect.name == "sqlite":
+            # pysqlite starts no transaction for a SELECT
+            connection.execute("BEGIN")
+            try:
+                yield connection
+            finally:
+                connection.execute("ROLLBACK")
+        else:
+            connection = connection.execution_options(
+                isolation_level="REPEATABLE READ")
+            with connection.begin():
+                yield connection.execution_options(stream_results=True)
+
+
+def write_chunk(out, index, kinds, rows):
+    out.write(CHUNK_HEADER.pack(index, len(rows)))
+    for position, kind in enumerate(kinds):
+        data = zlib.compress(encode(kind, [row[position] for row in rows]))
+        out.write(LENGTH.pack(len(data)))
+        out.write(data)
+
+
+def take_snapshot(engine, path, chunk=CHUNK):
+    """Write the farmer tables of engine to path, return rows per table."""
+    header = {"version": VERSION, "tables": [
+        {"name": table.name, "columns": [[column.name, column_kind(column)]
+                                         for column in table.columns]}
+        for table in tables()]}
+    counts = {}
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as out:
+        encoded = json.dumps(header).encode("utf-8")
+        out.write(MAGIC + LENGTH.pack(len(encoded)) + encoded)
+        with read_transaction(engine) as connection:
+            for index, table in enumerate(tables()):
+                kinds = [column_kind(column) for column in table.columns]
+                result = connection.execute(select(list(table.columns))
+                                            .order_by(table.c.id))
+                counts[table.name] = 0
+                while True:
+                    rows = result.fetchmany(chunk)
+                    if not rows:
+                        break
+                    write_chunk(out, index, kinds, rows)
+                    counts[table.name] += len(rows)
+        out.write(CHUNK_HEADER.pack(END, sum(counts.values())))
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(temporary, path)
+    return counts
+
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Snapshot is truncated.")
+    return data
+
+
+def read_snapshot(path):
+    """Yield (table name, columns, rows) chunks of a snapshot file."""
+    with open(path, "rb") as f:
+        if read_exactly(f, len(MAGIC)) != MAGIC:
+            raise ValueError("Not a dataserv snapshot.")
+        length, = LENGTH.unpack(read_exactly(f, LENGTH.size))
+        header = json.loads(read_exactly(f, length).decode("utf-8"))
+        if header["version"] != VERSION:
+            raise ValueError("Unknown snapshot version.")
+        total = 0
+        while True:
+            index, count = CHUNK_HEADER.unpack(
+                read_exactly(f, CHUNK_HEADER.size))
+            if index == END:
+                if count != total:
+                    raise ValueError("Snapshot rows are missing.")
+                return
+            table = header["tables"][index]
+            columns = []
+            for name, kind in table["columns"]:
+                size, = LENGTH.unpack(read_exactly(f, LENGTH.size))
+                values = decode(kind, zlib.decompress(read_exactly(f, size)),
+                                count)
+                if len(values) != count:
+                    raise ValueError("Snapshot column is damaged.")
+                columns.append(values)
+            total += count
+            yield (table["name"], [name for name, _ in table["columns"]],
+                   list(zip(*columns)))
+
+
+def copy_chunk(cursor, table, names, rows):
+    """Load one chunk with PostgreSQL COPY, NULL is an unquoted empty."""
+    data = StringIO()
+    writer = csv.writer(data)
+    writer.writerows(rows)
+    data.seek(0)
+    cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH CSV".format(
+        table.name, ", ".join(names)), data)
+
+
+def restore_snapshot(engine, path, replace=False):
+    """
+    Load a snapshot into the empty farmer tables in one transaction,
+    return the rows per table.
+
+    """
+    by_name = dict((table.name, table) for table in tables())
+    connection = engine.raw_connection()
+    counts = {}
+    try:
+        cursor = connection.cursor()
+        for table in tables():
+            if replace:
+                cursor.execute("DELETE FROM {0}".format(table.name))
+            else:
+                cursor.execute("SELECT COUNT(*) FROM {0}".format(table.name))
+                if cursor.fetchone()[0]:
+                    raise ValueError("Table {0} is not empty.".format(
+                        table.name))
+        postgresql = engine.dialect.name == "postgresql"
+        marker = "?" if engine.dialect.paramstyle == "qmark" else "%s"
+        for name, names, rows in read_snapshot(path):
+            table = by_name[name]
+            unknown = [column for column in names if column not in table.c]
+            if unknown:
+                raise ValueError("Unknown columns in {0}: {1}".format(
+                    name, ", ".join(unknown)))
+            # raw DBAPI values, the column types would run per value
+            processors = [table.c[column].type.bind_processor(engine.dialect)
+                          for column in names]
+            if any(processors):
+                rows = [tuple(value if processor is None else
+                              processor(value) for processor, value
+                              in zip(processors, row)) for row in rows]
+            if postgresql:
+                copy_chunk(cursor, table, names, rows)
+            else:
+                cursor.executemany("INSERT INTO {0} ({1}) VALUES ({2})".format(
+                    name, ", ".join(names), ", ".join([marker] * len(names))),
+                    rows)
+            counts[name] = counts.get(name, 0) + len(rows)
+        if postgresql:  # the serials continue after the restored ids
+            for table in tables():
+                cursor.execute(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "COALESCE(MAX(id), 0) + 1, false) FROM {0}".format(
+                        table.name))
+        connection.commit()  # all or nothing, also if the file is damaged
+    finally:
+        connection.close()  # rolls back if not committed
+    return counts
+
+
+def node_engine():
+    if get_shards() is not None:
+        raise ValueError("Snapshots of sharded nodes are not supported.")
+    return db.engine
+
+
+def row_counts(engine):
+    with engine.connect() as connection:
+        return dict((table.name, connection.execute(
+            select([func.count()]).select_from(table)).scalar())
+            for table in tables())
@@ -0,0 +1,132 @@
+import time
+import bisect
+import calendar
+import threading
+from datetime import datetime
+from datetime import timedelta
+from dataserv.run import app
+from dataserv.Farmer import observe
+
+
+def epoch_minute(when):
+    """Minute since the unix epoch of a naive UTC datetime."""
+    return calendar.timegm(when.utctimetuple()) // 60
+
+
+class TimeWheel(object):
+
+    def __init__(self, online_time):
+        """
+        In memory set of online farmers. Farmers sit in a bucket keyed by
+        the minute of their last ping, so expiring everybody older than
+        `online_time` minutes drops whole buckets instead of scanning.
+        The online farmers are also kept ordered by (height DESC, id).
+
+        """
+        self.online_time = online_time
+        self.buckets = {}  # epoch minute -> set of btc_addr
+        self.records = {}  # btc_addr -> FarmerRecord
+        self.order = []  # sorted (-height, id, btc_addr)
+        self.loaded = None  # time of the last load from the database
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def cutoff(self, now=None):
+        now = now or datetime.utcnow()
+        return now - timedelta(minutes=self.online_time)
+
+    def _remove(self, btc_addr):
+        record = self.records.pop(btc_addr, None)
+        if record is None:
+            return None
+        bucket = self.buckets.get(epoch_minute(record.last_seen))
+        if bucket is not None:
+            bucket.discard(btc_addr)
+        key = (-record.height, record.id, record.btc_addr)
+        index = bisect.bisect_left(self.order, key)
+        if index < len(self.order) and self.order[index] == key:
+            del self.order[index]
+        return record
+
+    def update(self, record, now=None):
+        """Add or move a farmer after a ping or height change."""
+        with self._lock:
+            self._remove(record.btc_addr)
+            if record.last_seen <= self.cutoff(now):
+                return
+            minute = epoch_minute(record.last_seen)
+            self.buckets.setdefault(minute, set()).add(record.btc_addr)
+            self.records[record.btc_addr] = record
+            key = (-record.height, record.id, record.btc_addr)
+            bisect.insort(self.order, key)
+
+    def expire(self, now=None):
+        """Drop farmers that have not pinged in time, return them."""
+        cutoff = self.cutoff(now)
+        cutoff_minute = epoch_minute(cutoff)
+        expired = []
+        with self._lock:
+            for minute in [m for m in self.buckets if m <= cutoff_minute]:
+                for btc_addr in list(self.buckets[minute]):
+                    record = self.records[btc_addr]
+                    if record.last_seen <= cutoff:
+                        expired.append(self._remove(btc_addr))
+                if not self.buckets[minute]:
+                    del self.buckets[minute]
+        return expired
+
+    def online(self, now=None):
+        """Online farmers ordered by height, in O(online)."""
+        with self._lock:
+            self.expire(now)
+            return [self.records[key[2]] for key in self.order]
+
+    def load(self, records, now=None):
+        """Replace the content with records read from the database."""
+        with self._lock:
+            self.buckets = {}
+            self.records = {}
+            self.order = []
+            for record in records:
+                self.update(record, now)
+            self.loaded = time.time()
+
+
+_lock = threading.Lock()
+_wheel = None
+
+
+def get_wheel(loader):
+    """
+    The process wide TimeWheel or None if ONLINE_TIMEWHEEL is off. It is
+    warm started with loader() on first use, and again every
+    TIMEWHEEL_RESYNC seconds to pick up pings handled by other processes.
+
+    """
+    global _wheel
+    if not app.config["ONLINE_TIMEWHEEL"]:
+        return None
+    with _lock:
+        if _wheel is None:
+            observe(on_farmer_change)
+            _wheel = TimeWheel(app.config["ONLINE_TIME"])
+        resync = app.config["TIMEWHEEL_RESYNC"]
+        if _wheel.loaded is None or (
+                resync and time.time() - _wheel.loaded >= resync):
+            _wheel.load(loader())
+        return _wheel
+
+
+def reset_wheel():
+    """Forget the process wide TimeWheel, it is reloaded on next use."""
+    global _wheel
+    with _lock:
+        _wheel = None
+
+
+def on_farmer_change(event, record, previous):
+    wheel = _wheel
+    if wheel is not None:
+        wheel.update(record)
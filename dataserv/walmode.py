@@ -0,0 +1,154 @@
+"""
+SQLite mode for many concurrent requests on a single database file.
+
+With SQLITE_WAL every connection uses write-ahead logging, so readers no
+longer wait for the writer and the other way round, tuned by the
+SQLITE_PRAGMAS. With SQLITE_WRITER the `Farmer` writes are not committed
+by the request threads, which would fight over the file lock, but handed
+to one writer thread. It commits everything queued up meanwhile in one
+transaction, one sync for a whole group of pings. Reads still go through
+the connection of the request's own session.
+
+The writer thread belongs to the process, a forked worker starts its own
+on its first write.
+
+"""
+import os
+import sqlite3
+import threading
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+from dataserv.run import app, db
+from dataserv.sharding import get_shards
+try:
+    from queue import Queue, Empty
+except ImportError:  # python 2
+    from Queue import Queue, Empty
+
+
+from dataserv.config import logging
+logger = logging.getLogger(__name__)
+
+
+def set_pragmas(dbapi_connection, connection_record):
+    """Switch new sqlite connections to WAL if SQLITE_WAL is set."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    if not app.config["SQLITE_WAL"]:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        for name, value in sorted(app.config["SQLITE_PRAGMAS"].items()):
+            cursor.execute("PRAGMA {0}={1}".format(name, value))
+    finally:
+        cursor.close()
+
+
+event.listen(Engine, "connect", set_pragmas)
+
+
+class Job(object):
+
+    def __init__(self, work):
+        """Call of work(connection) waited for by a request thread."""
+        self.work = work
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Writer(object):
+
+    def __init__(self, url, batch):
+        """Thread committing the submitted work in groups of up to batch."""
+        # a connection of its own, the request threads waiting for their
+        # writes may hold every connection of the application's pool
+        self.engine = create_engine(url, poolclass=NullPool)
+        self.connection = None
+        self.batch = batch
+        self.pid = os.getpid()
+        self.groups = 0  # committed transactions
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, work):
+        """Run work(connection) in a writer transaction, return its result."""
+        job = Job(work)
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def stop(self):
+        """Commit what was submitted so far and end the thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        self.connection = self.engine.connect()
+        while True:
+            jobs = [self.queue.get()]
+            while jobs[-1] is not None and len(jobs) < self.batch:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            stop = jobs[-1] is None
+            if stop:
+                jobs.pop()
+            if jobs:
+                self.commit(jobs)
+            if stop:
+                self.connection.close()
+                return
+
+    def commit(self, jobs):
+        """Run jobs in one transaction, each alone if one of them fails."""
+        try:
+            with self.connection.begin():
+                for job in jobs:
+                    job.result = job.work(self.connection)
+            self.groups += 1
+        except Exception as e:
+            if len(jobs) > 1:  # one bad write must not fail the others
+                for job in jobs:
+                    self.commit([job])
+                return
+            logger.warning("Queued write failed: %s", e)
+            jobs[0].error = e
+        for job in jobs:
+            job.done.set()
+
+
+_writers = {}  # engine: Writer
+_lock = threading.Lock()
+
+
+def get_writer():
+    """The Writer of the sqlite database, None if writes are not queued."""
+    if not app.config["SQLITE_WRITER"] or get_shards() is not None:
+        return None
+    engine = db.engine
+    if engine.dialect.name != "sqlite" or \
+            engine.url.database in (None, "", ":memory:"):
+        return None
+    with _lock:
+        writer = _writers.get(engine)
+        if writer is None or writer.pid != os.getpid():
+            writer = Writer(engine.url, app.config["SQLITE_WRITER_BATCH"])
+            _writers[engine] = writer
+        return writer
+
+
+def reset_writers():
+    """Stop the writers, for tests and benchmarks switching modes."""
+    with _lock:
+        while _writers:
+            writer = _writers.popitem()[1]
+            if writer.pid == os.getpid():  # a forked child has no thread
+                writer.stop()
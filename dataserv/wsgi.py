@@ -0,0 +1,38 @@
+"""
+Gunicorn entry point that loads the app once in the master process, so
+forked workers start with the routes and the signature libraries already
+imported:
+
+    gunicorn -c python:dataserv.wsgi "dataserv.wsgi:create_app()"
+
+Used as the config module it sets `preload_app` and a `post_fork` hook
+that gives each worker its own database connections, log writer thread
+and sqlite writer. Nothing here touches the database before the fork.
+
+"""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+
+# gunicorn settings when loaded with -c python:dataserv.wsgi
+preload_app = True
+
+
+def create_app():
+    """The Flask app with the lazily imported dependencies loaded."""
+    from dataserv.app import app
+    from dataserv.Farmer import auth_error, is_btc_address
+    auth_error()  # storjcore
+    is_btc_address(app.config["ADDRESS"])  # btctxstore and its BtcTxStore
+    return app
+
+
+def post_fork(server, worker):
+    """Drop the state a worker must not share with the master."""
+    from dataserv.run import app, db
+    from dataserv.logs import setup_logging
+    from dataserv.walmode import reset_writers
+    setup_logging(app.config)  # the listener thread was not forked
+    reset_writers()
+    db.engine.dispose()  # connections opened before the fork
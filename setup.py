@@ -32,6 +32,7 @@ setup(
     download_url=DOWNLOAD_URL,
     test_suite="tests",
     install_requires=open("requirements.txt").readlines(),
+    extras_require={"async": open("async_requirements.txt").readlines()},
     tests_require=open("test_requirements.txt").readlines(),
     zip_safe=False,
     classifiers=[
@@ -1,11 +1,15 @@
+import os
 import json
+import shutil
 import unittest
+import tempfile
 import time
 from time import mktime
 from datetime import datetime
 from dataserv.run import app, db
 from btctxstore import BtcTxStore
 from email.utils import formatdate
+from dataserv.Farmer import Farmer
 from dataserv.app import secs_to_mins, online_farmers
 
 
@@ -252,6 +256,66 @@ class HeightTest(TemplateTest):
         self.assertEqual(rv.status_code, 200)
 
 
+class ReplicaTest(TemplateTest):
+
+    def setUp(self):
+        # two sqlite files stand in for the primary and the replica
+        self.tmp_dir = tempfile.mkdtemp()
+        self.uri = app.config["SQLALCHEMY_DATABASE_URI"]
+        self.binds = app.config["SQLALCHEMY_BINDS"]
+        primary = os.path.join(self.tmp_dir, "primary.db")
+        replica = os.path.join(self.tmp_dir, "replica.db")
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + primary
+        app.config["SQLALCHEMY_BINDS"] = {"replica": "sqlite:///" + replica}
+        db.session.remove()
+        TemplateTest.setUp(self)
+        self.replica = db.get_engine(app, "replica")
+        db.Model.metadata.create_all(self.replica)
+
+    def tearDown(self):
+        TemplateTest.tearDown(self)
+        app.config["SQLALCHEMY_DATABASE_URI"] = self.uri
+        app.config["SQLALCHEMY_BINDS"] = self.binds
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reads_use_replica(self):
+        btc_addr = self.btctxstore.get_address(self.btctxstore.get_key(self.btctxstore.create_wallet()))
+
+        # writes go to the primary
+        rv = self.app.get('/api/register/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/api/height/{0}/{1}'.format(btc_addr, 10))
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/api/ping/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(online_farmers()[0].btc_addr, btc_addr)
+
+        # the replica has not caught up yet
+        rv = self.app.get('/api/online/json')
+        self.assertFalse(btc_addr in str(rv.data))
+        rv = self.app.get('/api/total')
+        self.assertTrue(b'"total_farmers": 0' in rv.data)
+
+        # replicate the row
+        row = dict(db.engine.execute(Farmer.__table__.select()).first())
+        self.replica.execute(Farmer.__table__.insert(), row)
+        rv = self.app.get('/api/online/json')
+        self.assertTrue(btc_addr in str(rv.data))
+        rv = self.app.get('/api/online')
+        self.assertTrue(btc_addr in str(rv.data))
+        rv = self.app.get('/api/total')
+        self.assertTrue(b'"total_farmers": 1' in rv.data)
+
+    def test_no_replica_configured(self):
+        app.config["SQLALCHEMY_BINDS"] = None
+        btc_addr = self.btctxstore.get_address(self.btctxstore.get_key(self.btctxstore.create_wallet()))
+        self.app.get('/api/register/{0}'.format(btc_addr))
+
+        # reads fall back to the primary
+        rv = self.app.get('/api/online/json')
+        self.assertTrue(btc_addr in str(rv.data))
+
+
 class AppAuthenticationHeadersTest(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,219 @@
+import json
+import unittest
+from time import mktime
+from datetime import datetime
+from datetime import timedelta
+from email.utils import formatdate
+from btctxstore import BtcTxStore
+from dataserv.app import app, db
+from dataserv.Farmer import Farmer, FarmerArchive
+from dataserv.archive import archive_farmers
+from dataserv.events import reset_hub
+try:
+    from aiohttp.test_utils import AioHTTPTestCase
+    from dataserv.aioapp import create_app
+except ImportError:  # no async extra
+    AioHTTPTestCase, create_app = unittest.TestCase, None
+
+
+@unittest.skipIf(create_app is None, "needs the async extra")
+class AioAppTest(AioHTTPTestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        app.config["ASYNC_VERIFY_PROCESSES"] = 0
+        self.max_ping = app.config["MAX_PING"]
+        self.btctxstore = BtcTxStore()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["SKIP_AUTHENTICATION"] = True
+        app.config["ASYNC_VERIFY_PROCESSES"] = None
+        app.config["MAX_PING"] = self.max_ping
+        reset_hub()
+        db.session.remove()
+        db.drop_all()
+
+    async def get_application(self):
+        return create_app()
+
+    def new_address(self):
+        return self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+
+    def signed_headers(self, wif):
+        date = formatdate(timeval=mktime(datetime.now().timetuple()),
+                          localtime=True, usegmt=True)
+        message = app.config["ADDRESS"] + " " + date
+        return {"Date": date,
+                "Authorization": self.btctxstore.sign_unicode(
+                    wif, message).decode()}
+
+    async def get(self, url, status, headers=None):
+        response = await self.client.get(url, headers=headers)
+        self.assertEqual(response.status, status)
+        return await response.text()
+
+    async def test_register(self):
+        btc_addr = self.new_address()
+        body = await self.get("/api/register/{0}".format(btc_addr), 200)
+        farmer = json.loads(body)
+        self.assertEqual(farmer["btc_addr"], btc_addr)
+        self.assertEqual(farmer["payout_addr"], btc_addr)
+        self.assertEqual((farmer["height"], farmer["uptime"]), (0, 100))
+        self.assertEqual(Farmer(btc_addr).lookup().payout_addr, btc_addr)
+
+        body = await self.get("/api/register/{0}".format(btc_addr), 409)
+        self.assertEqual(body,
+                         "Registration Failed: Address already is registered.")
+        await self.get("/api/register/{0}/{1}".format(
+            self.new_address(), "1NotAnAddress"), 400)
+        body = await self.get("/api/register/1NotAnAddress", 400)
+        self.assertEqual(body, "Registration Failed: Invalid Bitcoin address.")
+
+    async def test_ping(self):
+        btc_addr = self.new_address()
+        await self.get("/api/ping/{0}".format(btc_addr), 404)
+        await self.get("/api/ping/1NotAnAddress", 400)
+        await self.get("/api/register/{0}".format(btc_addr), 200)
+
+        app.config["MAX_PING"] = 0
+        before = datetime.utcnow()
+        body = await self.get("/api/ping/{0}".format(btc_addr), 200)
+        self.assertEqual(body, "Ping accepted.")
+        self.assertTrue(Farmer(btc_addr).lookup().last_seen >= before)
+
+    async def test_height(self):
+        btc_addr = self.new_address()
+        await self.get("/api/height/{0}/10".format(btc_addr), 404)
+        await self.get("/api/register/{0}".format(btc_addr), 200)
+        body = await self.get("/api/height/{0}/50".format(btc_addr), 200)
+        self.assertEqual(body, "Height accepted.")
+        self.assertEqual(Farmer(btc_addr).lookup().height, 50)
+        await self.get("/api/height/{0}/{1}".format(
+            btc_addr, app.config["HEIGHT_LIMIT"] + 1), 413)
+        await self.get("/api/height/{0}/-1".format(btc_addr), 404)
+
+    async def test_online(self):
+        addresses = [self.new_address() for _ in range(2)]
+        for height, btc_addr in enumerate(addresses):
+            await self.get("/api/register/{0}".format(btc_addr), 200)
+            await self.get("/api/height/{0}/{1}".format(btc_addr, height), 200)
+
+        farmers = json.loads(await self.get("/api/online/json", 200))
+        self.assertEqual([farmer["btc_addr"] for farmer in
+                          farmers["farmers"]], addresses[::-1])
+        total = json.loads(await self.get("/api/total", 200))
+        self.assertEqual(total["total_farmers"], 2)
+        body = await self.get("/api/online", 200)
+        self.assertEqual(body.count("<br/>"), 2)
+
+        # served from the cache until CACHING_TIME passed
+        app.config["DISABLE_CACHING"] = False
+        try:
+            await self.get("/api/total", 200)
+            await self.get("/api/register/{0}".format(self.new_address()),
+                           200)
+            total = json.loads(await self.get("/api/total", 200))
+            self.assertEqual(total["total_farmers"], 2)
+        finally:
+            app.config["DISABLE_CACHING"] = True
+
+    async def test_register_after_delta(self):
+        first = self.new_address()
+        await self.get("/api/register/{0}".format(first), 200)
+        full = json.loads(await self.get("/api/online/json?since=", 200))
+        self.assertTrue(full["full"])
+
+        # the hub now observes registrations, they carry the new row id
+        second = self.new_address()
+        body = await self.get("/api/register/{0}".format(second), 200)
+        self.assertEqual(json.loads(body)["btc_addr"], second)
+        await self.get("/api/register/{0}".format(self.new_address()), 200)
+        delta = json.loads(await self.get(
+            "/api/online/json?since=" + full["version"], 200))
+        self.assertIn(second, [farmer["btc_addr"]
+                               for farmer in delta["added"]])
+
+    async def test_authentication(self):
+        app.config["SKIP_AUTHENTICATION"] = False
+        wif = self.btctxstore.create_key()
+        btc_addr = self.btctxstore.get_address(wif)
+        await self.get("/api/register/{0}".format(btc_addr), 401)
+        await self.get("/api/register/{0}".format(btc_addr), 200,
+                       self.signed_headers(wif))
+        other = self.btctxstore.create_key()
+        await self.get("/api/height/{0}/5".format(btc_addr), 401,
+                       self.signed_headers(other))
+
+        # throttled pings need no signature
+        app.config["MAX_PING"] = 60
+        await self.get("/api/ping/{0}".format(btc_addr), 200)
+        app.config["MAX_PING"] = 0
+        await self.get("/api/ping/{0}".format(btc_addr), 401)
+
+    async def test_revived_on_ping(self):
+        btc_addr = self.new_address()
+        await self.get("/api/register/{0}".format(btc_addr), 200)
+        last_seen = datetime.utcnow() - timedelta(days=40)
+        db.engine.execute(Farmer.__table__.update().values(
+            last_seen=last_seen, reg_time=last_seen, height=7))
+        self.assertEqual(archive_farmers(30, chunk=10), 1)
+        await self.get("/api/ping/{0}".format(btc_addr), 200)
+        db.session.remove()
+        self.assertEqual(FarmerArchive.query.count(), 0)
+        self.assertEqual(Farmer(btc_addr).lookup().height, 7)
+
+    async def test_not_revived_without_auth(self):
+        btc_addr = self.new_address()
+        await self.get("/api/register/{0}".format(btc_addr), 200)
+        last_seen = datetime.utcnow() - timedelta(days=40)
+        db.engine.execute(Farmer.__table__.update().values(
+            last_seen=last_seen, reg_time=last_seen))
+        self.assertEqual(archive_farmers(30, chunk=10), 1)
+        app.config["SKIP_AUTHENTICATION"] = False
+        await self.get("/api/ping/{0}".format(btc_addr), 401)
+        db.session.remove()
+        self.assertEqual(FarmerArchive.query.count(), 1)
+        self.assertEqual(Farmer.query.count(), 0)
+
+
+@unittest.skipIf(create_app is None, "needs the async extra")
+class AioAppProcessTest(AioHTTPTestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = False
+        app.config["REPLAY_PROTECTION"] = True
+        app.config["ASYNC_VERIFY_PROCESSES"] = 1
+        self.btctxstore = BtcTxStore()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["SKIP_AUTHENTICATION"] = True
+        app.config["REPLAY_PROTECTION"] = False
+        app.config["ASYNC_VERIFY_PROCESSES"] = None
+        db.session.remove()
+        db.drop_all()
+
+    async def get_application(self):
+        return create_app()
+
+    async def test_signature_in_process(self):
+        wif = self.btctxstore.create_key()
+        btc_addr = self.btctxstore.get_address(wif)
+        date = formatdate(timeval=mktime(datetime.now().timetuple()),
+                          localtime=True, usegmt=True)
+        message = app.config["ADDRESS"] + " " + date
+        headers = {"Date": date, "Authorization": self.btctxstore.sign_unicode(
+            wif, message).decode()}
+        response = await self.client.get(
+            "/api/register/{0}".format(btc_addr), headers=headers)
+        self.assertEqual(response.status, 200)
+        response = await self.client.get(
+            "/api/height/{0}/1".format(btc_addr), headers=headers)
+        self.assertEqual(response.status, 200)
+        # replayed headers are caught before the executor
+        response = await self.client.get(
+            "/api/height/{0}/1".format(btc_addr), headers=headers)
+        self.assertEqual(response.status, 401)
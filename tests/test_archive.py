@@ -0,0 +1,101 @@
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from btctxstore import BtcTxStore
+from dataserv.app import app, db
+from dataserv.Farmer import Farmer, FarmerArchive
+from dataserv.archive import (archive_farmers, table_sizes, start_archiver)
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["SKIP_AUTHENTICATION"] = True
+        db.session.remove()
+        db.drop_all()
+
+    def new_address(self):
+        return self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+
+    def add_farmer(self, days_offline, height=0):
+        farmer = Farmer(self.new_address())
+        farmer.register()
+        farmer = farmer.lookup()
+        farmer.last_seen = datetime.utcnow() - timedelta(days=days_offline)
+        farmer.reg_time = farmer.last_seen - timedelta(days=10)
+        farmer.height = height
+        farmer.uptime = 3600
+        db.session.commit()
+        return farmer.btc_addr
+
+    def test_archive(self):
+        old = [self.add_farmer(40) for _ in range(5)]
+        recent = [self.add_farmer(1) for _ in range(2)]
+        self.assertEqual(archive_farmers(30, chunk=2), 5)
+        self.assertEqual(sorted(f.btc_addr for f in Farmer.query.all()),
+                         sorted(recent))
+        archived = FarmerArchive.query.all()
+        self.assertEqual(sorted(f.btc_addr for f in archived), sorted(old))
+        self.assertTrue(all(f.archived is not None for f in archived))
+        self.assertEqual(archive_farmers(30, chunk=2), 0)
+
+    def test_revived_on_ping(self):
+        self.add_farmer(1)
+        btc_addr = self.add_farmer(40, height=50)
+        farmer_id = Farmer(btc_addr).lookup().id
+        archive_farmers(30, chunk=10)
+        rv = self.app.get('/api/ping/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(FarmerArchive.query.count(), 0)
+        farmer = Farmer(btc_addr).lookup()
+        self.assertEqual(farmer.id, farmer_id)
+        self.assertEqual(farmer.height, 50)
+        self.assertEqual(farmer.uptime, 3600 + 5 * 60)
+        self.assertTrue(datetime.utcnow() - farmer.last_seen <
+                        timedelta(seconds=5))
+
+    def test_revived_with_reused_id(self):
+        btc_addr = self.add_farmer(40)
+        farmer_id = Farmer(btc_addr).lookup().id
+        archive_farmers(30, chunk=10)
+        db.session.remove()
+        db.engine.execute(Farmer.__table__.insert().values(
+            id=farmer_id, btc_addr=self.new_address(), height=0))
+        rv = self.app.get('/api/ping/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(Farmer(btc_addr).lookup().id, farmer_id)
+
+    def test_still_registered(self):
+        btc_addr = self.add_farmer(40)
+        archive_farmers(30, chunk=10)
+        rv = self.app.get('/api/register/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 409)
+
+    def test_not_revived_without_auth(self):
+        btc_addr = self.add_farmer(40)
+        archive_farmers(30, chunk=10)
+        app.config["SKIP_AUTHENTICATION"] = False
+        rv = self.app.get('/api/ping/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 401)
+        db.session.remove()
+        self.assertEqual(FarmerArchive.query.count(), 1)
+        self.assertEqual(Farmer.query.count(), 0)
+
+    def test_table_sizes(self):
+        self.add_farmer(40)
+        sizes = table_sizes(db.engine)
+        if sizes:  # sqlite may be built without dbstat
+            self.assertTrue(sizes["farmer"] > 0)
+            self.assertTrue("farmer_archive" in sizes)
+
+    def test_no_background_job(self):
+        self.assertEqual(app.config["ARCHIVE_INTERVAL"], 0)
+        self.assertEqual(start_archiver(), None)
@@ -0,0 +1,147 @@
+import unittest
+import threading
+from datetime import datetime
+from sqlalchemy import event
+from btctxstore import BtcTxStore
+from dataserv.app import app, db
+import dataserv.bloom
+from dataserv.Farmer import Farmer, FarmerArchive
+from dataserv.bloom import BloomFilter, RegisteredAddresses, start_bloom_filter
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_sizing(self):
+        bloom = BloomFilter(1000000, 0.01)
+        self.assertEqual(bloom.hashes, 7)
+        self.assertEqual(len(bloom.bits) // 1000, 1198)  # KB
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        keys = ["addr{0}".format(i) for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false = sum("other{0}".format(i) in bloom for i in range(10000))
+        self.assertLess(false, 300)  # 1% expected
+        self.assertLessEqual(bloom.count, 1000)
+
+    def test_concurrent_adds(self):
+        bloom = BloomFilter(20000, 0.01)
+        keys = ["addr{0}".format(i) for i in range(20000)]
+        threads = [threading.Thread(target=bloom.update, args=(keys[i::2],))
+                   for i in range(2)] + [
+            threading.Thread(target=lambda: [bloom.add(k) for k in keys])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(key in bloom for key in keys))
+
+
+class RegisteredAddressesTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        db.create_all()
+        now = datetime.utcnow()
+        self.insert(Farmer, ["farmer1", "farmer2"])
+        self.insert(FarmerArchive, ["archived"], archived=now)
+        self.registry = RegisteredAddresses(0.01, 1000, 10, 3600)
+        self.registry.build(now=1000)
+        self.statements = 0
+        event.listen(db.engine, "before_cursor_execute", self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, "before_cursor_execute", self.count)
+        db.session.remove()
+        db.drop_all()
+
+    def count(self, *args):
+        self.statements += 1
+
+    def insert(self, model, addresses, **values):
+        now = datetime.utcnow()
+        db.engine.execute(model.__table__.insert(), [dict(
+            btc_addr=address, last_seen=now, reg_time=now, **values)
+            for address in addresses])
+
+    def test_lookup(self):
+        for address in ["farmer1", "farmer2", "archived"]:
+            self.assertTrue(self.registry.may_contain(address, now=1001))
+        self.assertFalse(self.registry.may_contain("stranger", now=1001))
+        self.assertEqual(self.statements, 0)
+
+    def test_catch_up(self):
+        self.insert(Farmer, ["elsewhere"])  # by another process
+        self.assertFalse(self.registry.may_contain("elsewhere", now=1005))
+        self.assertTrue(self.registry.may_contain("elsewhere", now=1010))
+        statements = self.statements
+        self.assertFalse(self.registry.may_contain("stranger", now=1011))
+        self.assertEqual(self.statements, statements)
+
+    def test_emptied_table(self):
+        db.drop_all()
+        db.create_all()
+        self.insert(Farmer, ["new"])
+        self.registry.rebuilding = True  # no background build
+        self.assertTrue(self.registry.may_contain("new", now=1010))
+        self.assertIsNone(self.registry.filter)
+        self.registry.rebuilding = False
+        self.registry.build(now=1020)
+        self.assertFalse(self.registry.may_contain("farmer1", now=1021))
+
+    def test_emptied_during_build(self):
+        db.drop_all()
+        db.create_all()
+        self.insert(Farmer, ["new"])
+        self.registry.rebuilding = True  # a build is running
+        self.assertTrue(self.registry.may_contain("new", now=1010))
+        self.assertIsNone(self.registry.filter)
+        self.assertTrue(self.registry.rebuild_again)
+        self.registry.run_rebuild()  # that build ends and another follows
+        self.assertFalse(self.registry.rebuilding)
+        self.assertIsNotNone(self.registry.filter)
+        self.assertTrue(self.registry.may_contain("new"))
+        self.assertFalse(self.registry.may_contain("farmer1"))
+
+
+class BloomRouteTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["BLOOM_FILTER"] = True
+        self.refresh = app.config["BLOOM_REFRESH"]
+        app.config["BLOOM_REFRESH"] = 60  # no catch-up during the test
+        db.create_all()
+        self.app = app.test_client()
+        start_bloom_filter().join()
+        btctxstore = BtcTxStore()
+        self.registered, self.unknown = [btctxstore.get_address(
+            btctxstore.get_key(btctxstore.create_wallet())) for _ in range(2)]
+        self.statements = 0
+
+    def tearDown(self):
+        app.config["BLOOM_FILTER"] = False
+        app.config["BLOOM_REFRESH"] = self.refresh
+        del dataserv.bloom._registry[:]
+        db.session.remove()
+        db.drop_all()
+
+    def count(self, *args):
+        self.statements += 1
+
+    def test_routes(self):
+        rv = self.app.get("/api/register/{0}".format(self.registered))
+        self.assertEqual(rv.status_code, 200)
+        event.listen(db.engine, "before_cursor_execute", self.count)
+        try:
+            rv = self.app.get("/api/ping/{0}".format(self.unknown))
+            self.assertEqual(rv.status_code, 404)
+            rv = self.app.get("/api/height/{0}/10".format(self.unknown))
+            self.assertEqual(rv.status_code, 404)
+            self.assertEqual(self.statements, 0)
+            rv = self.app.get("/api/height/{0}/10".format(self.registered))
+            self.assertEqual(rv.status_code, 200)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", self.count)
@@ -0,0 +1,161 @@
+import json
+import time
+import unittest
+from sqlalchemy import event
+from btctxstore import BtcTxStore
+from dataserv.app import app, db
+from dataserv.Farmer import Farmer
+from dataserv.breaker import (CircuitBreaker, breaker, install_breaker,
+                              recent_pings, stale_responses)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(window=10, min_calls=4, slow_time=1.0,
+                                      failure_rate=0.5, cooldown=5)
+
+    def test_trips_on_slow_and_failed_statements(self):
+        for duration in [0.1, 0.1, 2.0]:
+            self.breaker.record(duration, False, now=100)
+        self.assertEqual(self.breaker.state(100), "closed")  # too few
+        self.breaker.record(0.1, True, now=101)
+        self.assertEqual(self.breaker.state(101), "open")
+        self.assertEqual(self.breaker.trips, 1)
+        self.assertFalse(self.breaker.allow(now=102))
+        self.assertEqual(self.breaker.retry_after(now=102), 4)
+
+    def test_window(self):
+        for _ in range(3):
+            self.breaker.record(2.0, False, now=100)
+        for _ in range(4):
+            self.breaker.record(0.1, False, now=115)
+        self.breaker.record(2.0, False, now=115)  # the slow ones expired
+        self.assertEqual(self.breaker.state(115), "closed")
+
+    def test_probes(self):
+        for _ in range(4):
+            self.breaker.record(5.0, False, now=100)
+        self.breaker.record(0.1, False, now=103)  # still running, ignored
+        self.assertEqual(self.breaker.state(103), "open")
+
+        self.assertTrue(self.breaker.allow(now=105))  # one probe
+        self.assertFalse(self.breaker.allow(now=106))
+        self.breaker.record(3.0, False, now=108)  # the probe was slow
+        self.assertFalse(self.breaker.allow(now=109))
+        self.assertTrue(self.breaker.allow(now=113))
+        self.breaker.record(0.1, False, now=114)
+        self.assertEqual(self.breaker.state(114), "closed")
+        self.assertTrue(self.breaker.allow(now=114))
+        self.assertEqual(self.breaker.trips, 1)
+
+    def test_only_the_probe_decides(self):
+        for _ in range(4):
+            self.breaker.record(5.0, False, now=100)
+        self.assertTrue(self.breaker.allow(now=105))
+        # a background thread and a statement started before the probe
+        self.breaker.record(0.1, False, now=106, thread=-1)
+        self.breaker.record(3.0, False, now=106)
+        self.assertEqual(self.breaker.state(106), "half-open")
+        self.breaker.record(0.1, False, now=107)
+        self.assertEqual(self.breaker.state(107), "closed")
+
+
+class SlowDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.config = dict((key, app.config[key]) for key in [
+            "MAX_PING", "BREAKER_MIN_CALLS", "BREAKER_SLOW_TIME",
+            "BREAKER_COOLDOWN"])
+        app.config["CIRCUIT_BREAKER"] = True
+        app.config["MAX_PING"] = 60
+        app.config["BREAKER_MIN_CALLS"] = 3
+        app.config["BREAKER_SLOW_TIME"] = 0.05
+        app.config["BREAKER_COOLDOWN"] = 60
+        install_breaker()
+
+        # a SQLite stand-in that takes delay seconds for every statement
+        self.delay = 0
+        self.statements = 0
+        event.listen(db.engine, "connect", self.slow_down)
+        db.session.remove()
+        db.engine.dispose()
+        db.create_all()
+        self.app = app.test_client()
+        btctxstore = BtcTxStore()
+        self.btc_addr, self.other_addr = [btctxstore.get_address(
+            btctxstore.get_key(btctxstore.create_wallet())) for _ in range(2)]
+        Farmer(self.btc_addr).register()
+
+    def tearDown(self):
+        event.remove(db.engine, "connect", self.slow_down)
+        app.config.update(self.config)
+        install_breaker()  # the listeners stay, with the default thresholds
+        app.config["CIRCUIT_BREAKER"] = False
+        breaker.reset()
+        recent_pings.clear()
+        stale_responses.clear()
+        db.session.remove()
+        db.engine.dispose()
+        db.drop_all()
+
+    def slow_down(self, dbapi_connection, connection_record):
+        def statement(sql):
+            self.statements += 1
+            time.sleep(self.delay)
+        dbapi_connection.set_trace_callback(statement)
+
+    def farmers(self, rv):
+        return [farmer["btc_addr"] for farmer in
+                json.loads(rv.data.decode("utf-8"))["farmers"]]
+
+    def test_background_statements(self):
+        self.delay = 0.1
+        for _ in range(5):
+            Farmer(self.btc_addr).lookup()  # outside of a request
+            db.session.remove()
+        self.assertEqual(breaker.state(), "closed")
+
+    def test_open_and_recover(self):
+        self.assertEqual(self.app.get("/api/online/json").status_code, 200)
+        self.assertEqual(self.app.get("/api/total").status_code, 200)
+
+        self.delay = 0.1
+        while breaker.state() == "closed":
+            self.app.get("/api/online/json")
+        statements = self.statements
+
+        rv = self.app.get("/api/online/json")  # the last slow response
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.farmers(rv), [self.btc_addr])
+        self.assertIn("Stale", rv.headers["Warning"])
+        self.assertEqual(self.app.get("/api/total").status_code, 200)
+        rv = self.app.get("/api/total/history")  # never served before
+        self.assertEqual(rv.status_code, 503)
+        self.assertTrue(0 < int(rv.headers["Retry-After"]) <= 60)
+
+        # registered just now, so this ping is throttled
+        rv = self.app.get("/api/ping/{0}".format(self.btc_addr))
+        self.assertEqual((rv.status_code, rv.data),
+                         (200, b"Ping accepted."))
+        rv = self.app.get("/api/ping/{0}".format(self.other_addr))
+        self.assertEqual(rv.status_code, 503)
+        rv = self.app.get("/api/register/{0}".format(self.other_addr))
+        self.assertEqual(rv.status_code, 503)
+        rv = self.app.get("/api/height/{0}/10".format(self.btc_addr))
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(self.statements, statements)  # nothing waited
+
+        # the database is fast again, the first request after the
+        # cooldown is the probe
+        self.delay = 0
+        breaker.opened -= 60
+        rv = self.app.get("/api/register/{0}".format(self.other_addr))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(breaker.state(), "closed")
+        rv = self.app.get("/api/online/json")
+        self.assertNotIn("Warning", rv.headers)
+        self.assertEqual(sorted(self.farmers(rv)),
+                         sorted([self.btc_addr, self.other_addr]))
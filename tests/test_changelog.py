@@ -0,0 +1,168 @@
+import json
+import time
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from dataserv.run import app, db
+from btctxstore import BtcTxStore
+from dataserv.Farmer import FarmerRecord
+from dataserv.events import EventHub, reset_hub
+from dataserv.changelog import ChangeLog
+
+
+def record(id, height, last_seen=None):
+    btc_addr = "addr{0}".format(id)
+    last_seen = last_seen or datetime.utcnow()
+    return FarmerRecord(id, btc_addr, btc_addr, height, last_seen,
+                        last_seen - timedelta(days=1), 0)
+
+
+class ChangeLogTest(unittest.TestCase):
+
+    def token(self, log):
+        """A watermark strictly between the entries before and after it."""
+        time.sleep(0.01)
+        token = log.token(time.time())
+        time.sleep(0.01)
+        return token
+
+    def test_since(self):
+        log = ChangeLog(10)
+        start = self.token(log)
+        log.put((1, "join", {"btc_addr": "a"}))
+        middle = self.token(log)
+        log.put((2, "height", {"btc_addr": "a"}))
+        log.put((3, "join", {"btc_addr": "b"}))
+        self.assertEqual(log.since(start), {"a": ("join", "height"),
+                                            "b": ("join", "join")})
+        self.assertEqual(log.since(middle), {"a": ("height", "height"),
+                                             "b": ("join", "join")})
+        self.assertEqual(log.since(self.token(log)), {})
+
+    def test_invalid_tokens(self):
+        log = ChangeLog(10)
+        log.put((1, "join", {"btc_addr": "a"}))
+        self.assertEqual(log.since("garbage"), None)
+        self.assertEqual(log.since("deadbeef-1"), None)
+        self.assertEqual(log.since(log.token(time.time() + 60)), None)
+        # older than the log
+        self.assertEqual(ChangeLog(10).since(log.token(log.start - 1)), None)
+
+    def test_retention(self):
+        log = ChangeLog(3)
+        tokens = [self.token(log)]
+        for version in range(1, 6):
+            log.put((version, "join", {"btc_addr": str(version)}))
+            tokens.append(self.token(log))
+        self.assertEqual(log.since(tokens[0]), None)
+        self.assertEqual(log.since(tokens[1]), None)
+        self.assertEqual(sorted(log.since(tokens[2])), ["3", "4", "5"])
+
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = EventHub(5, queue_size=10, retention=100)
+
+    def test_delta(self):
+        self.hub.on_farmer_change("register", record(1, 0), None)
+        self.hub.on_farmer_change("register", record(2, 0), None)
+        full = self.hub.delta(None)
+        self.assertTrue(full["full"])
+        self.assertEqual(len(full["farmers"]), 2)
+
+        self.hub.on_farmer_change("height", record(2, 9), record(2, 0))
+        self.hub.on_farmer_change("register", record(3, 0), None)
+        delta = self.hub.delta(full["version"])
+        self.assertFalse(delta["full"])
+        self.assertEqual([f["btc_addr"] for f in delta["added"]], ["addr3"])
+        self.assertEqual([f["height"] for f in delta["changed"]], [9])
+        self.assertEqual(delta["removed"], [])
+
+        # the first farmer times out
+        self.hub.wheel.update(record(1, 0, datetime.utcnow() -
+                                     timedelta(minutes=4, seconds=59)))
+        self.hub.wheel.expire(datetime.utcnow() + timedelta(seconds=2))
+        self.hub.publish("leave", {"btc_addr": "addr1"})
+        delta = self.hub.delta(delta["version"])
+        self.assertEqual(delta["removed"], ["addr1"])
+        self.assertEqual(delta["added"] + delta["changed"], [])
+
+    def test_token_too_old(self):
+        hub = EventHub(5, queue_size=10, retention=2)
+        token = hub.delta(None)["version"]
+        for i in range(3):
+            hub.on_farmer_change("register", record(i, 0), None)
+        delta = hub.delta(token)
+        self.assertTrue(delta["full"])
+        self.assertEqual(len(delta["farmers"]), 3)
+
+    def test_token_of_other_worker(self):
+        rows = [record(1, 0)]
+        workers = [EventHub(5, queue_size=10, loader=lambda: list(rows),
+                            resync=60) for _ in range(2)]
+        for hub in workers:
+            hub.load()
+        full = workers[0].delta(None)
+        self.assertEqual(len(full["farmers"]), 1)
+
+        # registered at the second worker, then asked there
+        time.sleep(0.01)
+        rows.append(record(2, 0))
+        workers[1].on_farmer_change("register", record(2, 0), None)
+        delta = workers[1].delta(full["version"])
+        self.assertFalse(delta["full"])
+        self.assertEqual([f["btc_addr"] for f in delta["added"]], ["addr2"])
+
+        # the first worker learns of it on its next sync
+        workers[0].sync()
+        delta = workers[0].delta(full["version"])
+        self.assertEqual([f["btc_addr"] for f in delta["added"]], ["addr2"])
+
+
+class OnlineDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = False
+        app.config["TIMEWHEEL_RESYNC"] = 0  # a single worker
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["DISABLE_CACHING"] = True
+        app.config["TIMEWHEEL_RESYNC"] = 60
+        reset_hub()
+        db.session.remove()
+        db.drop_all()
+
+    def new_address(self):
+        return self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+
+    def get(self, url):
+        return json.loads(self.app.get(url).data.decode("utf-8"))
+
+    def test_since(self):
+        addr1 = self.new_address()
+        self.app.get('/api/register/{0}'.format(addr1))
+
+        full = self.get('/api/online/json?since=')
+        self.assertTrue(full["full"])
+        self.assertEqual([f["btc_addr"] for f in full["farmers"]], [addr1])
+
+        addr2 = self.new_address()
+        self.app.get('/api/register/{0}'.format(addr2))
+        delta = self.get('/api/online/json?since=' + full["version"])
+        self.assertFalse(delta["full"])
+        self.assertEqual([f["btc_addr"] for f in delta["added"]], [addr2])
+
+        # nothing changed since the last token, not served from the cache
+        delta = self.get('/api/online/json?since=' + delta["version"])
+        self.assertEqual(delta["added"], [])
+
+        # unknown tokens fall back to the full list
+        delta = self.get('/api/online/json?since=deadbeef-3')
+        self.assertTrue(delta["full"])
+        self.assertEqual(len(delta["farmers"]), 2)
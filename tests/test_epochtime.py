@@ -0,0 +1,156 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from datetime import timedelta
+import sqlalchemy as sa
+from alembic.operations import Operations
+from alembic.migration import MigrationContext
+from dataserv.app import app, db, query_online_rows
+from dataserv.Farmer import Farmer, FarmerRecord, calculate_uptime
+from dataserv.serialize import FragmentCache
+from dataserv.epochtime import (EpochDateTime, convert, from_epoch,
+                                to_epoch, uptime_percent)
+
+
+def whole_seconds(when):
+    return when.replace(microsecond=0)
+
+
+class EpochTimeTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        now = whole_seconds(datetime.utcnow())
+        self.assertEqual(from_epoch(to_epoch(now)), now)
+        self.assertEqual(to_epoch(datetime(1970, 1, 2)), 86400)
+
+    def test_column_type(self):
+        engine = sa.create_engine("sqlite://")
+        metadata = sa.MetaData()
+        table = sa.Table("t", metadata, sa.Column("when", EpochDateTime))
+        metadata.create_all(engine)
+        now = whole_seconds(datetime.utcnow())
+        engine.execute(table.insert(), [{"when": now}, {"when": None}])
+        self.assertEqual([row[0] for row in engine.execute(
+            sa.select([table.c.when]))], [now, None])
+        raw = sa.type_coerce(table.c.when, sa.Integer)
+        self.assertEqual(engine.execute(
+            sa.select([raw]).where(raw > to_epoch(now) - 1)).scalar(),
+            to_epoch(now))
+        # datetimes in filters are converted too
+        self.assertEqual(engine.execute(sa.select([table.c.when]).where(
+            table.c.when > now - timedelta(seconds=1))).scalar(), now)
+
+    def test_uptime_percent(self):
+        now = whole_seconds(datetime.utcnow())
+        online_time = app.config["ONLINE_TIME"] * 60
+        cases = [(timedelta(days=1), timedelta(seconds=30), 3600),
+                 (timedelta(days=10), timedelta(days=2), 86400),
+                 (timedelta(hours=1), timedelta(seconds=0), 3500),
+                 (timedelta(seconds=0), timedelta(seconds=0), 0)]
+        for registered, seen, uptime in cases:
+            reg_time, last_seen = now - registered, now - seen
+            expected = calculate_uptime(reg_time, last_seen, uptime)
+            self.assertAlmostEqual(uptime_percent(
+                to_epoch(now), to_epoch(reg_time), to_epoch(last_seen),
+                uptime, online_time), expected, delta=0.01)
+
+    def test_render_rows(self):
+        now = whole_seconds(datetime.utcnow())
+        records = [FarmerRecord(i, "addr{0}".format(i), "pay{0}".format(i),
+                                30 - i, now - timedelta(seconds=10 * i),
+                                now - timedelta(days=i), 1000 * i)
+                   for i in range(1, 4)]
+        rows = [record[:4] + (to_epoch(record.last_seen),
+                              to_epoch(record.reg_time), record.uptime)
+                for record in records]
+        body = json.loads(FragmentCache().render_rows(rows, to_epoch(now)))
+        self.assertEqual([farmer["btc_addr"] for farmer in body["farmers"]],
+                         ["addr1", "addr2", "addr3"])
+        self.assertEqual([farmer["last_seen"] for farmer in body["farmers"]],
+                         [10, 20, 30])
+        expected = json.loads(FragmentCache().render(records, now))
+        for farmer, other in zip(body["farmers"], expected["farmers"]):
+            self.assertAlmostEqual(farmer.pop("uptime"), other.pop("uptime"),
+                                   delta=0.01)
+            self.assertEqual(farmer, other)
+
+
+class ConvertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = sa.create_engine("sqlite:///" + os.path.join(
+            self.directory, "convert.db"))
+        self.metadata = sa.MetaData()
+        self.farmer = sa.Table(
+            "farmer", self.metadata,
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("btc_addr", sa.String(35), unique=True),
+            sa.Column("last_seen", sa.DateTime, index=True),
+            sa.Column("reg_time", sa.DateTime))
+        self.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def convert(self, epoch):
+        with self.engine.begin() as connection:
+            convert(Operations(MigrationContext.configure(connection)), epoch)
+
+    def column_types(self):
+        inspector = sa.inspect(self.engine)
+        return dict((c["name"], type(c["type"]).__name__)
+                    for c in inspector.get_columns("farmer"))
+
+    def test_convert(self):
+        now = whole_seconds(datetime.utcnow())
+        rows = [{"btc_addr": "a", "last_seen": now,
+                 "reg_time": now - timedelta(days=3)},
+                {"btc_addr": "b", "last_seen": None, "reg_time": now}]
+        self.engine.execute(self.farmer.insert(), rows)
+
+        self.convert(True)
+        self.assertEqual(self.column_types()["last_seen"], "INTEGER")
+        self.assertEqual(list(self.engine.execute(
+            "SELECT last_seen, reg_time FROM farmer ORDER BY id")),
+            [(to_epoch(now), to_epoch(now) - 3 * 86400),
+             (None, to_epoch(now))])
+        indexes = sa.inspect(self.engine).get_indexes("farmer")
+        self.assertEqual([i["column_names"] for i in indexes],
+                         [["last_seen"]])
+        self.convert(True)  # already converted
+
+        self.convert(False)
+        self.assertEqual(self.column_types()["reg_time"], "DATETIME")
+        self.assertEqual([dict(row) for row in self.engine.execute(
+            sa.select([self.farmer.c.btc_addr, self.farmer.c.last_seen,
+                       self.farmer.c.reg_time]).order_by(self.farmer.c.id))],
+            rows)
+
+
+@unittest.skipUnless(app.config["EPOCH_TIMES"], "needs DATASERV_EPOCH_TIMES")
+class OnlineRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_online_rows(self):
+        now = whole_seconds(datetime.utcnow())
+        db.engine.execute(Farmer.__table__.insert(), [
+            {"btc_addr": "online", "payout_addr": "online", "height": 1,
+             "last_seen": now, "reg_time": now, "uptime": 0},
+            {"btc_addr": "offline", "payout_addr": "offline", "height": 2,
+             "last_seen": now - timedelta(hours=1), "reg_time": now,
+             "uptime": 0}])
+        rows = query_online_rows()
+        self.assertEqual([tuple(row)[1:] for row in rows],
+                         [("online", "online", 1, to_epoch(now),
+                           to_epoch(now), 0)])
@@ -0,0 +1,140 @@
+import json
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from dataserv.run import app, db
+from btctxstore import BtcTxStore
+from dataserv.Farmer import FarmerRecord
+from dataserv.events import EventHub, Subscriber, reset_hub
+
+
+def record(id, height, last_seen=None):
+    btc_addr = "addr{0}".format(id)
+    last_seen = last_seen or datetime.utcnow()
+    return FarmerRecord(id, btc_addr, btc_addr, height, last_seen,
+                        last_seen - timedelta(days=1), 0)
+
+
+def parse(chunk):
+    """(event, data) of one server-sent event."""
+    fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+    return fields["event"], json.loads(fields["data"])
+
+
+class EventHubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = EventHub(5, queue_size=3)
+
+    def test_snapshot(self):
+        self.hub.wheel.load([record(1, 10), record(2, 20)])
+        subscriber, snapshot, version = self.hub.subscribe()
+        self.assertEqual([r.id for r in snapshot], [2, 1])
+        self.assertEqual(version, 0)
+
+    def test_join_height_leave(self):
+        subscriber, snapshot, version = self.hub.subscribe()
+        self.hub.on_farmer_change("register", record(1, 0), None)
+        self.hub.on_farmer_change("ping", record(1, 0), record(1, 0))
+        self.hub.on_farmer_change("height", record(1, 7), record(1, 0))
+        events = subscriber.get(0)
+        self.assertEqual([(v, e) for v, e, data in events],
+                         [(1, "join"), (2, "height")])
+        self.assertEqual(events[1][2]["height"], 7)
+
+        later = datetime.utcnow() + timedelta(minutes=6)
+        self.hub.expire(later)
+        self.assertEqual(subscriber.get(0),
+                         [(3, "leave", {"btc_addr": "addr1"})])
+
+        # back online
+        self.hub.on_farmer_change("ping", record(1, 7), record(1, 7))
+        self.assertEqual(subscriber.get(0)[0][1], "join")
+
+    def test_slow_consumer_dropped(self):
+        slow, _, _ = self.hub.subscribe()
+        fast, _, _ = self.hub.subscribe()
+        for i in range(3):
+            self.hub.on_farmer_change("register", record(i, 0), None)
+            fast.get(0)
+        self.assertFalse(slow.dropped)
+        self.hub.on_farmer_change("register", record(9, 0), None)
+        self.assertTrue(slow.dropped)
+        self.assertFalse(slow in self.hub.subscribers)
+        self.assertTrue(fast in self.hub.subscribers)
+        self.assertEqual(len(fast.get(0)), 1)
+
+    def test_get_timeout(self):
+        self.assertEqual(Subscriber(10).get(0.01), [])
+
+    def test_pinged_other_worker(self):
+        rows = [record(1, 0)]
+        loads = []
+
+        def loader(btc_addrs=None):
+            loads.append(btc_addrs)
+            return [row for row in rows
+                    if btc_addrs is None or row.btc_addr in btc_addrs]
+        hub = EventHub(5, queue_size=10, loader=loader, resync=60)
+        hub.sync()
+        subscriber, snapshot, version = hub.subscribe()
+        self.assertEqual([r.id for r in snapshot], [1])
+
+        # another worker took a ping of 1 and the registration of 2,
+        # only the expired farmer is looked up
+        now = datetime.utcnow()
+        rows[:] = [record(1, 0, now + timedelta(minutes=4)),
+                   record(2, 3, now + timedelta(minutes=4))]
+        hub.expire(now + timedelta(minutes=6))
+        self.assertEqual(subscriber.get(0), [])
+        self.assertEqual(loads, [None, ["addr1"]])
+
+        # the next resync brings the join
+        hub.synced -= 60
+        hub.expire(now + timedelta(minutes=6))
+        self.assertEqual([(e, data["btc_addr"]) for v, e, data
+                          in subscriber.get(0)], [("join", "addr2")])
+
+        hub.expire(now + timedelta(minutes=10))
+        self.assertEqual(sorted(data["btc_addr"] for v, e, data
+                                in subscriber.get(0)), ["addr1", "addr2"])
+        self.assertEqual(len(hub.wheel), 0)
+
+
+class OnlineEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        reset_hub()
+        db.session.remove()
+        db.drop_all()
+
+    def new_address(self):
+        return self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+
+    def test_stream(self):
+        addr1 = self.new_address()
+        self.app.get('/api/register/{0}'.format(addr1))
+
+        rv = self.app.get('/api/online/events', buffered=False)
+        self.assertEqual(rv.mimetype, "text/event-stream")
+        chunks = iter(rv.response)
+        event, data = parse(next(chunks).decode("utf-8"))
+        self.assertEqual(event, "snapshot")
+        self.assertEqual([f["btc_addr"] for f in data["farmers"]], [addr1])
+
+        addr2 = self.new_address()
+        self.app.get('/api/register/{0}'.format(addr2))
+        self.app.get('/api/height/{0}/{1}'.format(addr1, 30))
+        event, data = parse(next(chunks).decode("utf-8"))
+        self.assertEqual((event, data["btc_addr"]), ("join", addr2))
+        event, data = parse(next(chunks).decode("utf-8"))
+        self.assertEqual((event, data["height"]), ("height", 30))
+        rv.close()
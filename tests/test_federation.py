@@ -0,0 +1,181 @@
+import json
+import time
+import socket
+import threading
+import unittest
+from dataserv.run import app, db
+from btctxstore import BtcTxStore
+from dataserv.federation import Federation
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+class StandInNode(object):
+
+    def __init__(self, total, farmers, delay=0):
+        """Local http server answering like a dataserv node."""
+        self.total = total
+        self.farmers = farmers
+        self.delay = delay
+        self.status = 200
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(node.delay)
+                if self.path == "/api/total":
+                    body = json.dumps(node.total)
+                else:
+                    body = json.dumps({"farmers": node.farmers})
+                self.send_response(node.status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body.encode("utf-8"))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def closed_port_url():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "http://127.0.0.1:{0}".format(port)
+
+
+def farmer(btc_addr, height, last_seen):
+    return {"btc_addr": btc_addr, "payout_addr": btc_addr, "height": height,
+            "last_seen": last_seen, "uptime": 100}
+
+
+class FederationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.node1 = StandInNode(
+            {"id": 1, "total_TB": 1.5, "total_farmers": 2},
+            [farmer("addr1", 100, 5), farmer("addr2", 10, 5)])
+        self.node2 = StandInNode(
+            {"id": 1, "total_TB": 0.25, "total_farmers": 1},
+            [farmer("addr1", 120, 2)])
+        self.slow = StandInNode(
+            {"id": 1, "total_TB": 100.0, "total_farmers": 100}, [], delay=2)
+
+    def tearDown(self):
+        for node in (self.node1, self.node2, self.slow):
+            node.stop()
+
+    def test_network_total(self):
+        peers = Federation([self.node1.url, self.node2.url], timeout=1,
+                           max_age=300)
+        peers.refresh()
+        local = {"id": 7, "total_TB": 0.5, "total_farmers": 1}
+        total = peers.network_total(local, [farmer("addr3", 50, 1)],
+                                    1024 ** 4 / 100)
+        self.assertEqual(total["id"], 7)
+        # addr1 is known to both peers and counted once, at height 120
+        self.assertEqual(total["total_farmers"], 3)
+        self.assertEqual(total["total_TB"], 1.8)
+        self.assertTrue(all(peer["ok"] for peer in total["peers"]))
+
+    def test_network_farmers(self):
+        peers = Federation([self.node1.url, self.node2.url], timeout=1,
+                           max_age=300)
+        peers.refresh()
+        farmers = peers.network_farmers([farmer("addr3", 50, 1)])
+
+        # addr1 is known to both peers, the most recent entry wins
+        self.assertEqual([f["btc_addr"] for f in farmers],
+                         ["addr1", "addr3", "addr2"])
+        self.assertEqual(farmers[0]["height"], 120)
+
+    def test_timeout_and_dead_peer(self):
+        dead = closed_port_url()
+        peers = Federation([self.node1.url, self.slow.url, dead], timeout=0.5,
+                           max_age=300)
+        start = time.time()
+        peers.refresh()
+        self.assertTrue(time.time() - start < 1.5)  # peers run concurrently
+
+        total = peers.network_total({"id": 1, "total_TB": 0,
+                                     "total_farmers": 0}, [], 1)
+        self.assertEqual(total["total_farmers"], 2)
+        status = dict((peer["peer"], peer) for peer in total["peers"])
+        self.assertTrue(status[self.node1.url]["ok"])
+        self.assertFalse(status[self.slow.url]["ok"])
+        self.assertFalse(status[dead]["ok"])
+        self.assertEqual(status[dead]["age"], None)
+
+    def test_last_good_result(self):
+        peers = Federation([self.node1.url], timeout=0.5,
+                           max_age=300)
+        peers.refresh()
+
+        # the peer starts failing, its last good numbers are kept
+        self.node1.status = 500
+        peers.refresh()
+        total = peers.network_total({"id": 1, "total_TB": 0,
+                                     "total_farmers": 0}, [], 1)
+        self.assertEqual(total["total_farmers"], 2)
+        self.assertFalse(total["peers"][0]["ok"])
+        self.assertEqual(total["peers"][0]["age"], 0)
+        self.assertFalse(total["peers"][0]["expired"])
+
+        # until they are older than max_age
+        peers.results[self.node1.url].fetched -= 301
+        total = peers.network_total({"id": 1, "total_TB": 0,
+                                     "total_farmers": 0}, [], 1)
+        self.assertEqual(total["total_farmers"], 0)
+        self.assertEqual(total["peers"][0]["age"], 301)
+        self.assertTrue(total["peers"][0]["expired"])
+        self.assertEqual(peers.network_farmers([]), [])
+
+
+class NetworkAppTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.node = StandInNode(
+            {"id": 1, "total_TB": 1.5, "total_farmers": 2},
+            [farmer("addr1", 100, 5), farmer("addr2", 10, 5)])
+        self.app = app.test_client()
+        self.btctxstore = BtcTxStore()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["PEER_NODES"] = []
+        self.node.stop()
+        db.session.remove()
+        db.drop_all()
+
+    def test_not_configured(self):
+        rv = self.app.get('/api/network/total')
+        self.assertEqual(rv.status_code, 404)
+        rv = self.app.get('/api/network/online/json')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_network_view(self):
+        app.config["PEER_NODES"] = [self.node.url]
+        btc_addr = self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+        self.app.get('/api/register/{0}'.format(btc_addr))
+
+        rv = self.app.get('/api/network/total')
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data.decode("utf-8"))
+        self.assertEqual(data["total_farmers"], 3)
+
+        rv = self.app.get('/api/network/online/json')
+        data = json.loads(rv.data.decode("utf-8"))
+        addresses = [f["btc_addr"] for f in data["farmers"]]
+        self.assertEqual(addresses, ["addr1", "addr2", btc_addr])
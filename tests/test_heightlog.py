@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from btctxstore import BtcTxStore
+from dataserv.app import app, db
+from dataserv.Farmer import Farmer
+from dataserv.heightlog import (DAY, HEADER, RECORD, HeightChange, HeightLog,
+                                HeightLogReader, compact, get_height_log,
+                                install_height_log, locked, segments,
+                                stop_height_log)
+
+
+class HeightLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = HeightLog(self.directory, HEADER.size + 4 * RECORD.size,
+                             3600)
+
+    def tearDown(self):
+        self.log.stop()
+        shutil.rmtree(self.directory)
+
+    def reader(self):
+        return HeightLogReader(self.directory)
+
+    def test_append_and_read(self):
+        self.log.append("a1", 100, 0, 10)
+        self.log.append("a2", 101, 0, 20)
+        with self.reader() as reader:
+            self.assertEqual(len(reader), 0)  # not flushed yet
+        self.assertEqual(self.log.flush(), 2)
+        self.assertEqual(self.log.flush(), 0)
+        with self.reader() as reader:
+            self.assertEqual(list(reader.scan()),
+                             [HeightChange("a1", 100, 0, 10),
+                              HeightChange("a2", 101, 0, 20)])
+
+    def test_rotation(self):
+        for i in range(10):
+            self.log.append("a{0}".format(i % 3), 100 + i, i, i + 1)
+            self.log.flush()
+        self.assertEqual([(s.first, s.last) for s in
+                          segments(self.directory)], [(1, 1), (2, 2), (3, 3)])
+        with self.reader() as reader:
+            self.assertEqual([c.timestamp for c in reader.scan()],
+                             list(range(100, 110)))
+            self.assertEqual([c.new for c in reader.history("a1")], [2, 5, 8])
+
+    def test_history_skips_other_addresses(self):
+        # a7 is also the start of a70
+        self.log.append("a70", 7, 7, 7)
+        self.log.append("a7", 8, 0, 7)
+        self.log.append("7a7", 9, 7, 8)
+        self.log.flush()
+        with self.reader() as reader:
+            self.assertEqual(reader.history("a7"),
+                             [HeightChange("a7", 8, 0, 7)])
+            self.assertEqual(reader.history("a9"), [])
+
+    def test_torn_record_ignored(self):
+        self.log.append("a1", 100, 0, 10)
+        self.log.flush()
+        with open(segments(self.directory)[-1].path, "ab") as f:
+            f.write(b"\x01\x02\x03")
+        with self.reader() as reader:
+            self.assertEqual(len(reader), 1)
+
+    def test_compact(self):
+        day = 10 * DAY
+        changes = [("a1", day, 0, 5), ("a2", day + 1, 0, 3),
+                   ("a1", day + 2, 5, 9), ("a1", day + DAY, 9, 12),
+                   ("a3", day + DAY + 1, 0, 1), ("a1", day + 2 * DAY, 12, 20)]
+        for change in changes:
+            self.log.append(*change)
+            self.log.flush()
+        # segments of 4 changes: 1-4, 5-6
+        self.assertEqual(len(segments(self.directory)), 2)
+        self.assertEqual(compact(self.directory, day + 2 * DAY), (1, 4, 3))
+        self.assertEqual([(s.first, s.last) for s in
+                          segments(self.directory)], [(1, 1), (2, 2)])
+
+        for change in [("a4", day + 3 * DAY, 0, 1),
+                       ("a4", day + 3 * DAY + 1, 1, 2),
+                       ("a5", day + 4 * DAY, 0, 1)]:
+            self.log.append(*change)
+            self.log.flush()  # the last one seals the second segment
+        replaced = compact(self.directory, day + 4 * DAY, bucket=DAY,
+                           drop_before=day + DAY)
+        self.assertEqual(replaced, (2, 7, 4))
+        self.assertEqual([(s.first, s.last) for s in
+                          segments(self.directory)], [(1, 2), (3, 3)])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["000000000001-000000000002.hlog",
+                          "000000000003.hlog", "lock"])
+        with self.reader() as reader:
+            self.assertEqual(list(reader.scan()), [
+                HeightChange("a1", day + DAY, 9, 12),
+                HeightChange("a3", day + DAY + 1, 0, 1),
+                HeightChange("a1", day + 2 * DAY, 12, 20),
+                HeightChange("a4", day + 3 * DAY + 1, 0, 2),
+                HeightChange("a5", day + 4 * DAY, 0, 1)])
+
+    def test_compact_waits_for_lock(self):
+        for timestamp in range(6):
+            self.log.append("a1", timestamp, timestamp, timestamp + 1)
+            self.log.flush()
+        result = []
+        with locked(self.directory):
+            thread = threading.Thread(target=lambda: result.append(
+                compact(self.directory, 10)))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual(result, [(1, 4, 1)])
+
+    def test_interrupted_compaction(self):
+        for timestamp in range(6):
+            self.log.append("a1", timestamp, timestamp, timestamp + 1)
+            self.log.flush()
+        original = os.path.join(self.directory, "000000000001.hlog")
+        shutil.copy(original, os.path.join(
+            self.directory, "000000000001-000000000001.hlog"))
+        with self.reader() as reader:  # the copy hides the original
+            self.assertEqual(len(reader), 6)
+
+
+class FarmerHeightLogTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        self.directory = tempfile.mkdtemp()
+        app.config["HEIGHT_LOG_DIR"] = self.directory
+        install_height_log()
+        db.create_all()
+
+    def tearDown(self):
+        stop_height_log()
+        app.config["HEIGHT_LOG_DIR"] = None
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.directory)
+
+    def test_set_height(self):
+        btctxstore = BtcTxStore()
+        btc_addr = btctxstore.get_address(btctxstore.get_key(
+            btctxstore.create_wallet()))
+        farmer = Farmer(btc_addr)
+        farmer.register()
+        farmer.set_height(10)
+        farmer.set_height(10)  # unchanged, not logged
+        farmer.set_height(25)
+        get_height_log().flush()
+        with HeightLogReader(self.directory) as reader:
+            self.assertEqual([(c.old, c.new) for c in
+                              reader.history(btc_addr)], [(0, 10), (10, 25)])
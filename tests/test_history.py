@@ -0,0 +1,112 @@
+import json
+import time
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from dataserv.app import app, db
+from dataserv.Farmer import Farmer
+from dataserv.history import (DAY, HOUR, NetworkTotal, choose_period,
+                              epoch_period, parse_period, query_history,
+                              record_totals)
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["TOTAL_UPDATE"] = 30
+        self.app = app.test_client()
+        db.create_all()
+        now = datetime.utcnow()
+        offline = now - timedelta(hours=1)
+        rows = [{"btc_addr": "online{0}".format(height), "height": height,
+                 "last_seen": now, "reg_time": now, "uptime": 0}
+                for height in range(1, 101)]
+        rows.append({"btc_addr": "offline", "height": 5000,
+                     "last_seen": offline, "reg_time": offline, "uptime": 0})
+        db.engine.execute(Farmer.__table__.insert(), rows)
+        # a day boundary, the start of the first half hour epoch
+        self.day = int(time.time()) // DAY * DAY - DAY
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def rows(self, period):
+        return NetworkTotal.query.filter_by(period=period).order_by(
+            NetworkTotal.start).all()
+
+    def test_record_totals(self):
+        self.assertTrue(record_totals(self.day + 10))
+        self.assertFalse(record_totals(self.day + 20))  # same epoch
+        row, = self.rows(epoch_period())
+        self.assertEqual(row.start, self.day)
+        self.assertEqual((row.farmers, row.height), (100, 5050))
+        self.assertEqual((row.height_p50, row.height_p90, row.height_p99),
+                         (51, 91, 100))
+        self.assertAlmostEqual(row.total_tb, 5050 * 128 / 1024.0 ** 2)
+
+    def test_rollups(self):
+        record_totals(self.day)
+        Farmer.query.filter_by(btc_addr="online1").delete()
+        db.session.commit()
+        record_totals(self.day + epoch_period())
+        record_totals(self.day + HOUR)
+
+        hourly = self.rows(HOUR)
+        self.assertEqual([(r.start, r.epochs) for r in hourly],
+                         [(self.day, 2), (self.day + HOUR, 1)])
+        self.assertEqual(hourly[0].farmers, 100)  # 99.5 rounded
+        self.assertEqual(hourly[0].height, 5050)  # 5049.5 rounded
+        daily, = self.rows(DAY)
+        self.assertEqual((daily.start, daily.epochs), (self.day, 3))
+
+    def test_prune(self):
+        old = self.day - (app.config["HISTORY_RETENTION"] + 1) * DAY
+        record_totals(old)
+        self.assertEqual(len(self.rows(epoch_period())), 1)
+        record_totals(self.day)
+        self.assertEqual([r.start for r in self.rows(epoch_period())],
+                         [self.day])
+        self.assertEqual([r.start for r in self.rows(DAY)],
+                         [old - old % DAY, self.day])
+
+    def test_choose_period(self):
+        now = self.day + DAY
+        self.assertEqual(choose_period(now - 7 * DAY, now, now),
+                         epoch_period())
+        self.assertEqual(choose_period(now - 15 * DAY, now, now), HOUR)
+        self.assertEqual(choose_period(now - 3 * 365 * DAY, now, now), DAY)
+        self.assertEqual(parse_period("day"), DAY)
+        self.assertRaises(ValueError, parse_period, "minute")
+
+    def test_query_history(self):
+        for epoch in range(4):
+            record_totals(self.day + epoch * epoch_period())
+        period, rows = query_history(self.day, self.day + HOUR,
+                                     epoch_period(), now=self.day)
+        self.assertEqual([row.start for row in rows],
+                         [self.day, self.day + epoch_period()])
+        period, rows = query_history(self.day, self.day + DAY, now=self.day)
+        self.assertEqual((period, len(rows)), (epoch_period(), 4))
+
+    def test_route(self):
+        for epoch in range(3):
+            record_totals(self.day + epoch * HOUR)
+        rv = self.app.get("/api/total/history?from={0}&to={1}"
+                          "&resolution=hour".format(self.day,
+                                                    self.day + DAY))
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data.decode("utf-8"))
+        self.assertEqual(data["resolution"], HOUR)
+        self.assertEqual([t["start"] for t in data["totals"]],
+                         [self.day, self.day + HOUR, self.day + 2 * HOUR])
+        self.assertEqual(data["totals"][0]["total_farmers"], 100)
+        self.assertEqual(data["totals"][0]["height_p99"], 100)
+
+        rv = self.app.get("/api/total/history?from=yesterday")
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.get("/api/total/history?resolution=minute")
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.get("/api/total/history")
+        self.assertEqual(rv.status_code, 200)
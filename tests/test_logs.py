@@ -0,0 +1,74 @@
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from dataserv.run import app
+from dataserv.logs import SampleFilter, setup_logging, stop_logging
+
+
+def make_record(level, msg, *args):
+    return logging.LogRecord("test", level, __file__, 1, msg, args, None)
+
+
+class SampleFilterTest(unittest.TestCase):
+
+    def test_sampled(self):
+        dropping = SampleFilter(["CALLED /api/ping/"], 0.0)
+        ping = make_record(logging.INFO, "CALLED /api/ping/%s", "addr")
+        self.assertFalse(dropping.filter(ping))
+        self.assertTrue(SampleFilter(["CALLED /api/ping/"], 1.0).filter(ping))
+
+    def test_kept(self):
+        dropping = SampleFilter(["CALLED /api/ping/"], 0.0)
+        self.assertTrue(dropping.filter(make_record(
+            logging.INFO, "CALLED /api/height/%s/%s", "addr", 10)))
+        self.assertTrue(dropping.filter(make_record(
+            logging.WARNING, "CALLED /api/ping/%s", "addr")))
+
+
+class SetupLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "test.log")
+        self.logger = logging.getLogger("dataserv.test_logs")
+
+    def tearDown(self):
+        setup_logging(app.config)
+        shutil.rmtree(self.tmp_dir)
+
+    def config(self, **settings):
+        config = dict(app.config)
+        config.update(LOG_FILE=self.path, LOG_SAMPLE_RATE=0.0, **settings)
+        return config
+
+    def read(self):
+        stop_logging()  # flushes the queue
+        with open(self.path) as f:
+            return f.read()
+
+    def test_queue(self):
+        setup_logging(self.config(LOG_QUEUE=True))
+        self.logger.info("CALLED /api/height/%s/%s", "addr", 10)
+        self.logger.info("CALLED /api/ping/%s", "addr")
+        self.logger.warning("Farmer not found.")
+        content = self.read()
+        self.assertTrue("CALLED /api/height/addr/10" in content)
+        self.assertFalse("/api/ping/" in content)
+        self.assertTrue("WARNING dataserv.test_logs" in content)
+
+    def test_level(self):
+        setup_logging(self.config(LOG_QUEUE=False, LOG_LEVEL="WARNING"))
+        self.logger.info("CALLED /api/total")
+        self.logger.warning("Height limit exceeded.")
+        content = self.read()
+        self.assertFalse("CALLED" in content)
+        self.assertTrue("Height limit exceeded." in content)
+
+    def test_setup_twice(self):
+        root = logging.getLogger()
+        setup_logging(self.config(LOG_QUEUE=True))
+        handlers = len(root.handlers)
+        setup_logging(self.config(LOG_QUEUE=True))
+        self.assertEqual(len(root.handlers), handlers)
@@ -0,0 +1,179 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from btctxstore import BtcTxStore
+from dataserv.app import app, db, cache
+from dataserv.metrics import (Registry, registry, instrument,
+                              observe_signature)
+
+
+def sample(text, line_start):
+    """Value of the first exposition line starting with line_start."""
+    for line in text.splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_counter(self):
+        metrics = Registry()
+        labels = (("route", "/api/ping/<btc_addr>"), ("status", 200))
+        metrics.inc("dataserv_requests_total", labels)
+        metrics.inc("dataserv_requests_total", labels, 2)
+        text = metrics.render()
+        self.assertTrue("# TYPE dataserv_requests_total counter" in text)
+        self.assertTrue('dataserv_requests_total{route="/api/ping/<btc_addr>"'
+                        ',status="200"} 3' in text)
+
+    def test_histogram(self):
+        metrics = Registry()
+        labels = (("route", "/"), ("method", "GET"))
+        for value in (0.0005, 0.003, 0.003, 20):
+            metrics.observe("dataserv_request_seconds", labels, value)
+        text = metrics.render()
+        prefix = 'dataserv_request_seconds_bucket{route="/",method="GET",'
+        self.assertTrue(prefix + 'le="0.001"} 1' in text)
+        self.assertTrue(prefix + 'le="0.0025"} 1' in text)
+        self.assertTrue(prefix + 'le="0.005"} 3' in text)
+        self.assertTrue(prefix + 'le="10"} 3' in text)
+        self.assertTrue(prefix + 'le="+Inf"} 4' in text)
+        self.assertTrue('dataserv_request_seconds_count{route="/",'
+                        'method="GET"} 4' in text)
+
+    def test_merge(self):
+        first, second = Registry(), Registry()
+        labels = (("result", "valid"),)
+        first.observe("dataserv_signature_seconds", labels, 0.02)
+        second.observe("dataserv_signature_seconds", labels, 2.0)
+        second.inc("dataserv_cache_requests_total",
+                   (("view", "/api/total"), ("result", "hit")))
+        total = Registry()
+        total.merge(json.loads(json.dumps(first.snapshot())))
+        total.merge(json.loads(json.dumps(second.snapshot())))
+        text = total.render()
+        self.assertEqual(sample(text, 'dataserv_signature_seconds_count'), 2)
+        self.assertEqual(sample(text, 'dataserv_signature_seconds_bucket{'
+                                      'result="valid",le="0.025"}'), 1)
+        self.assertEqual(sample(text, 'dataserv_cache_requests_total'), 1)
+
+    def test_escaping(self):
+        metrics = Registry()
+        metrics.inc("dataserv_requests_total", (("route", 'a"b\\'),))
+        self.assertTrue('route="a\\"b\\\\"' in metrics.render())
+
+
+class MetricsEndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        app.config["METRICS"] = True
+        instrument(app, cache)
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        self.tmp_dir = tempfile.mkdtemp()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["DISABLE_CACHING"] = True
+        app.config["METRICS"] = False
+        app.config["METRICS_DIR"] = None
+        with app.app_context():
+            cache.clear()
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def metrics(self):
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.mimetype.startswith("text/plain"))
+        return rv.data.decode("utf-8")
+
+    def test_requests(self):
+        before = self.metrics()
+        register = ('dataserv_requests_total{route="/api/register/<btc_addr>"'
+                    ',method="GET",status="')
+        btc_addr = self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+        self.app.get('/api/register/{0}'.format(btc_addr))
+        self.app.get('/api/register/{0}'.format(btc_addr))
+        self.app.get('/api/register/invalid')
+        self.app.get('/api/height/{0}/{1}'.format(btc_addr, 10 ** 9))
+        text = self.metrics()
+
+        for status, count in [("200", 1), ("409", 1), ("400", 1)]:
+            self.assertEqual(sample(text, register + status + '"}') -
+                             sample(before, register + status + '"}'), count)
+        height = ('dataserv_requests_total{route="/api/height/<btc_addr>/'
+                  '<int:height>",method="GET",status="413"}')
+        self.assertEqual(sample(text, height) - sample(before, height), 1)
+        route = '{route="/api/register/<btc_addr>"}'
+        self.assertTrue(sample(text, 'dataserv_db_statements_total' + route) >
+                        sample(before, 'dataserv_db_statements_total' + route))
+        self.assertTrue(sample(text, 'dataserv_db_seconds_total' + route) > 0)
+        self.assertTrue('dataserv_request_seconds_bucket{route="/api/register/'
+                        '<btc_addr>",method="GET",le="+Inf"}' in text)
+
+    def test_failed_statement(self):
+        with db.engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.execute("SELECT * FROM no_such_table")
+            self.assertEqual(connection.info["metrics_start"], [])
+
+    def test_disabled(self):
+        app.config["METRICS"] = False
+        self.assertEqual(self.app.get('/metrics').status_code, 404)
+
+    def test_cache(self):
+        app.config["DISABLE_CACHING"] = False
+        with app.app_context():
+            cache.clear()
+        line = ('dataserv_cache_requests_total{{view="/api/total",'
+                'result="{0}"}}')
+        before = self.metrics()
+        for _ in range(3):
+            self.app.get('/api/total')
+        text = self.metrics()
+        for result, count in [("miss", 1), ("hit", 2)]:
+            self.assertEqual(sample(text, line.format(result)) -
+                             sample(before, line.format(result)), count)
+
+    def test_signatures(self):
+        wif = self.btctxstore.create_key()
+        app.config["SKIP_AUTHENTICATION"] = False
+        try:
+            self.app.get('/api/height/{0}/10'.format(
+                self.btctxstore.get_address(wif)),
+                headers={"Date": "Mon, 01 Jan 2018 00:00:00 GMT",
+                         "Authorization": "wrong"})
+        finally:
+            app.config["SKIP_AUTHENTICATION"] = True
+        observe_signature(0.05, True)
+        text = self.metrics()
+        self.assertTrue(sample(text, 'dataserv_signature_seconds_count{'
+                                     'result="invalid"}') >= 1)
+        self.assertTrue(sample(text, 'dataserv_signature_seconds_count{'
+                                     'result="valid"}') >= 1)
+
+    def test_workers(self):
+        app.config["METRICS_DIR"] = self.tmp_dir
+        other = Registry()
+        other.inc("dataserv_requests_total", (("route", "/other"),
+                                              ("method", "GET"),
+                                              ("status", 200)), 5)
+        with open(os.path.join(self.tmp_dir, "1-1.json"), "w") as f:
+            json.dump(other.snapshot(), f)
+        text = self.metrics()
+        self.assertEqual(sample(text, 'dataserv_requests_total{route="/other"'),
+                         5)
+        own = [name for name in os.listdir(self.tmp_dir)
+               if name.startswith("{0}-".format(os.getpid()))]
+        self.assertEqual(len(own), 1)
+        with open(os.path.join(self.tmp_dir, own[0])) as f:
+            self.assertEqual(len(json.load(f)["counters"]),
+                             len(registry.snapshot()["counters"]))
@@ -0,0 +1,52 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from dataserv.run import app, db
+from dataserv.Farmer import Farmer, is_btc_address
+from dataserv.population import (populate_database, random_farmer,
+                                 random_address)
+
+
+class PopulationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_random_farmer(self):
+        now = datetime.utcnow()
+        online = random_farmer(random_address(), now, 1.0, 300, 100)
+        self.assertTrue(is_btc_address(online["btc_addr"]))
+        self.assertTrue(now - online["last_seen"] <= timedelta(seconds=300))
+        self.assertTrue(online["reg_time"] < online["last_seen"])
+        self.assertTrue(0 <= online["height"] <= 100)
+        registered = online["last_seen"] - online["reg_time"]
+        self.assertTrue(online["uptime"] <= registered.total_seconds())
+
+        offline = random_farmer(random_address(), now, 0.0, 300, 100)
+        self.assertTrue(now - offline["last_seen"] > timedelta(seconds=300))
+
+    def test_populate(self):
+        key_file = os.path.join(self.tmp_dir, "keys.csv")
+        addresses = populate_database(50, keys=2, online=0.5, processes=2,
+                                      key_file=key_file)
+        self.assertEqual(len(set(addresses)), 50)
+        self.assertEqual(db.session.query(Farmer).count(), 50)
+
+        with open(key_file) as f:
+            keys = list(csv.reader(f))
+        self.assertEqual([address for address, _ in keys], addresses[:2])
+
+        # farmers are usable by the app
+        farmer = Farmer(addresses[10]).lookup()
+        self.assertEqual(farmer.payout_addr, addresses[10])
+        self.assertTrue(0 <= farmer.calculate_uptime() <= 100)
@@ -0,0 +1,128 @@
+import os
+import pstats
+import shutil
+import cProfile
+import tempfile
+import unittest
+from time import mktime
+from datetime import datetime
+from email.utils import formatdate
+from btctxstore import BtcTxStore
+from dataserv.app import app, db
+from dataserv.profiler import (RouteProfiles, route_name, profiles,
+                               profile_requests)
+
+
+def work():
+    return sum(range(1000))
+
+
+class RouteProfilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_route_name(self):
+        self.assertEqual(route_name("/api/ping/<btc_addr>"),
+                         "api_ping_btc_addr")
+        self.assertEqual(route_name("/"), "index")
+
+    def test_aggregate(self):
+        route_profiles = RouteProfiles()
+        for _ in range(3):
+            profile = cProfile.Profile()
+            profile.runcall(work)
+            route_profiles.add("/work", profile)
+        path = route_profiles.dump("/work", self.tmp_dir)
+        self.assertEqual(os.path.basename(path),
+                         "work.{0}.prof".format(os.getpid()))
+        stats = pstats.Stats(path)
+        calls = [value[1] for key, value in stats.stats.items()
+                 if key[2] == "work"]
+        self.assertEqual(calls, [3])
+
+        # not again within max_age, unknown routes are skipped
+        self.assertEqual(route_profiles.dump("/work", self.tmp_dir, 60), None)
+        self.assertEqual(route_profiles.dump("/other", self.tmp_dir), None)
+
+
+class ProfilerAppTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.tmp_dir = tempfile.mkdtemp()
+        app.config["PROFILE_DIR"] = self.tmp_dir
+        app.config["PROFILE_DUMP"] = 0
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["PROFILE_RATE"] = 0.0
+        app.config["ADMIN_ADDRESS"] = None
+        app.config["PROFILE_DIR"] = "profiles"
+        app.config["PROFILE_DUMP"] = 30
+        app.config["REPLAY_PROTECTION"] = False
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_disabled(self):
+        self.assertFalse(profile_requests(app))
+
+    def test_sampled(self):
+        app.config["PROFILE_RATE"] = 1.0
+        self.assertTrue(profile_requests(app))
+        self.app.get('/api/total')
+        path = os.path.join(self.tmp_dir,
+                            "api_total.{0}.prof".format(os.getpid()))
+        stats = pstats.Stats(path)
+        self.assertTrue([key for key in stats.stats if key[2] == "total"])
+
+        app.config["PROFILE_RATE"] = 0.0
+        os.remove(path)
+        self.app.get('/api/total')
+        self.assertFalse(os.path.exists(path))
+
+    def test_admin(self):
+        app.config["REPLAY_PROTECTION"] = True
+        wif = self.btctxstore.create_key()
+        app.config["ADMIN_ADDRESS"] = self.btctxstore.get_address(wif)
+        self.assertTrue(profile_requests(app))
+
+        header_date = formatdate(timeval=mktime(datetime.now().timetuple()),
+                                 localtime=True, usegmt=True)
+        message = app.config["ADDRESS"] + " " + header_date
+        headers = {"Date": header_date, "X-Profile": "1",
+                   "Authorization": self.btctxstore.sign_unicode(wif,
+                                                                 message)}
+        rv = self.app.get('/api/address', headers=headers)
+        self.assertEqual(rv.headers["X-Profile"],
+                         "api_address.{0}.prof".format(os.getpid()))
+        self.assertTrue("/api/address" in profiles.stats)
+
+        # unsigned or replayed requests are not profiled
+        rv = self.app.get('/api/address', headers={"X-Profile": "1"})
+        self.assertFalse("X-Profile" in rv.headers)
+        rv = self.app.get('/api/address', headers=headers)
+        self.assertFalse("X-Profile" in rv.headers)
+
+    def test_admin_route_profiled(self):
+        # the profiler and the route check the same admin headers once
+        app.config["REPLAY_PROTECTION"] = True
+        wif = self.btctxstore.create_key()
+        app.config["ADMIN_ADDRESS"] = self.btctxstore.get_address(wif)
+        self.assertTrue(profile_requests(app))
+        header_date = formatdate(timeval=mktime(datetime.now().timetuple()),
+                                 localtime=True, usegmt=True)
+        message = app.config["ADDRESS"] + " " + header_date
+        headers = {"Date": header_date, "X-Profile": "1",
+                   "Authorization": self.btctxstore.sign_unicode(wif,
+                                                                 message)}
+        rv = self.app.get('/api/admin/slow-queries', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue("X-Profile" in rv.headers)
@@ -0,0 +1,131 @@
+import time
+import unittest
+import storjcore
+from time import mktime
+from datetime import datetime
+from email.utils import formatdate
+from btctxstore import BtcTxStore
+from dataserv.run import app, db
+from dataserv.Farmer import Farmer
+from dataserv.replay import ReplayGuard, header_time
+
+
+def headers_at(timestamp, signature="sig"):
+    return {"Date": formatdate(timeval=timestamp, usegmt=True),
+            "Authorization": signature}
+
+
+class ReplayGuardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.guard = ReplayGuard(20, width=5)
+        self.now = 1000000.0
+
+    def test_header_time(self):
+        self.assertEqual(header_time(headers_at(self.now)), self.now)
+        self.assertEqual(header_time({"Date": None}), None)
+        self.assertEqual(header_time({"Date": "yesterday"}), None)
+
+    def test_seen(self):
+        headers = headers_at(self.now)
+        self.assertFalse(self.guard.seen("addr", headers, self.now))
+        self.assertTrue(self.guard.add("addr", headers, self.now))
+        self.assertTrue(self.guard.seen("addr", headers, self.now + 1))
+        self.assertFalse(self.guard.add("addr", headers, self.now + 1))
+
+        # same headers for another request, from another sender, with
+        # another signature or date
+        self.assertFalse(self.guard.seen("addr", headers, self.now,
+                                         "GET /api/ping/addr"))
+        self.assertFalse(self.guard.seen("other", headers, self.now))
+        self.assertFalse(self.guard.seen("addr", headers_at(self.now, "x"),
+                                         self.now))
+        self.assertFalse(self.guard.seen("addr", headers_at(self.now + 1),
+                                         self.now))
+
+    def test_expire(self):
+        headers = headers_at(self.now)
+        self.guard.add("addr", headers, self.now)
+        # still valid until the date is timeout seconds old
+        self.assertTrue(self.guard.seen("addr", headers, self.now + 19))
+        self.assertFalse(self.guard.seen("addr", headers, self.now + 25))
+        self.assertEqual(self.guard.buckets, {})
+
+    def test_future_dates_kept(self):
+        headers = headers_at(self.now + 15)
+        self.guard.add("addr", headers, self.now)
+        self.assertTrue(self.guard.seen("addr", headers, self.now + 30))
+
+    def test_bounded(self):
+        for i in range(1000):
+            self.guard.add("addr", headers_at(self.now + i // 10, str(i)),
+                           self.now + i // 10)
+        # only the last timeout + width seconds of dates are kept
+        self.assertTrue(len(self.guard) <= 10 * (20 + 5))
+        self.assertTrue(len(self.guard.buckets) <= 6)
+
+
+class FarmerReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = False
+        app.config["REPLAY_PROTECTION"] = True
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["SKIP_AUTHENTICATION"] = True
+        app.config["REPLAY_PROTECTION"] = False
+        db.session.remove()
+        db.drop_all()
+
+    def signed_headers(self, wif, date=None):
+        date = date or datetime.now()
+        header_date = formatdate(timeval=mktime(date.timetuple()),
+                                 localtime=True, usegmt=True)
+        message = app.config["ADDRESS"] + " " + header_date
+        return {"Date": header_date,
+                "Authorization": self.btctxstore.sign_unicode(wif, message)}
+
+    def test_replay_rejected(self):
+        wif = self.btctxstore.create_key()
+        farmer = Farmer(self.btctxstore.get_address(wif))
+        headers = self.signed_headers(wif)
+        self.assertTrue(farmer.authenticate(headers))
+        self.assertRaises(storjcore.auth.AuthError, farmer.authenticate,
+                          headers)
+
+        app.config["REPLAY_PROTECTION"] = False
+        self.assertTrue(farmer.authenticate(headers))
+
+    def test_failed_not_recorded(self):
+        wif = self.btctxstore.create_key()
+        other = Farmer(self.btctxstore.get_address(
+            self.btctxstore.create_key()))
+        headers = self.signed_headers(wif)
+        self.assertRaises(storjcore.auth.AuthError, other.authenticate,
+                          headers)
+        farmer = Farmer(self.btctxstore.get_address(wif))
+        self.assertTrue(farmer.authenticate(headers))
+
+    def test_replayed_request(self):
+        wif = self.btctxstore.create_key()
+        btc_addr = self.btctxstore.get_address(wif)
+        headers = self.signed_headers(wif)
+        rv = self.app.get('/api/register/{0}'.format(btc_addr),
+                          headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        # another request signed in the same second is no replay
+        rv = self.app.get('/api/height/{0}/10'.format(btc_addr),
+                          headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/api/height/{0}/10'.format(btc_addr),
+                          headers=headers)
+        self.assertEqual(rv.status_code, 401)
+
+        # fresh headers for the next second are accepted
+        time.sleep(1)
+        rv = self.app.get('/api/height/{0}/10'.format(btc_addr),
+                          headers=self.signed_headers(wif))
+        self.assertEqual(rv.status_code, 200)
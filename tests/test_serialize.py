@@ -0,0 +1,85 @@
+import json
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from dataserv.run import app, db
+from btctxstore import BtcTxStore
+from dataserv.Farmer import Farmer, FarmerRecord
+from dataserv import serialize
+from dataserv.serialize import FragmentCache
+
+
+def record(id, height, payout_addr=None):
+    btc_addr = "addr{0}".format(id)
+    now = datetime.utcnow()
+    return FarmerRecord(id, btc_addr, payout_addr or btc_addr, height,
+                        now - timedelta(seconds=id), now - timedelta(days=1),
+                        3600)
+
+
+class FragmentCacheTest(unittest.TestCase):
+
+    def test_render(self):
+        farmers = [record(1, 20), record(2, 10)]
+        body = FragmentCache().render(farmers)
+        data = json.loads(body)
+        self.assertEqual(data["farmers"], [f.to_dict() for f in farmers])
+
+    def test_empty(self):
+        self.assertEqual(json.loads(FragmentCache().render([])),
+                         {"farmers": []})
+
+    def test_reuse(self):
+        cache = FragmentCache()
+        cache.render([record(1, 20), record(2, 10)])
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        # only the farmer with a new height is encoded again
+        body = cache.render([record(1, 20), record(2, 30), record(3, 5)])
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        self.assertEqual(json.loads(body)["farmers"][1]["height"], 30)
+
+        # farmers that went offline are dropped
+        cache.render([record(3, 5)])
+        self.assertEqual(list(cache.fragments), ["addr3"])
+
+    def test_payout_change(self):
+        cache = FragmentCache()
+        cache.render([record(1, 20)])
+        body = cache.render([record(1, 20, payout_addr="other")])
+        self.assertEqual(json.loads(body)["farmers"][0]["payout_addr"],
+                         "other")
+
+    def test_plain_json_backend(self):
+        app.config["FAST_JSON"] = False
+        try:
+            self.assertEqual(serialize.dumps({"a": 1}), '{"a": 1}')
+        finally:
+            app.config["FAST_JSON"] = True
+
+
+class OnlineJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_online_json(self):
+        btc_addr = self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+        farmer = Farmer(btc_addr)
+        farmer.register()
+        farmer.set_height(42)
+
+        rv = self.app.get('/api/online/json')
+        self.assertEqual(rv.mimetype, "application/json")
+        self.assertEqual(rv.headers['Access-Control-Allow-Origin'], '*')
+        data = json.loads(rv.data.decode("utf-8"))
+        self.assertEqual(data["farmers"], [json.loads(farmer.to_json())])
@@ -0,0 +1,108 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from dataserv.run import app, db
+from btctxstore import BtcTxStore
+from dataserv.Farmer import Farmer
+from dataserv.app import online_farmers
+from dataserv.sharding import get_shards, shard_index
+
+
+class ShardingTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+
+        # several sqlite files stand in for the shard databases
+        self.tmp_dir = tempfile.mkdtemp()
+        app.config["SHARD_DATABASE_URIS"] = [
+            "sqlite:///" + os.path.join(self.tmp_dir, "shard{0}.db".format(i))
+            for i in range(3)
+        ]
+        self.shards = get_shards()
+        self.shards.create_all()
+
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        self.shards.remove_sessions()
+        self.shards.drop_all()
+        app.config["SHARD_DATABASE_URIS"] = []
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def new_address(self):
+        return self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+
+    def shard_addresses(self, index):
+        table = Farmer.__table__
+        rows = self.shards.engines[index].execute(table.select()).fetchall()
+        return set(row.btc_addr for row in rows)
+
+    def test_disabled(self):
+        app.config["SHARD_DATABASE_URIS"] = []
+        self.assertEqual(get_shards(), None)
+        app.config["SHARD_DATABASE_URIS"] = self.shards.uris
+        self.assertTrue(get_shards() is self.shards)
+
+    def test_routing(self):
+        addresses = [self.new_address() for i in range(9)]
+        for btc_addr in addresses:
+            farmer = Farmer(btc_addr)
+            self.assertFalse(farmer.exists())
+            farmer.register()
+            self.assertTrue(farmer.exists())
+            self.assertRaises(LookupError, farmer.register)
+
+        # every farmer lives on exactly the shard its address hashes to
+        for index in range(len(self.shards)):
+            expected = set(a for a in addresses
+                           if shard_index(a, len(self.shards)) == index)
+            self.assertEqual(self.shard_addresses(index), expected)
+
+        # nothing was written to the main database
+        self.assertEqual(db.session.query(Farmer).count(), 0)
+
+    def test_ping_and_height(self):
+        btc_addr = self.new_address()
+        farmer = Farmer(btc_addr)
+        self.assertRaises(LookupError, farmer.ping)
+        farmer.register()
+
+        self.assertEqual(farmer.set_height(50), 50)
+        self.assertEqual(Farmer(btc_addr).lookup().height, 50)
+        farmer.ping()
+
+        # through the api
+        rv = self.app.get('/api/height/{0}/{1}'.format(btc_addr, 70))
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/api/ping/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 200)
+        self.shards.remove_sessions()
+        self.assertEqual(Farmer(btc_addr).lookup().height, 70)
+
+    def test_online_merge(self):
+        heights = [5, 300, 0, 42, 300, 7, 1000, 42]
+        for height in heights:
+            farmer = Farmer(self.new_address())
+            farmer.register()
+            farmer.set_height(height)
+
+        farmers = online_farmers()
+        self.assertEqual([f.height for f in farmers],
+                         sorted(heights, reverse=True))
+        for a, b in zip(farmers, farmers[1:]):
+            self.assertTrue((-a.height, a.id) <= (-b.height, b.id))
+
+        rv = self.app.get('/api/online/json')
+        data = json.loads(rv.data.decode("utf-8"))
+        self.assertEqual(len(data["farmers"]), len(heights))
+        rv = self.app.get('/api/total')
+        self.assertTrue(b'"total_farmers": 8' in rv.data)
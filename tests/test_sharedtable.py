@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from datetime import datetime
+from datetime import timedelta
+from dataserv.run import app, db
+from btctxstore import BtcTxStore
+from dataserv.Farmer import FarmerRecord
+from dataserv.sharedtable import SharedTable, HEADER, RECORD
+
+
+def record(id, height, last_seen=None):
+    btc_addr = "1Addr{0:029d}".format(id)
+    last_seen = last_seen or datetime.utcnow().replace(microsecond=0)
+    return FarmerRecord(id, btc_addr, btc_addr, height, last_seen,
+                        last_seen - timedelta(days=1), 60 * id)
+
+
+def write_in_child(path, records):
+    SharedTable(path).write(records)
+
+
+class SharedTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "online")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_footprint(self):
+        self.assertEqual(HEADER.size, 32)
+        self.assertEqual(RECORD.size, 102)
+        SharedTable(self.path, capacity=1000)
+        self.assertEqual(os.path.getsize(self.path), 32 + 102 * 1000)
+
+    def test_round_trip(self):
+        table = SharedTable(self.path, capacity=10)
+        self.assertEqual(table.read(), [])
+        records = [record(1, 50), record(2, 20)]
+        table.write(records)
+        self.assertEqual(table.read(), records)
+        self.assertEqual(table.header()[0], 2)
+        self.assertTrue(table.age() < 5)
+
+        # a second mapping of the same file sees the same content
+        self.assertEqual(SharedTable(self.path).read(), records)
+
+    def test_grow(self):
+        table = SharedTable(self.path, capacity=2)
+        reader = SharedTable(self.path)
+        records = [record(i, i) for i in range(1, 6)]
+        table.write(records)
+        self.assertEqual(table.header()[3], 8)
+        self.assertEqual(reader.read(), records)
+
+    def test_other_process(self):
+        table = SharedTable(self.path, capacity=10)
+        records = [record(1, 50), record(2, 20)]
+        child = multiprocessing.Process(target=write_in_child,
+                                        args=(self.path, records))
+        child.start()
+        child.join()
+        self.assertEqual(table.read(), records)
+
+    def test_writer_died(self):
+        table = SharedTable(self.path, capacity=10)
+        table.write([record(1, 50)])
+        HEADER.pack_into(table._map, 0, 3, 0, 0.0, 10)  # stuck mid write
+        self.assertEqual(table.read(retries=10), None)
+
+    def test_refresh(self):
+        table = SharedTable(self.path, capacity=10)
+        self.assertTrue(table.refresh(lambda: [record(1, 5)], 10))
+        self.assertFalse(table.refresh(lambda: [record(2, 5)], 10))
+        self.assertEqual([r.id for r in table.read()], [1])
+
+        # someone else holds the refresh lock
+        import fcntl
+        fd = os.open(table.lock_path, os.O_RDWR)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            self.assertFalse(SharedTable(self.path).refresh(
+                lambda: [record(3, 5)], 0))
+        finally:
+            os.close(fd)
+        self.assertTrue(table.refresh(lambda: [record(3, 5)], 0))
+        self.assertEqual([r.id for r in table.read()], [3])
+
+
+class SharedTableAppTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.tmp_dir = tempfile.mkdtemp()
+        app.config["SHARED_TABLE_PATH"] = os.path.join(self.tmp_dir, "online")
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["SHARED_TABLE_PATH"] = None
+        app.config["SHARED_TABLE_REFRESH"] = 10
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_served_from_table(self):
+        btc_addr = self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+        self.app.get('/api/register/{0}'.format(btc_addr))
+        self.app.get('/api/height/{0}/{1}'.format(btc_addr, 10))
+
+        # the first read waits for the table to be written
+        rv = self.app.get('/api/online/json')
+        data = json.loads(rv.data.decode("utf-8"))
+        self.assertEqual(data["farmers"][0]["btc_addr"], btc_addr)
+        self.assertEqual(data["farmers"][0]["height"], 10)
+
+        # later writes show up after the next refresh only
+        self.app.get('/api/height/{0}/{1}'.format(btc_addr, 20))
+        rv = self.app.get('/api/online')
+        self.assertTrue(b"Height: 10" in rv.data)
+        app.config["SHARED_TABLE_REFRESH"] = 0
+        rv = self.app.get('/api/online')
+        self.assertTrue(b"Height: 20" in rv.data)
+        rv = self.app.get('/api/total')
+        self.assertTrue(b'"total_farmers": 1' in rv.data)
@@ -0,0 +1,138 @@
+import json
+import unittest
+from time import mktime
+from datetime import datetime
+from email.utils import formatdate
+from btctxstore import BtcTxStore
+from dataserv.app import app, db
+from dataserv.slowlog import SlowQueryLog, explain, slow_queries
+
+
+class SlowQueryLogTest(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        log = SlowQueryLog(3)
+        for i in range(5):
+            log.add({"statement": str(i)})
+        self.assertEqual([e["statement"] for e in log.recent()],
+                         ["4", "3", "2"])
+        log.resize(2)
+        self.assertEqual([e["statement"] for e in log.recent()], ["4", "3"])
+        log.clear()
+        self.assertEqual(log.recent(), [])
+
+
+class FakeCursor(object):
+
+    def __init__(self, executed):
+        self.executed = executed
+
+    def execute(self, statement, parameters=None):
+        self.executed.append(statement)
+        if statement.startswith("EXPLAIN"):
+            raise ValueError("no plan")
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, dialect):
+        self.dialect = type("Dialect", (object,), {"name": dialect})
+        self.executed = []
+        self.connection = self
+
+    def cursor(self):
+        return FakeCursor(self.executed)
+
+
+class ExplainTest(unittest.TestCase):
+
+    def test_failed_explain_in_savepoint(self):
+        conn = FakeConnection("postgresql")
+        plan = explain(conn, "SELECT 1", ())
+        self.assertEqual(plan, ["EXPLAIN failed: no plan"])
+        self.assertEqual(conn.executed, [
+            "SAVEPOINT slowlog_explain", "EXPLAIN SELECT 1",
+            "ROLLBACK TO SAVEPOINT slowlog_explain",
+            "RELEASE SAVEPOINT slowlog_explain"])
+
+    def test_no_savepoint_on_sqlite(self):
+        conn = FakeConnection("sqlite")
+        explain(conn, "SELECT 1", ())
+        self.assertEqual(conn.executed, ["EXPLAIN QUERY PLAN SELECT 1"])
+
+
+class SlowQueryAppTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+        slow_queries.clear()
+
+    def tearDown(self):
+        app.config["SLOW_QUERY_TIME"] = 0.5
+        app.config["SLOW_QUERY_EXPLAIN"] = False
+        app.config["ADMIN_ADDRESS"] = None
+        slow_queries.clear()
+        db.session.remove()
+        db.drop_all()
+
+    def new_address(self):
+        return self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+
+    def test_threshold(self):
+        self.app.get('/api/register/{0}'.format(self.new_address()))
+        self.assertEqual(slow_queries.recent(), [])
+
+        app.config["SLOW_QUERY_TIME"] = 1e-9  # everything is slow
+        btc_addr = self.new_address()
+        self.app.get('/api/register/{0}'.format(btc_addr))
+        entries = slow_queries.recent()
+        self.assertTrue(entries)
+        insert = [e for e in entries if e["statement"].startswith("INSERT")]
+        self.assertEqual(insert[0]["route"], "/api/register/<btc_addr>")
+        self.assertTrue(btc_addr in insert[0]["parameters"])
+        self.assertTrue(insert[0]["duration"] > 0)
+        self.assertEqual(insert[0]["plan"], None)
+
+    def test_failed_statement(self):
+        with db.engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.execute("SELECT * FROM no_such_table")
+            self.assertEqual(connection.info["slowlog_start"], [])
+
+    def test_explain(self):
+        app.config["SLOW_QUERY_TIME"] = 1e-9
+        app.config["SLOW_QUERY_EXPLAIN"] = True
+        self.app.get('/api/online')
+        select = [e for e in slow_queries.recent()
+                  if e["statement"].startswith("SELECT")][0]
+        self.assertEqual(select["route"], "/api/online")
+        self.assertTrue(select["plan"])
+        self.assertTrue("farmer" in " ".join(select["plan"]))
+
+    def test_admin_endpoint(self):
+        rv = self.app.get('/api/admin/slow-queries')
+        self.assertEqual(rv.status_code, 401)
+
+        wif = self.btctxstore.create_key()
+        app.config["ADMIN_ADDRESS"] = self.btctxstore.get_address(wif)
+        app.config["SLOW_QUERY_TIME"] = 1e-9
+        self.app.get('/api/total')
+        header_date = formatdate(timeval=mktime(datetime.now().timetuple()),
+                                 localtime=True, usegmt=True)
+        message = app.config["ADDRESS"] + " " + header_date
+        headers = {"Date": header_date,
+                   "Authorization": self.btctxstore.sign_unicode(wif,
+                                                                 message)}
+        rv = self.app.get('/api/admin/slow-queries', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data.decode("utf-8"))
+        self.assertEqual(data["threshold"], 1e-9)
+        self.assertTrue("/api/total" in [q["route"] for q in data["queries"]])
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from datetime import timedelta
+import sqlalchemy as sa
+from dataserv.app import db
+from dataserv.Farmer import Farmer, FarmerArchive
+from dataserv.snapshot import (decode, encode, read_snapshot,
+                               restore_snapshot, row_counts, take_snapshot,
+                               tables)
+
+
+class EncodingTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        now = datetime(2026, 10, 19, 12, 30, 15, 123456)
+        cases = [("id", [3, 4, 10, 1000000]),
+                 ("int", [0, None, -5, 2 ** 40]),
+                 ("time", [now, None, datetime(1969, 12, 31, 23, 59, 59)]),
+                 ("str", ["1abc", None, "", u"\xe9", "a\nb", "\0", "\n"])]
+        for kind, values in cases:
+            self.assertEqual(decode(kind, encode(kind, values), len(values)),
+                             values)
+
+    def test_damaged_str(self):
+        data = encode("str", ["abc", None])
+        self.assertRaises(ValueError, decode, "str", data[:-1], 2)
+        self.assertRaises(ValueError, decode, "str", data, 3)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "node.snapshot")
+        self.target = sa.create_engine("sqlite:///" + os.path.join(
+            self.directory, "target.db"))
+        db.metadata.create_all(self.target, tables=tables())
+        db.create_all()
+        now = datetime.utcnow()
+        self.farmers = [{"btc_addr": "addr{0}".format(i),
+                         "payout_addr": None if i == 3 else "pay{0}".format(i),
+                         "height": i * 10, "uptime": i,
+                         "last_seen": now - timedelta(seconds=i),
+                         "reg_time": now - timedelta(days=i)}
+                        for i in range(1, 26)]
+        db.engine.execute(Farmer.__table__.insert(), self.farmers)
+        db.engine.execute(Farmer.__table__.delete().where(
+            Farmer.__table__.c.btc_addr == "addr7"))  # a gap in the ids
+        db.engine.execute(FarmerArchive.__table__.insert(), [
+            {"btc_addr": "gone", "payout_addr": "gone", "height": 1,
+             "last_seen": now, "reg_time": now, "uptime": 0,
+             "archived": now}])
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.target.dispose()
+        shutil.rmtree(self.directory)
+
+    def rows(self, engine, table):
+        with engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(
+                sa.select(list(table.columns)).order_by(table.c.id))]
+
+    def test_round_trip(self):
+        counts = take_snapshot(db.engine, self.path, chunk=7)
+        self.assertEqual(counts, {"farmer": 24, "farmer_archive": 1})
+        self.assertEqual([len(rows) for _, _, rows in
+                          read_snapshot(self.path)], [7, 7, 7, 3, 1])
+        self.assertEqual(restore_snapshot(self.target, self.path), counts)
+        for table in tables():
+            self.assertEqual(self.rows(self.target, table),
+                             self.rows(db.engine, table))
+        self.assertEqual(row_counts(self.target), counts)
+
+        # the next farmer gets a new id after the restored ones
+        self.target.execute(Farmer.__table__.insert(), {"btc_addr": "new"})
+        self.assertEqual(self.target.execute(sa.select(
+            [Farmer.__table__.c.id]).where(
+            Farmer.__table__.c.btc_addr == "new")).scalar(), 26)
+
+    def test_restore_needs_empty_tables(self):
+        take_snapshot(db.engine, self.path)
+        restore_snapshot(self.target, self.path)
+        self.assertRaises(ValueError, restore_snapshot, self.target,
+                          self.path)
+        self.assertEqual(restore_snapshot(self.target, self.path,
+                                          replace=True)["farmer"], 24)
+
+    def test_truncated(self):
+        take_snapshot(db.engine, self.path)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        with open(self.path, "wb") as f:
+            f.write(data[:-6])  # the end marker
+        self.assertRaises(ValueError, restore_snapshot, self.target,
+                          self.path)
+        with open(self.path, "wb") as f:
+            f.write(b"garbage")
+        self.assertRaises(ValueError, restore_snapshot, self.target,
+                          self.path)
+        self.assertEqual(row_counts(self.target)["farmer"], 0)
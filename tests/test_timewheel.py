@@ -0,0 +1,133 @@
+import json
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from dataserv.run import app, db
+from btctxstore import BtcTxStore
+from dataserv.Farmer import Farmer, FarmerRecord
+from dataserv.app import online_farmers
+from dataserv.timewheel import TimeWheel, get_wheel, reset_wheel
+
+
+def record(id, height, last_seen):
+    btc_addr = "addr{0}".format(id)
+    return FarmerRecord(id, btc_addr, btc_addr, height, last_seen,
+                        last_seen, 0)
+
+
+class TimeWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.utcnow()
+        self.wheel = TimeWheel(5)
+
+    def test_order(self):
+        self.wheel.update(record(1, 10, self.now))
+        self.wheel.update(record(2, 30, self.now))
+        self.wheel.update(record(3, 10, self.now))
+        self.wheel.update(record(4, 20, self.now))
+        ids = [r.id for r in self.wheel.online(self.now)]
+        self.assertEqual(ids, [2, 4, 1, 3])
+
+        # height change moves the farmer
+        self.wheel.update(record(3, 40, self.now))
+        ids = [r.id for r in self.wheel.online(self.now)]
+        self.assertEqual(ids, [3, 2, 4, 1])
+        self.assertEqual(len(self.wheel), 4)
+
+    def test_expire(self):
+        self.wheel.update(record(1, 10, self.now - timedelta(minutes=4)))
+        self.wheel.update(record(2, 20, self.now - timedelta(minutes=2)))
+        self.wheel.update(record(3, 30, self.now))
+
+        # too old to be added at all
+        self.wheel.update(record(4, 40, self.now - timedelta(minutes=6)))
+        self.assertEqual(len(self.wheel), 3)
+
+        later = self.now + timedelta(minutes=2)
+        expired = self.wheel.expire(later)
+        self.assertEqual([r.id for r in expired], [1])
+        self.assertEqual([r.id for r in self.wheel.online(later)], [3, 2])
+
+        # a ping moves the farmer to a new bucket
+        self.wheel.update(record(2, 20, later))
+        later += timedelta(minutes=4)
+        self.assertEqual([r.id for r in self.wheel.online(later)], [2])
+        self.assertEqual(len(self.wheel.buckets), 1)
+
+    def test_boundary(self):
+        # exactly online_time ago is offline, like the database query
+        self.wheel.update(record(1, 10, self.now))
+        cutoff = self.now + timedelta(minutes=5)
+        self.assertEqual(self.wheel.online(cutoff - timedelta(seconds=1))[0].id,
+                         1)
+        self.assertEqual(self.wheel.online(cutoff), [])
+
+    def test_load(self):
+        self.wheel.update(record(9, 10, self.now))
+        self.wheel.load([record(1, 10, self.now), record(2, 20, self.now)],
+                        self.now)
+        self.assertEqual([r.id for r in self.wheel.online(self.now)], [2, 1])
+        self.assertTrue(self.wheel.loaded is not None)
+
+
+class OnlineTimeWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        app.config["ONLINE_TIMEWHEEL"] = False
+        reset_wheel()
+        db.session.remove()
+        db.drop_all()
+
+    def new_address(self):
+        return self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+
+    def test_warm_start(self):
+        online = Farmer(self.new_address())
+        online.register()
+        online.set_height(5)
+        offline = Farmer(self.new_address())
+        offline.register()
+        offline.last_seen = datetime.utcnow() - timedelta(minutes=10)
+        db.session.commit()
+
+        app.config["ONLINE_TIMEWHEEL"] = True
+        wheel = get_wheel(lambda: [f.record() for f in Farmer.query])
+        self.assertEqual(list(wheel.records), [online.btc_addr])
+
+    def test_fed_by_pings(self):
+        app.config["ONLINE_TIMEWHEEL"] = True
+        addr1 = self.new_address()
+        addr2 = self.new_address()
+        self.app.get('/api/register/{0}'.format(addr1))
+        self.app.get('/api/register/{0}'.format(addr2))
+        self.assertEqual(len(online_farmers()), 2)
+
+        # writes after the warm start reach the wheel through the observer
+        self.app.get('/api/height/{0}/{1}'.format(addr2, 100))
+        self.assertEqual(online_farmers()[0].btc_addr, addr2)
+        self.app.get('/api/height/{0}/{1}'.format(addr1, 200))
+        farmers = online_farmers()
+        self.assertEqual(farmers[0].btc_addr, addr1)
+        self.assertEqual(farmers[0].height, 200)
+
+        # endpoints are served from the wheel
+        addr3 = self.new_address()
+        self.app.get('/api/register/{0}'.format(addr3))
+        rv = self.app.get('/api/online/json')
+        data = json.loads(rv.data.decode("utf-8"))
+        self.assertEqual([f["btc_addr"] for f in data["farmers"]],
+                         [addr1, addr2, addr3])
+        self.assertEqual(data["farmers"][0]["height"], 200)
+        rv = self.app.get('/api/online')
+        self.assertTrue(addr3 in str(rv.data))
+        rv = self.app.get('/api/total')
+        self.assertTrue(b'"total_farmers": 3' in rv.data)
@@ -0,0 +1,173 @@
+import json
+import time
+import threading
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from btctxstore import BtcTxStore
+from dataserv.app import app, db
+from dataserv.Farmer import Farmer, FarmerArchive
+from dataserv.archive import archive_farmers
+from dataserv.walmode import get_writer, reset_writers
+
+
+class WalModeTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["SKIP_AUTHENTICATION"] = True  # monkey patch
+        app.config["DISABLE_CACHING"] = True
+        app.config["SQLITE_WAL"] = True
+        app.config["SQLITE_WRITER"] = True
+        self.max_ping = app.config["MAX_PING"]
+        self.btctxstore = BtcTxStore()
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        reset_writers()
+        app.config["SQLITE_WAL"] = False
+        app.config["SQLITE_WRITER"] = False
+        app.config["MAX_PING"] = self.max_ping
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()  # WAL can only be left without other connections
+        db.engine.execute("PRAGMA journal_mode=DELETE")
+        db.engine.dispose()
+
+    def new_address(self):
+        return self.btctxstore.get_address(self.btctxstore.get_key(
+                                        self.btctxstore.create_wallet()))
+
+    def test_pragmas(self):
+        connection = db.engine.connect()
+        try:
+            mode = connection.execute("PRAGMA journal_mode").scalar()
+            synchronous = connection.execute("PRAGMA synchronous").scalar()
+        finally:
+            connection.close()
+        self.assertEqual(mode, "wal")
+        self.assertEqual(synchronous, 1)  # NORMAL
+
+    def test_register_ping_height(self):
+        btc_addr = self.new_address()
+        rv = self.app.get('/api/register/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 200)
+        payload = json.loads(rv.data.decode("utf-8"))
+        self.assertEqual(payload["height"], 0)
+        self.assertEqual(payload["uptime"], 100)
+
+        rv = self.app.get('/api/register/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 409)
+
+        app.config["MAX_PING"] = 0
+        rv = self.app.get('/api/height/{0}/50'.format(btc_addr))
+        self.assertEqual(rv.status_code, 200)
+        farmer = Farmer(btc_addr).lookup()
+        self.assertEqual(farmer.height, 50)
+        self.assertTrue(farmer.reg_time <= farmer.last_seen)
+        self.assertTrue(get_writer().groups >= 3)
+
+    def test_concurrent_pings(self):
+        app.config["MAX_PING"] = 0
+        addresses = [self.new_address() for _ in range(4)]
+        for btc_addr in addresses:
+            Farmer(btc_addr).register()
+        before = datetime.utcnow()
+        codes = []
+
+        def pings(btc_addr):
+            client = app.test_client()
+            for _ in range(20):
+                codes.append(client.get(
+                    '/api/ping/{0}'.format(btc_addr)).status_code)
+
+        threads = [threading.Thread(target=pings, args=(btc_addr,))
+                   for btc_addr in addresses * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(codes, [200] * 160)
+        db.session.remove()
+        for btc_addr in addresses:
+            self.assertTrue(Farmer(btc_addr).lookup().last_seen >= before)
+
+    def test_failed_write(self):
+        writer = get_writer()
+        with self.assertRaises(Exception):
+            writer.submit(lambda connection: connection.execute(
+                "INSERT INTO missing VALUES (1)"))
+        self.assertEqual(writer.submit(
+            lambda connection: connection.execute("SELECT 1").scalar()), 1)
+
+    def queued(self, works):
+        """Submit works behind a blocked one, return results and groups."""
+        writer = get_writer()
+        blocked = threading.Event()
+        results = []
+
+        def submit(work):
+            try:
+                results.append(writer.submit(work))
+            except Exception:
+                results.append(-1)
+
+        threads = [threading.Thread(target=submit, args=(
+            lambda connection: blocked.wait() and 0,))]
+        threads += [threading.Thread(target=submit, args=(work,))
+                    for work in works]
+        threads[0].start()
+        while writer.queue.qsize():  # the blocked one is taken
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        while writer.queue.qsize() < len(works):
+            time.sleep(0.001)
+        groups = writer.groups
+        blocked.set()
+        for thread in threads:
+            thread.join(5)
+        return sorted(results), writer.groups - groups
+
+    def test_group_commit(self):
+        works = [lambda connection, i=i: i for i in range(1, 6)]
+        self.assertEqual(self.queued(works), (list(range(6)), 2))
+
+    def test_failed_write_in_group(self):
+        works = [lambda connection, i=i: i for i in range(1, 6)]
+        works.append(lambda connection: connection.execute(
+            "INSERT INTO missing VALUES (1)"))
+        # the group is retried write by write, only the bad one fails
+        self.assertEqual(self.queued(works), (list(range(-1, 6)), 6))
+
+    def test_revived_on_ping(self):
+        btc_addr = self.new_address()
+        Farmer(btc_addr).register()
+        last_seen = datetime.utcnow() - timedelta(days=40)
+        db.engine.execute(Farmer.__table__.update().values(
+            last_seen=last_seen, reg_time=last_seen))
+        self.assertEqual(archive_farmers(30, chunk=10), 1)
+        rv = self.app.get('/api/ping/{0}'.format(btc_addr))
+        self.assertEqual(rv.status_code, 200)
+        db.session.remove()
+        self.assertEqual(FarmerArchive.query.count(), 0)
+        farmer = Farmer(btc_addr).lookup()
+        self.assertTrue(datetime.utcnow() - farmer.last_seen <
+                        timedelta(seconds=5))
+
+    def test_not_revived_without_auth(self):
+        btc_addr = self.new_address()
+        Farmer(btc_addr).register()
+        last_seen = datetime.utcnow() - timedelta(days=40)
+        db.engine.execute(Farmer.__table__.update().values(
+            last_seen=last_seen, reg_time=last_seen))
+        self.assertEqual(archive_farmers(30, chunk=10), 1)
+        app.config["SKIP_AUTHENTICATION"] = False
+        try:
+            rv = self.app.get('/api/ping/{0}'.format(btc_addr))
+        finally:
+            app.config["SKIP_AUTHENTICATION"] = True
+        self.assertEqual(rv.status_code, 401)
+        db.session.remove()
+        self.assertEqual(FarmerArchive.query.count(), 1)
+        self.assertEqual(Farmer.query.count(), 0)
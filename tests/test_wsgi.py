@@ -0,0 +1,46 @@
+import sys
+import unittest
+import subprocess
+from dataserv import logs
+from dataserv.app import app
+from dataserv.wsgi import create_app, post_fork
+
+
+class LazyImportTest(unittest.TestCase):
+
+    def imported(self, code):
+        """Top level packages in sys.modules after code ran."""
+        script = code + "; import sys; print(' '.join(sys.modules))"
+        out = subprocess.check_output([sys.executable, "-c", script])
+        return set(name.split(".")[0] for name in out.decode().split())
+
+    def test_serving_imports(self):
+        modules = self.imported("import dataserv.app")
+        for name in ("alembic", "flask_migrate", "flask_script", "storjcore",
+                     "btctxstore", "pycoin"):
+            self.assertNotIn(name, modules)
+
+    def test_create_app(self):
+        modules = self.imported("import dataserv.wsgi; "
+                                "dataserv.wsgi.create_app()")
+        self.assertIn("storjcore", modules)
+        self.assertIn("btctxstore", modules)
+        self.assertNotIn("alembic", modules)
+        self.assertIs(create_app(), app)
+
+    def test_manage(self):
+        from dataserv.manage import manager
+        for command in ("db", "populate", "archive", "history",
+                        "compact_heights", "snapshot", "restore"):
+            self.assertIn(command, manager._commands)
+
+
+class PostForkTest(unittest.TestCase):
+
+    def test_restarts_log_listener(self):
+        if not app.config["LOG_QUEUE"] or logs.LazyQueueHandler is None:
+            self.skipTest("needs the log queue")
+        before = list(logs._listener)
+        post_fork(None, None)
+        self.assertEqual(len(logs._listener), 1)
+        self.assertIsNot(logs._listener[0], before[0])